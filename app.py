@@ -15,6 +15,7 @@ from google.cloud import storage
 from google.genai import types as genai_types
 
 from dbt_query_tool_agent.agent import root_agent
+from dbt_query_tool_agent.services.progress import iterate_with_progress
 from dbt_query_tool_agent.services.runner import create_runner
 from dbt_query_tool_agent.services.session import create_session
 from dbt_query_tool_agent.setup.initialization import init_vertexai
@@ -175,12 +176,19 @@ async def chat_interface(message: str, history: list, session_state: Any):
         start_new_bubble = False
         current_status = "Processing..."
 
-        async for event in agent_runner.run_async(
+        # Progress reported from inside long-running tools (e.g. streamed test
+        # script uploads) is interleaved with the agent's own events.
+        async for kind, event in iterate_with_progress(agent_runner.run_async(
             user_id=user_id,
             session_id=session_id,
             new_message=content,
             run_config=run_config,
-        ):
+        )):
+            if kind == 'progress':
+                current_status = event
+                yield "", history, session_state, current_status, gr.update()
+                continue
+
             download_update = gr.update() # Default to no change
 
             # Process all parts of the event before yielding a single UI update.
@@ -9,6 +9,7 @@ from dbt_query_tool_agent.tools.dbt_unit_testing import  run_unit_testing_dbt_pr
 from dbt_query_tool_agent.tools.dbt_profiles_generator import generate_dbt_profiles_yml_tool
 from dbt_query_tool_agent.tools.dbt_test_plan_generator import dbt_test_case_generator_tool
 from dbt_query_tool_agent.tools.dbt_test_report_generator import generate_dbt_test_report_tool
+from dbt_query_tool_agent.tools.dbt_artifact_repair import repair_dbt_artifact_tool
 
 root_agent = LlmAgent(
     name= "root_agent",
@@ -43,7 +44,7 @@ To get started, please upload your STTM file. Once uploaded, I will:
         - You will pass `artifact_type='snapshot'` and all the parameters you gathered.
         - **CRITICAL**: For the `gcs_url` parameter, you MUST use the GCS path of the STTM file that was uploaded at the beginning of the conversation. Do NOT ask the user for it again. The tool needs this path to determine where to save the generated snapshot file.
     * After the tool call is complete, announce the result to the user.
-    * **For Running Commands:** If the user asks to `run`, `test`, or `snapshot` the project, you must parse their intent and call `run_unit_testing_dbt_project_tool` with the corresponding `dbt_command`. You must look back in the conversation to find the GCS path for the project.
+    * **For Running Commands:** If the user asks to `run`, `test`, or `snapshot` the project, you must parse their intent and call `run_unit_testing_dbt_project_tool` with the corresponding `dbt_command`. You must look back in the conversation to find the GCS path for the project. The number of dbt threads is derived automatically; only pass `threads` if the user asks for a specific number.
 
 3.  **Autonomous Execution (Subsequent Turns):**
     * After the greeting, you will begin the execution plan. You MUST use the GCS path provided in the user's initial message for all tool calls.
@@ -52,6 +53,8 @@ To get started, please upload your STTM file. Once uploaded, I will:
         b. **Execute Tool:** Call the appropriate tool. This is a separate turn with NO text output.
         c. **Announce Result:** After the tool succeeds, send a message with the result.
     * You must strictly follow this "Announce, Execute, Result" pattern for every step.
+    * If the STTM is an `.xlsx` workbook and the user names the sheet holding the mapping, pass it as `sheet_name` to every STTM tool (schema, profiles, model and test plan). Otherwise omit it; the mapping sheet is detected automatically.
+    * Paths may be `gs://`, `file://` (local storage) or `mem://` (in-memory) URLs. Keep using the scheme of the uploaded STTM for every path you pass to the tools; the tools return paths in that scheme.
 
     **Tool and Step Mapping:**
     - **Step 1: Generate `schema.yml`**
@@ -64,7 +67,10 @@ To get started, please upload your STTM file. Once uploaded, I will:
         - Announce Result: "Success! profiles.yml file created. Next up: Generating the dbt model SQL."
     - **Step 3: Generate dbt model SQL files**
         - Announce: "Step 3 of 9: Starting dbt model SQL file generation..."
-        - Tool to call: `generate_dbt_model_sql_tool` with `artifact_type='model'`.
+        - Ask user: "How should the model be materialized: `view` (default, recomputed on every query), `table`, or `incremental` (only new rows are processed on each run)?"
+        - Tool to call: `generate_dbt_model_sql_tool` with `artifact_type='model'` and `materialization` set to the user's choice (omit it for `view`).
+        - If the tool output has a `materialization` field, tell the user the resulting configuration (e.g. the unique key, partitioning and clustering, or why an incremental model was built as a table).
+        - If the tool output has `catalog_issues`, list them: the STTM references tables or columns that do not exist in the warehouse, and the run in Step 5 will likely fail on them. Ask the user whether to continue or correct the STTM first.
         - Announce Result: "Success! The dbt model SQL has been generated. Next up: Generating dbt_project.yml."
     - **Step 4: Generate `dbt_project.yml`**
         - Announce: "Step 4 of 9: Starting dbt_project.yml file generation..."
@@ -78,13 +84,18 @@ To get started, please upload your STTM file. Once uploaded, I will:
         - **If Attempt 1 fails OR the output contains '[WARNING]':**
             - Announce the failure/warning, quoting the relevant lines from the `stdout`.
             - Analyze the error/warning to identify the problematic file (e.g., `models/ons.sql`, `models/schema.yml`).
-            - Call the appropriate generation tool (`generate_dbt_model_sql_tool` or `generate_dbt_schema_yml_tool`) with an instruction to fix the error. E.g., "The previous run failed with this message: '...'. Please regenerate the file, fixing this issue."
+            - Call `repair_dbt_artifact_tool` to patch ONLY that file. Do NOT regenerate the other artifacts.
+                - `artifact_gcs_path`: the GCS path of the failing file inside the project (e.g. `gs://<bucket>/<project>/dbt/models/ons.sql`).
+                - `error_message`: the error lines from the `stdout` (the full `stdout` is also accepted).
+                - `context_gcs_url`: the GCS path of the STTM file uploaded at the beginning of the conversation.
+                - Known errors are fixed without regenerating anything; the tool may patch a related file instead (e.g. add a missing source to `models/schema.yml`). Its `output_path` says which file was changed.
             - **Attempt 2:** Announce "Validation Attempt 2 of 3..." and call `run_unit_testing_dbt_project_tool` again with `dbt_command='run'`.
         - **If Attempt 2 fails OR contains warnings:**
-            - Repeat the process: announce the issue, analyze, call a tool to fix it.
+            - Repeat the process: announce the issue, analyze, call `repair_dbt_artifact_tool` to fix the failing file.
             - **Attempt 3:** Announce "Validation Attempt 3 of 3..." and call `run_unit_testing_dbt_project_tool` again.
         - **If any attempt succeeds:**
             - Announce: "dbt project ran successfully!" and proceed to Step 6.
+            - The tool output has a `profile`: briefly report the total execution time and bytes billed and the slowest model. If `profile.regressions` is not empty, tell the user which models got slower or more expensive than in the previous run.
         - **If all 3 attempts fail:**
             - Report the final error to the user, including the full `stdout` from the last attempt, and stop the workflow.
     - **Step 6: Generate Test Plan**
@@ -98,24 +109,30 @@ To get started, please upload your STTM file. Once uploaded, I will:
         - Ask user: "Would you also like me to generate dbt SQL test scripts based on the test plan we just created?"
         - If the user confirms, you MUST call `generate_dbt_model_sql_tool` with `artifact_type='test'`.
         - **CRITICAL**: For the `gcs_url` parameter of the tool, you MUST use the GCS path of the test plan file that was generated in the previous step. Do NOT use the original STTM file path.
+        - Pass `consolidate=True` so that null, uniqueness, accepted-values and transformation-logic checks are folded into single-scan queries (written to `analyses/consolidated_*.sql`). Only pass `consolidate=False` if the user asks for one test file per test case.
+        - If the user asks for native dbt tests, also pass `generic_tests=True`: null, uniqueness, accepted-values and referential integrity checks are then declared as generic tests in `models/schema.yml` instead of SQL files, and only the remaining checks are generated as SQL.
         - Announce Result: "Success! Test scripts created. Next up: Running tests."
     - **Step 8: Run and Self-Correct dbt Tests (Iterative)**
         - Announce: "Step 8 of 9: Running dbt tests..."
         - Ask the user if they want to run the tests. If they do not confirm, stop here.
         - If they confirm, you will now attempt to run `dbt test` up to 3 times to fix any syntactical errors.
+        - These attempts only look for compilation and 'Database Error' failures, so they run on sampled data: pass `sample=True` to `run_unit_testing_dbt_project_tool` for every attempt.
         - **Attempt 1:**
-            - Announce: "Test Execution Attempt 1 of 3: Running dbt test..."
-            - Call `run_unit_testing_dbt_project_tool` with `dbt_command='test'`.
+            - Announce: "Test Execution Attempt 1 of 3: Running dbt test on sampled data..."
+            - Call `run_unit_testing_dbt_project_tool` with `dbt_command='test'` and `sample=True`.
         - **If Attempt 1 fails with a 'Database Error':**
             - Announce the failure, quoting the relevant lines from the `stdout` that show the syntax error.
-            - Analyze the error to identify the problematic test file (e.g., `tests/assert_something.sql`).
-            - Call `generate_dbt_model_sql_tool` with `artifact_type='test'` and an instruction to fix the specific error. E.g., "The previous test run failed for `tests/assert_something.sql` with this message: '...'. Please regenerate all test scripts from the test plan, ensuring you fix this specific syntax issue."
-            - **CRITICAL**: You must use the GCS path of the test plan file from Step 6 for this tool call.
-            - **Attempt 2:** Announce "Test Execution Attempt 2 of 3..." and call `run_unit_testing_dbt_project_tool` again with `dbt_command='test'`.
+            - Analyze the error to identify the problematic test file (e.g., `tests/assert_something.sql`, a consolidated query such as `analyses/consolidated_ons_checks.sql`, or `models/schema.yml` for a generic test).
+            - Call `repair_dbt_artifact_tool` once for EACH failing test file. Do NOT regenerate all test scripts.
+                - `artifact_gcs_path`: the GCS path of the failing test (e.g. `gs://<bucket>/<project>/dbt/tests/assert_something.sql`).
+                - `error_message`: the error lines for that test from the `stdout`.
+                - **CRITICAL**: `context_gcs_url` MUST be the GCS path of the test plan file from Step 6.
+            - **Attempt 2:** Announce "Test Execution Attempt 2 of 3..." and call `run_unit_testing_dbt_project_tool` again with `dbt_command='test'` and `sample=True`.
         - **If Attempt 2 fails with a 'Database Error':**
-            - Repeat the process: announce the issue, analyze, call `generate_dbt_model_sql_tool` to fix it.
-            - **Attempt 3:** Announce "Test Execution Attempt 3 of 3..." and call `run_unit_testing_dbt_project_tool` again.
+            - Repeat the process: announce the issue, analyze, call `repair_dbt_artifact_tool` for each failing test.
+            - **Attempt 3:** Announce "Test Execution Attempt 3 of 3..." and call `run_unit_testing_dbt_project_tool` again with `sample=True`.
         - **If any attempt succeeds OR fails for reasons other than 'Database Error' (e.g., a data quality failure like 'Got X results...'):**
+            - The tests now compile and execute. Announce: "Tests execute cleanly. Running them once on the full data..." and call `run_unit_testing_dbt_project_tool` with `dbt_command='test'` and `sample=False`. Use the output of THIS run for everything below; results of sampled runs are not final.
             - Announce: "dbt test run complete."
             - You MUST show the user the results. If the tool output contains a `stdout` field, display the full content of that field in a markdown code block. If there is no `stdout` field, display the `message` from the tool output.
             - **CRITICAL**: The tool output from the test run contains a `test_results` list. You MUST extract and save this list of results. It is required for the next step.
@@ -129,6 +146,8 @@ To get started, please upload your STTM file. Once uploaded, I will:
         - **CRITICAL**: For the `test_results` parameter, you MUST use the `test_results` list that you extracted and saved from the previous step (Step 8).
         - You will need the `test_plan_gcs_path` from Step 6.
         - **CRITICAL**: You MUST convert this list of test results into a JSON formatted string before passing it to the tool.
+        - Pass `output_format='xlsx'` or `output_format='parquet'` if the user asks for an Excel or Parquet report; the default is CSV.
+        - When announcing the result, also mention the slowest tests and the total bytes processed from the tool output.
         - Announce Result: "Test report generated successfully. A download link should now be visible in the UI."
 
 4.  **Error Handling:**
@@ -159,6 +178,7 @@ Here is the full log output from the tool:
         run_unit_testing_dbt_project_tool,
         dbt_test_case_generator_tool,
         generate_dbt_profiles_yml_tool,
-        generate_dbt_test_report_tool
+        generate_dbt_test_report_tool,
+        repair_dbt_artifact_tool
     ]
 )
\ No newline at end of file
@@ -0,0 +1,146 @@
+import os
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """The model and generation settings used for one kind of LLM task."""
+    model_name: str
+    max_output_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    thinking_budget: Optional[int] = None  # None keeps the model's default thinking behaviour
+    max_input_tokens: Optional[int] = None  # Prompt budget enforced by services/prompt_builder.py
+
+
+# --- Model routing table ---
+# Trivial, latency-sensitive inferences go to a lite model with a small output
+# budget; large generations get the full model and enough room to finish.
+# Every field can be overridden per task with environment variables, e.g.
+#   DBT_AGENT_MODEL_MODEL_SQL=gemini-2.5-pro
+#   DBT_AGENT_MAX_TOKENS_TEST_SQL=65535
+#   DBT_AGENT_TEMPERATURE_YAML=0
+#   DBT_AGENT_THINKING_BUDGET_DATASET_INFERENCE=0
+#   DBT_AGENT_MAX_INPUT_TOKENS_TEST_PLAN=32000
+# Input budgets keep prompts (and latency) flat as mappings grow: larger
+# mappings are projected, shortened or split into several calls.
+MODEL_ROUTES: Dict[str, ModelRoute] = {
+    'dataset_inference': ModelRoute('gemini-2.5-flash-lite', max_output_tokens=256, temperature=0.0, thinking_budget=0, max_input_tokens=8000),
+    'yaml': ModelRoute('gemini-2.5-flash', max_output_tokens=8192, temperature=0.1, thinking_budget=1024, max_input_tokens=32000),
+    'model_sql': ModelRoute('gemini-2.5-flash', max_output_tokens=32768, temperature=0.2, max_input_tokens=100000),
+    'test_sql': ModelRoute('gemini-2.5-flash', max_output_tokens=65535, temperature=0.1, max_input_tokens=100000),
+    'test_plan': ModelRoute('gemini-2.5-flash', max_output_tokens=16384, temperature=0.2, max_input_tokens=48000),
+    'repair': ModelRoute('gemini-2.5-flash', max_output_tokens=16384, temperature=0.1, max_input_tokens=64000),
+    'sttm_extraction': ModelRoute('gemini-2.5-flash', max_output_tokens=32768, temperature=0.0, max_input_tokens=16000),
+}
+
+# Which routing task each `artifact_type` of generate_dbt_model_sql uses.
+ARTIFACT_TYPE_TASKS = {
+    'model': 'model_sql',
+    'macro': 'model_sql',
+    'schema_yml': 'yaml',
+    'profiles_yml': 'yaml',
+    'test': 'test_sql',
+}
+
+
+def _env_override(name: str, cast):
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return None
+    return cast(value.strip())
+
+
+def get_model_route(task: str) -> ModelRoute:
+    """
+    Returns the routing entry for `task`, with any `DBT_AGENT_*_<TASK>`
+    environment overrides applied.
+
+    Raises:
+        KeyError: If `task` is not in MODEL_ROUTES.
+    """
+    route = MODEL_ROUTES[task]
+    suffix = task.upper()
+    overrides = {
+        'model_name': _env_override(f"DBT_AGENT_MODEL_{suffix}", str),
+        'max_output_tokens': _env_override(f"DBT_AGENT_MAX_TOKENS_{suffix}", int),
+        'temperature': _env_override(f"DBT_AGENT_TEMPERATURE_{suffix}", float),
+        'thinking_budget': _env_override(f"DBT_AGENT_THINKING_BUDGET_{suffix}", int),
+        'max_input_tokens': _env_override(f"DBT_AGENT_MAX_INPUT_TOKENS_{suffix}", int),
+    }
+    overrides = {key: value for key, value in overrides.items() if value is not None}
+    return replace(route, **overrides) if overrides else route
+
+
+# --- Test script generation ---
+# Large test plans are split into batches of this many rows, generated
+# concurrently (at most TEST_SCRIPT_BATCH_CONCURRENCY batches at a time per
+# request, on top of the global LLM gateway limits).
+TEST_SCRIPT_BATCH_SIZE = int(os.environ.get("DBT_AGENT_TEST_BATCH_SIZE", "25"))
+TEST_SCRIPT_BATCH_CONCURRENCY = int(os.environ.get("DBT_AGENT_TEST_BATCH_CONCURRENCY", "4"))
+
+
+# --- Sampled test runs ---
+# `dbt test` with sample=True reads every model through a sample: tables with
+# TABLESAMPLE at this percentage, views limited to this many rows. Sources are
+# read in full so referential and derivation checks do not fail spuriously.
+TEST_SAMPLE_PERCENT = float(os.environ.get("DBT_AGENT_TEST_SAMPLE_PERCENT", "1"))
+TEST_SAMPLE_ROWS = int(os.environ.get("DBT_AGENT_TEST_SAMPLE_ROWS", "10000"))
+
+
+# --- Model SQL optimizer ---
+# Generated models are rewritten before upload to prune unused columns and
+# joins and push filters down (see services/sql_optimizer.py). Set to 0 to
+# upload them exactly as generated.
+SQL_OPTIMIZER_ENABLED = os.environ.get("DBT_AGENT_SQL_OPTIMIZER", "1").lower() not in ("0", "false", "no")
+
+
+# --- dbt concurrency ---
+# dbt threads are derived from the width of the project DAG (independent models
+# for `run`, tests for `test`) and capped by this budget of concurrent
+# BigQuery jobs per invocation.
+MAX_WAREHOUSE_CONCURRENCY = int(os.environ.get("DBT_AGENT_MAX_WAREHOUSE_CONCURRENCY", "8"))
+# Written to profiles.yml: retries of transient BigQuery job errors, query
+# priority ('interactive' or 'batch') and the per-query timeout.
+DBT_JOB_RETRIES = int(os.environ.get("DBT_AGENT_DBT_JOB_RETRIES", "1"))
+DBT_QUERY_PRIORITY = os.environ.get("DBT_AGENT_DBT_QUERY_PRIORITY", "interactive")
+DBT_TIMEOUT_SECONDS = int(os.environ.get("DBT_AGENT_DBT_TIMEOUT_SECONDS", "300"))
+
+
+# --- Source column catalog ---
+# Column lists of the STTM source tables are read from INFORMATION_SCHEMA and
+# cached for this many seconds. Set DBT_AGENT_CATALOG_PATH to a JSON file of
+# {"dataset.table": {"COLUMN": "TYPE", ...}} to use it instead (offline use).
+CATALOG_TTL_SECONDS = int(os.environ.get("DBT_AGENT_CATALOG_TTL_SECONDS", "3600"))
+CATALOG_PATH = os.environ.get("DBT_AGENT_CATALOG_PATH", "")
+
+
+# --- Context caching ---
+# The instructions and STTM shared by the generators of one upload are stored
+# as a Vertex AI cached context for this many seconds, so later calls (other
+# artifacts, regenerations during repair) do not resend them. Prefixes smaller
+# than the provider minimum are sent as-is. Set DBT_AGENT_CONTEXT_CACHE=0 to
+# always send full prompts.
+CONTEXT_CACHE_ENABLED = os.environ.get("DBT_AGENT_CONTEXT_CACHE", "1").lower() not in ("0", "false", "no")
+CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("DBT_AGENT_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("DBT_AGENT_CONTEXT_CACHE_MIN_TOKENS", "2048"))
+
+
+# --- Image STTM ingestion ---
+# An uploaded STTM image is converted to grayscale, cropped to its content and
+# scaled down to this width, then cut into tiles of at most this height, and
+# its table is extracted to CSV with one multimodal call. The CSV is cached by
+# the upload's hash, so every tool after the first reads text, not the image.
+STTM_IMAGE_MAX_WIDTH = int(os.environ.get("DBT_AGENT_STTM_IMAGE_MAX_WIDTH", "1536"))
+STTM_IMAGE_TILE_HEIGHT = int(os.environ.get("DBT_AGENT_STTM_IMAGE_TILE_HEIGHT", "1536"))
+
+
+# --- Storage ---
+# Tools accept gs://, file:// and mem:// URLs (see services/storage.py).
+# file://<bucket>/<path> maps to <DBT_AGENT_LOCAL_STORAGE_ROOT>/<bucket>/<path>,
+# so local projects have the same layout as in GCS. Bulk copies (e.g. a project
+# downloaded for dbt) transfer this many objects at a time.
+LOCAL_STORAGE_ROOT = os.environ.get(
+    "DBT_AGENT_LOCAL_STORAGE_ROOT", os.path.join(os.path.expanduser("~"), ".dbt_query_tool_agent", "storage")
+)
+STORAGE_COPY_CONCURRENCY = int(os.environ.get("DBT_AGENT_STORAGE_COPY_CONCURRENCY", "16"))
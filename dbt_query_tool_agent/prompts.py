@@ -31,11 +31,8 @@ DBT_MODEL_SQL_PROMPT = """
        - Include `LEFT JOIN` clauses within the `source_data` CTE based on the 'Join Table' and 'Join Key' information.
        - **Alias Resolution**: The STTM might use ambiguous aliases like 'T2' for different join tables. You MUST assign a unique, sequential alias (T1, T2, T3, ...) to each unique source table and use that unique alias consistently in the join conditions and the final SELECT. T1 is always the primary source table.
     6. **SQL Dialect Conversion**:
-       - The 'Transformation Logic' may contain SQL syntax from other dialects (e.g., PostgreSQL). You MUST convert this to standard BigQuery SQL.
-       - For example:
-         - Convert `SUBSTRING(column FROM start FOR length)` to `SUBSTR(column, start, length)`.
-         - Convert `Position(' ' IN column)` to `STRPOS(column, ' ')`.
-         - Convert `CAST(column TO datatype)` to `CAST(column AS datatype)`.
+       - The 'Transformation Logic' in the CSV has already been converted to BigQuery SQL. Use it as given; only replace table aliases as described in the other sections.
+       - If an 'Unconverted Transformation Logic' section follows the CSV, the rows it lists could not be converted automatically. Convert only those expressions to standard BigQuery SQL (e.g., `SUBSTRING(column FROM start FOR length)` becomes `SUBSTR(column, start, length)`).
     7. **Final `SELECT` Statement and Column Sourcing**:
       - **Deduplication**: If the source data might contain duplicate rows and no single primary key is being used to uniquely identify rows, use `SELECT DISTINCT` in the final `SELECT` statement to ensure the model produces unique records.
       - Every column in the final `SELECT` statement must exist in the `source_data` CTE or be derived in an intermediate CTE.
@@ -51,41 +48,6 @@ DBT_MODEL_SQL_PROMPT = """
 
   """
     
-DBT_SNAPSHOT_SQL_PROMPT = """
-    **Instructions for DBT Snapshots (SQL Files):**
-    Your task is to generate the complete SQL code for a dbt snapshot file.
-    You will be given the exact configuration details. You MUST use ONLY these details.
-    Do not use examples from your training data like 'stripe'.
-    The final output should be ONLY the raw SQL code, with no extra commentary or markdown.
-
-    **You MUST follow this structure precisely:**
-
-       ```sql
-       {% snapshot [Snapshot Name] %}
-       {{ config(
-           target_database='[Target Database]',
-           target_schema='[Target Schema]',
-           unique_key='[Unique Key]',
-           strategy='[Strategy]',
-           [check_cols or updated_at]='[Value for strategy]'
-       ) }}
-
-       select * from {{ ref('[Source Model to reference]') }}
-
-       {% endsnapshot %}
-       ```
-
-    **Explanation of Placeholders:**
-    - `[Snapshot Name]`: Use the "Snapshot Name" provided.
-    - `[Unique Key]`: Use the "Unique Key" provided.
-    - `[Strategy]`: Use the "Strategy" provided.
-    - `[Target Database]`: Use the "Target Database" provided.
-    - `[Target Schema]`: Use the "Target Schema" provided.
-    - `[check_cols or updated_at]`:
-        - If the strategy is 'check', use the literal `check_cols` and the value from "Check Columns". If the value is 'all', use `check_cols='all'`. Otherwise, format it as a list of strings, e.g., `check_cols=['col1', 'col2']`.
-        - If the strategy is 'timestamp', use the literal `updated_at` and the value from "Updated At Column".
-    - `[Source Model to reference]`: Use the "Source Model to reference" provided.
- """
 DBT_MACRO_SQL_PROMPT = """
     **Instructions for DBT Macros (SQL or Jinja Files):**
     1. **Purpose**: Generate reusable Jinja macros for common SQL patterns or complex logic.
@@ -140,7 +102,7 @@ DBT_PROFILES_YML_PROMPT = """
     **Instructions for DBT `profiles.yml` (YAML File):**
     1. **Purpose**: Generate a `profiles.yml` file to configure dbt connections to your data warehouse (e.g., BigQuery).
     2. **File Naming Convention**: The file should be named `profiles.yml` and stored at the root of the dbt project.
-    3. **Configuration**: Use the provided 'DBT Project Name' as the top-level profile name. Configure the `dev` target for BigQuery using the provided `project`, `dataset`, `threads`, and `timeout_seconds`.
+    3. **Configuration**: Use the provided 'DBT Project Name' as the top-level profile name. Configure the `dev` target for BigQuery using the provided `project`, `dataset`, `threads`, `timeout_seconds`, `job_retries` and `priority`.
     4. **CRITICAL**: The timeout property for BigQuery MUST be `timeout_seconds`. Do NOT use `job_timeout_ms` or any other variant. This is a common error, so double-check your output.
     5. **Example Structure**:
        ```yaml
@@ -152,8 +114,9 @@ DBT_PROFILES_YML_PROMPT = """
              method: oauth
              project: "your_bigquery_project_id"
              dataset: "your_bigquery_dataset_name"
-             threads: 1
+             threads: 4
              timeout_seconds: 300 # MUST be this exact key name.
+             job_retries: 1
              priority: interactive
        ```
 """
@@ -206,11 +169,10 @@ DBT_TEST_SQL_PROMPT = """
     2. **Input**: The input will be the full text of a test plan CSV file. It contains columns like "Test ID", "Test Type", "Model/Component Tested", "Target Column(s)", "Source Columns", and "Derivation Rule/Condition".
 
     3. **Crucial Output Formatting**:
-       - You MUST generate a single text response that contains a separate SQL script for each row in the input CSV.
-       - Each script within your response MUST be separated by a line containing only `---`.
-       - Immediately following the `---` separator, you MUST add a line specifying the filename: `output_file_name: {test_file_name}.sql`.
-       - The `{test_file_name}` MUST be taken directly from the "Test ID" column of the corresponding row in the test plan.
-       - The SQL code for the test MUST begin on the very next line after the `output_file_name` directive. Do not add extra blank lines or commentary.
+       - Your response MUST be a JSON array with exactly one object per row in the input CSV.
+       - Each object has two string fields:
+         - `file_name`: `{test_file_name}.sql`, where `{test_file_name}` MUST be taken directly from the "Test ID" column of the corresponding row in the test plan.
+         - `sql`: the complete SQL code for the test, with no markdown code fences or commentary.
 
     4. **General SQL Generation Rules**:
        - **Model Reference**: To refer to the dbt model being tested, you MUST use the `{{ ref('model_name') }}` macro. The `model_name` will be explicitly provided to you in the instructions (e.g., 'The model being tested is named 'ons''). **You MUST use this provided model name.** IGNORE the 'Model/Component Tested' column in the test plan CSV and use the name from the instructions instead. This is critical to avoid referencing a non-existent model.
@@ -271,6 +233,9 @@ DBT_TEST_SQL_PROMPT = """
            where {{ Target Column(s) }} not in ('value_1', 'value_2', 'etc')
            ```
 
+       - **If "Test Type" is 'Direct Mapping'**:
+         - Use the 'Transformation Logic' template below. The "Derivation Rule/Condition" is the source column itself, so the expected value is `s.{{ Source Columns }}`; the source table is named in the "Test Scenario".
+
        - **If "Test Type" is 'Transformation Logic' (Most Complex)**:
          - This test requires you to re-implement the transformation logic from the source data and compare it to the final data in the model.
          - You MUST join the final model back to the original source tables.
@@ -312,58 +277,52 @@ DBT_TEST_SQL_PROMPT = """
 
     6. **Example of Final Output Structure**:
        The following is a brief example of the required output format. Remember, you MUST generate a script for **every single test case** in the provided test plan CSV, not just the two tests shown in this example.
-       ```sql
-       ---
-       output_file_name: assert_ons_postcode_is_unique.sql
-       select
-         postcode
-       from {{ ref('ons') }}
-       where postcode is not null
-       group by 1
-       having count(*) > 1
-
-       ---
-       output_file_name: assert_ons_rural_in_transformation.sql
-       with source_data as (
-           select
-             t1.PCDS,
-             t2.RU11NM
-           from {{ source('test_lbg', 'onspd_full') }} as t1
-           left join {{ source('test_lbg', 'rural_urban') }} as t2 on t1.ru11ind = t2.ru11ind
-       ),
-       model_data as (
-           select POST_CODE, RURAL_IN from {{ ref('ons') }}
-       )
-       select m.POST_CODE
-       from model_data m
-       join source_data s on m.POST_CODE = s.PCDS
-       where
-           (m.RURAL_IN is not distinct from (
-               CASE
-                   WHEN s.RU11NM LIKE '%Urban%' THEN 'U'
-                   WHEN s.RU11NM LIKE '%Rural%' THEN 'R'
-                   ELSE NULL
-               END
-           )) = false
+       ```json
+       [
+         {
+           "file_name": "assert_ons_postcode_is_unique.sql",
+           "sql": "select\n  postcode\nfrom {{ ref('ons') }}\nwhere postcode is not null\ngroup by 1\nhaving count(*) > 1"
+         },
+         {
+           "file_name": "assert_ons_rural_in_transformation.sql",
+           "sql": "with source_data as (\n    select\n      t1.PCDS,\n      t2.RU11NM\n    from {{ source('test_lbg', 'onspd_full') }} as t1\n    left join {{ source('test_lbg', 'rural_urban') }} as t2 on t1.ru11ind = t2.ru11ind\n),\nmodel_data as (\n    select POST_CODE, RURAL_IN from {{ ref('ons') }}\n)\nselect m.POST_CODE\nfrom model_data m\njoin source_data s on m.POST_CODE = s.PCDS\nwhere\n    (m.RURAL_IN is not distinct from (\n        CASE\n            WHEN s.RU11NM LIKE '%Urban%' THEN 'U'\n            WHEN s.RU11NM LIKE '%Rural%' THEN 'R'\n            ELSE NULL\n        END\n    )) = false"
+         }
+       ]
        ```
 """
 
+DBT_CONSOLIDATED_DERIVATION_PROMPT = """
+    **Instructions for Consolidated Transformation Logic Checks:**
+    1. **Primary Goal**: You will be given the 'Transformation Logic' and 'Direct Mapping' rows of a test plan (in CSV format) for ONE dbt model. Instead of one test file per row, all rows are checked by a single query that joins the model to its source data once. You provide the pieces; the query itself is assembled for you.
+    2. **Output Format**: Return a single JSON object with these fields and nothing else:
+       - `source_sql`: ONE BigQuery `select` that re-creates the source data needed by every row, including the source column that corresponds to the model's primary key and all source columns used by the derivation rules. Use `{{ source('dataset_name', 'table_name') }}` for raw tables and `LEFT JOIN` for join tables. No trailing semicolon, no markdown.
+       - `model_key`: the primary key column of the model (e.g. `POST_CODE`).
+       - `source_key`: the column of `source_sql` that matches `model_key` (e.g. `PCDS`).
+       - `checks`: one object per CSV row with:
+         - `test_id`: the "Test ID" of the row, unchanged.
+         - `target_column`: the model column being validated.
+         - `expected_expression`: the BigQuery expression that re-computes the expected value from `source_sql`. Source columns MUST be prefixed with `s.` (replace aliases such as `T1.` or `T2.` with `s.`). Model columns, if needed, are prefixed with `m.`. For a 'Direct Mapping' row it is just the source column, e.g. `s.PCDS`.
+    3. **SQL Dialect**: All SQL MUST be valid Google BigQuery SQL.
+    4. **Example**:
+       {"source_sql": "select t1.PCDS, t2.RU11NM from {{ source('test_lbg', 'onspd_full') }} as t1 left join {{ source('test_lbg', 'rural_urban') }} as t2 on t1.ru11ind = t2.ru11ind", "model_key": "POST_CODE", "source_key": "PCDS", "checks": [{"test_id": "assert_ons_rural_in_transformation", "target_column": "RURAL_IN", "expected_expression": "CASE WHEN s.RU11NM LIKE '%Urban%' THEN 'U' WHEN s.RU11NM LIKE '%Rural%' THEN 'R' ELSE NULL END"}]}
+"""
+
 DBT_TEST_CASE_SHEET_PROMPT = """
     **Instructions for DBT Test Case Sheet Generation (CSV or XLSX Format):**
     1. **Purpose**: Generate a comprehensive and structured test case sheet based on the provided Source-to-Target Mapping (STTM). This sheet should outline a wide variety of test scenarios, expected results, and the rationale for each test to ensure high data quality.
-    2. **Output Format**: The output must be in a **structured CSV format**. Do NOT include any markdown code blocks (e.g., ```csv) or additional explanatory text before or after the CSV content. The header row should be the first line of the output.
+    2. **Output Format**: The output must be a **JSON array** with one object per test case. Do NOT include any markdown code blocks or explanatory text.
     3. **Content**:
-       - The CSV should include the following columns. Each column name should be enclosed in double quotes.
-         - **"Test ID"**: A unique identifier for the test case that will match the dbt test name. Use the format `assert_{model_name}_{test_scenario_slug}` (e.g., `assert_ons_postcode_is_unique`).
-         - **"Test Scenario"**: A clear, concise description of what is being tested.
-         - **"Model/Component Tested"**: The dbt model or component the test applies to (e.g., `your_model_name`).
-         - **"Test Type"**: The category of test (e.g., "Data Integrity", "Transformation Logic", "Uniqueness", "Null Check", "Referential Integrity", "Accepted Values", "Format Check").
-         - **"Source Columns"**: Relevant source columns involved in the test (comma-separated if multiple).
-         - **"Target Column(s)"**: The target column(s) being validated (comma-separated if multiple).
-         - **"Expected Result"**: A description of the expected outcome if the transformation or data quality rule is correctly applied.
-         - **"Derivation Rule/Condition"**: If applicable, the specific derivation rule or business condition from the STTM that this test validates.
-         - **"Test Data Considerations"**: Any specific data conditions or edge cases that this test targets (e.g., "NULL values in source", "Specific date ranges", "Empty strings").
-         - **"Priority"**: (High, Medium, Low) based on the criticality of the data or transformation.
+       - Each object MUST have the following string fields:
+         - **`test_id`** ("Test ID"): A unique identifier for the test case that will match the dbt test name. Use the format `assert_{model_name}_{test_scenario_slug}` (e.g., `assert_ons_postcode_is_unique`). Only letters, digits and underscores.
+         - **`test_scenario`** ("Test Scenario"): A clear, concise description of what is being tested.
+         - **`model_component_tested`** ("Model/Component Tested"): The dbt model or component the test applies to (e.g., `your_model_name`).
+         - **`test_type`** ("Test Type"): The category of test (e.g., "Data Integrity", "Transformation Logic", "Uniqueness", "Null Check", "Referential Integrity", "Accepted Values", "Format Check").
+         - **`source_columns`** ("Source Columns"): Relevant source columns involved in the test (comma-separated if multiple).
+         - **`target_columns`** ("Target Column(s)"): The target column(s) being validated (comma-separated if multiple).
+         - **`expected_result`** ("Expected Result"): A description of the expected outcome if the transformation or data quality rule is correctly applied.
+         - **`derivation_rule`** ("Derivation Rule/Condition"): If applicable, the specific derivation rule or business condition from the STTM that this test validates.
+         - **`test_data_considerations`** ("Test Data Considerations"): Any specific data conditions or edge cases that this test targets (e.g., "NULL values in source", "Specific date ranges", "Empty strings").
+         - **`priority`** ("Priority"): One of High, Medium, Low based on the criticality of the data or transformation.
 
        - **Infer Test Cases from STTM**: You must analyze the STTM and generate a focused but comprehensive set of test cases. **The total number of generated test cases MUST NOT exceed 20.** Prioritize the following scenarios to stay within the limit:
          - **Transformation Logic Tests (Highest Priority)**: For each row that has a non-empty 'Transformation Logic / Derivation Rule', generate **exactly one** 'Transformation Logic' test case to validate it. This is the most important category.
@@ -373,17 +332,35 @@ DBT_TEST_CASE_SHEET_PROMPT = """
          - **General Nullability Tests (Low Priority)**: For up to 3 other important target columns that are not primary keys but are expected to be populated, generate a 'Null Check' test case.
        - **Do not generate test cases for other scenarios** like format checks or volume checks unless they are part of a specific transformation rule. This focus will help you stay under the 20-test-case limit.
 
-    4. **Example Structure for CSV Content (pure CSV, no markdown block):**
-       ```csv
-       "Test ID","Test Scenario","Model/Component Tested","Test Type","Source Columns","Target Column(s)","Expected Result","Derivation Rule/Condition","Test Data Considerations","Priority"
-       "assert_ons_postcode_is_unique","Verify uniqueness of postcode","ons","Uniqueness","","postcode","No duplicate postcodes","postcode is primary key","N/A","High"
-       "assert_ons_postcode_not_null","Verify postcode is not null","ons","Null Check","","postcode","No null postcodes","postcode is a required field","N/A","High"
-       "assert_ons_rural_in_transformation","Validate RURAL_IN transformation logic","ons","Transformation Logic","RU11NM","RURAL_IN","'U' for Urban, 'R' for Rural based on source","CASE WHEN RU11NM LIKE '%Urban%' THEN 'U' ...","NULLs in source","High"
-       "assert_ons_ru11ind_referential_integrity","Verify that all ru11ind values in the model exist in the source rural_urban table","ons","Referential Integrity","ru11ind","ru11ind","All ru11ind values are valid","JOIN on ru11ind","N/A","Medium"
-       "assert_ons_rural_in_accepted_values","Verify that RURAL_IN only contains 'U', 'R', or NULL","ons","Accepted Values","RU11NM","RURAL_IN","Column contains only 'U', 'R', or is NULL","CASE WHEN RU11NM LIKE '%Urban%' THEN 'U' ...","N/A","Medium"
-       ```
+    4. **Example Structure (pure JSON, no markdown block):**
+       [
+         {"test_id": "assert_ons_postcode_is_unique", "test_scenario": "Verify uniqueness of postcode", "model_component_tested": "ons", "test_type": "Uniqueness", "source_columns": "", "target_columns": "postcode", "expected_result": "No duplicate postcodes", "derivation_rule": "postcode is primary key", "test_data_considerations": "N/A", "priority": "High"},
+         {"test_id": "assert_ons_postcode_not_null", "test_scenario": "Verify postcode is not null", "model_component_tested": "ons", "test_type": "Null Check", "source_columns": "", "target_columns": "postcode", "expected_result": "No null postcodes", "derivation_rule": "postcode is a required field", "test_data_considerations": "N/A", "priority": "High"},
+         {"test_id": "assert_ons_rural_in_transformation", "test_scenario": "Validate RURAL_IN transformation logic", "model_component_tested": "ons", "test_type": "Transformation Logic", "source_columns": "RU11NM", "target_columns": "RURAL_IN", "expected_result": "'U' for Urban, 'R' for Rural based on source", "derivation_rule": "CASE WHEN RU11NM LIKE '%Urban%' THEN 'U' ...", "test_data_considerations": "NULLs in source", "priority": "High"},
+         {"test_id": "assert_ons_ru11ind_referential_integrity", "test_scenario": "Verify that all ru11ind values in the model exist in the source rural_urban table", "model_component_tested": "ons", "test_type": "Referential Integrity", "source_columns": "ru11ind", "target_columns": "ru11ind", "expected_result": "All ru11ind values are valid", "derivation_rule": "JOIN on ru11ind", "test_data_considerations": "N/A", "priority": "Medium"},
+         {"test_id": "assert_ons_rural_in_accepted_values", "test_scenario": "Verify that RURAL_IN only contains 'U', 'R', or NULL", "model_component_tested": "ons", "test_type": "Accepted Values", "source_columns": "RU11NM", "target_columns": "RURAL_IN", "expected_result": "Column contains only 'U', 'R', or is NULL", "derivation_rule": "CASE WHEN RU11NM LIKE '%Urban%' THEN 'U' ...", "test_data_considerations": "N/A", "priority": "Medium"}
+       ]
     """
-    
+
+DBT_TEST_CASE_SHEET_DERIVATION_SCOPE = """
+    **Scope for this request**: The standard checks (key 'Uniqueness' and 'Null Check', 'Referential Integrity' on join keys and 'Direct Mapping' equality for columns without a derivation rule) have already been generated from the STTM. The CSV below contains ONLY the rows that have a derivation rule. For each row generate exactly one 'Transformation Logic' test case and, where the rule yields a fixed set of values, one 'Accepted Values' test case. Do NOT generate any other test types. The 20 test case limit does not apply.
+"""
+
+DBT_TEST_CASE_SHEET_TARGET_SCOPE = """
+    **Scope for this request**: The standard checks (key 'Uniqueness' and 'Null Check', 'Referential Integrity' on join keys and 'Direct Mapping' equality for columns without a derivation rule) have already been generated from the STTM. Of the mapping above, consider ONLY the rows of these target columns, which have a derivation rule: {target_columns}. For each of them generate exactly one 'Transformation Logic' test case and, where the rule yields a fixed set of values, one 'Accepted Values' test case. Do NOT generate any other test types. The 20 test case limit does not apply.
+"""
+
+DBT_ARTIFACT_REPAIR_PROMPT = """
+    **Instructions for Repairing a Single dbt Artifact:**
+    1. **Purpose**: You are given ONE dbt file that failed, the structured dbt error for it, and only the mapping or test plan rows that relate to it. Fix the file so the error no longer occurs.
+    2. **Scope**:
+       - Change only what is needed to fix the reported error. Keep everything else (CTE names, aliases, column order, formatting, `ref()`/`source()` calls, config blocks) exactly as it is.
+       - Do NOT add, remove or rename output columns unless the error requires it.
+       - Use the provided rows as the source of truth for column names, tables and derivation rules.
+    3. **SQL Dialect**: All SQL MUST be valid Google BigQuery SQL. Tabular STTMs arrive with their transformation logic already converted; copy it as given. Convert only the rows listed under 'Unconverted Transformation Logic', and any other dialect found in image STTMs (e.g., `SUBSTRING(x FROM a FOR b)` to `SUBSTR(x, a, b)`, `POSITION(' ' IN x)` to `STRPOS(x, ' ')`).
+    4. **Output**: Return ONLY the complete, corrected content of the file. No markdown code fences, no explanations.
+"""
+
 AGENT_INSTRUCTIONS = '''
     You are a data engineer with expertise in dBT framework. 
     You are tasked with creating model files using sheet image snapshot/csv file as provided which contains source and target column mapping.
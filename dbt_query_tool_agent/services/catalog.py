@@ -0,0 +1,246 @@
+import difflib
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from dbt_query_tool_agent.config import CATALOG_PATH, CATALOG_TTL_SECONDS
+from dbt_query_tool_agent.services.sql_transpiler import find_logic_column
+from dbt_query_tool_agent.services.sttm import bare_column, find_column, split_join_key
+
+# 'project.dataset.table' or 'dataset.table', optionally backquoted.
+_TABLE_REFERENCE = re.compile(r"^`?(?:(?P<project>[\w\-]+)\.)?(?P<dataset>\w+)\.(?P<table>\w+)`?$")
+_IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+# "{{ source('dataset', 'table') }}" as written in a model.
+_SOURCE_CALL = re.compile(r"source\s*\(\s*['\"](?P<dataset>\w+)['\"]\s*,\s*['\"](?P<table>\w+)['\"]\s*\)")
+# Bytes BigQuery bills per value of the fixed-size types; STRING, BYTES, JSON,
+# ARRAY and STRUCT depend on the data.
+VALUE_BYTES = {
+    'INT64': 8, 'FLOAT64': 8, 'NUMERIC': 16, 'BIGNUMERIC': 32, 'BOOL': 1, 'DATE': 8,
+    'DATETIME': 8, 'TIME': 8, 'TIMESTAMP': 8, 'INTERVAL': 16,
+}
+_COLUMNS_QUERY = """
+    SELECT table_name, column_name, data_type
+    FROM `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMNS
+    WHERE table_name IN UNNEST(@tables)
+    ORDER BY table_name, ordinal_position
+"""
+
+
+@dataclass(frozen=True)
+class TableRef:
+    """A BigQuery table named in the STTM."""
+    project: str
+    dataset: str
+    table: str
+
+    def __str__(self) -> str:
+        return f"{self.dataset}.{self.table}"
+
+
+@dataclass(frozen=True)
+class CatalogColumn:
+    name: str
+    data_type: str
+
+
+def parse_table_ref(reference: str, default_project: str) -> Optional[TableRef]:
+    match = _TABLE_REFERENCE.match(reference.strip())
+    if not match:
+        return None
+    return TableRef(match.group('project') or default_project, match.group('dataset'), match.group('table'))
+
+
+class InformationSchemaBackend:
+    """Reads column lists from BigQuery, with one INFORMATION_SCHEMA query per dataset."""
+
+    def __init__(self):
+        self._client = None
+
+    def fetch(self, tables: List[TableRef]) -> Dict[TableRef, List[CatalogColumn]]:
+        from google.cloud import bigquery
+
+        if self._client is None:
+            self._client = bigquery.Client()
+        by_dataset: Dict[Tuple[str, str], Dict[str, TableRef]] = defaultdict(dict)
+        for table in tables:
+            by_dataset[(table.project, table.dataset)][table.table] = table
+        found: Dict[TableRef, List[CatalogColumn]] = {}
+        for (project, dataset), names in by_dataset.items():
+            job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter('tables', 'STRING', list(names))])
+            rows = self._client.query(_COLUMNS_QUERY.format(project=project, dataset=dataset), job_config=job_config).result()
+            for row in rows:
+                table = names.get(row['table_name'])
+                if table is not None:
+                    found.setdefault(table, []).append(CatalogColumn(row['column_name'], row['data_type']))
+        return found
+
+
+class JsonCatalogBackend:
+    """
+    Reads column lists from a local JSON file keyed by 'project.dataset.table'
+    or 'dataset.table', each mapping column names to data types.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, tables: List[TableRef]) -> Dict[TableRef, List[CatalogColumn]]:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            catalog = {key.lower(): columns for key, columns in json.load(f).items()}
+        found = {}
+        for table in tables:
+            columns = catalog.get(f"{table.project}.{table}".lower()) or catalog.get(str(table).lower())
+            if columns is not None:
+                found[table] = [CatalogColumn(name, str(data_type)) for name, data_type in columns.items()]
+        return found
+
+
+class SourceCatalog:
+    """
+    Column lists of source tables, cached per table for `ttl_seconds`. Tables
+    the backend does not know are cached as missing for the same time.
+    """
+
+    def __init__(self, backend, ttl_seconds: float = CATALOG_TTL_SECONDS):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._cache: Dict[TableRef, Tuple[float, Optional[List[CatalogColumn]]]] = {}
+        self._lock = threading.Lock()
+
+    def columns(self, tables: Iterable[TableRef]) -> Dict[TableRef, Optional[List[CatalogColumn]]]:
+        """Returns the columns of every table (None if it does not exist). Blocking."""
+        tables = list(dict.fromkeys(tables))
+        now = time.monotonic()
+        with self._lock:
+            stale = [table for table in tables if table not in self._cache or now - self._cache[table][0] > self.ttl_seconds]
+        if stale:
+            fetched = self.backend.fetch(stale)
+            with self._lock:
+                for table in stale:
+                    self._cache[table] = (now, fetched.get(table))
+        with self._lock:
+            return {table: self._cache[table][1] for table in tables}
+
+    def invalidate(self, table: Optional[TableRef] = None) -> None:
+        with self._lock:
+            if table is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(table, None)
+
+
+def _default_backend():
+    return JsonCatalogBackend(CATALOG_PATH) if CATALOG_PATH else InformationSchemaBackend()
+
+
+SOURCE_CATALOG = SourceCatalog(_default_backend())
+
+
+def _referenced_columns(sttm_df: pd.DataFrame, default_project: str) -> Dict[TableRef, Dict[str, str]]:
+    """Maps every table of the STTM to the columns read from it, with the STTM row each comes from."""
+    source_table = find_column(sttm_df, 'source table')
+    source_column = find_column(sttm_df, 'source column', 'source columns')
+    join_table = find_column(sttm_df, 'join table')
+    join_key = find_column(sttm_df, 'join key')
+    target_column = find_column(sttm_df, 'target column', 'target column(s)')
+
+    referenced: Dict[TableRef, Dict[str, str]] = defaultdict(dict)
+    for _, row in sttm_df.iterrows():
+        def cell(column):
+            return '' if column is None or pd.isna(row.get(column)) else str(row[column]).strip()
+
+        target = cell(target_column) or '?'
+        table = parse_table_ref(cell(source_table), default_project)
+        if table is not None and bare_column(cell(source_column)):
+            referenced[table].setdefault(bare_column(cell(source_column)), target)
+        joined = parse_table_ref(cell(join_table), default_project)
+        if joined is not None and cell(join_key):
+            model_side, joined_side = split_join_key(cell(join_key))
+            if joined_side:
+                referenced[joined].setdefault(joined_side, target)
+            if table is not None and model_side:
+                referenced[table].setdefault(model_side, target)
+    return referenced
+
+
+def ground_sttm(sttm_df: pd.DataFrame, catalog: SourceCatalog = SOURCE_CATALOG,
+                default_project: Optional[str] = None) -> Tuple[List[str], str]:
+    """
+    Checks the tables and columns the STTM reads against the catalog, before any
+    SQL is generated from it.
+
+    Returns:
+        The problems found (unknown tables or columns, with close matches), and a
+        prompt section listing the exact names and types of the columns the
+        STTM uses (referenced directly or in a derivation rule). Both are empty
+        when the catalog cannot be read.
+    """
+    default_project = default_project or os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT") or ''
+    referenced = _referenced_columns(sttm_df, default_project)
+    if not referenced:
+        return [], ''
+    try:
+        catalog_columns = catalog.columns(referenced)
+    except Exception as err:
+        print(f"Warning: could not read the source catalog; STTM references are not checked. Error: {err}")
+        return [], ''
+
+    logic_column = find_logic_column(sttm_df)
+    logic_words = set()
+    if logic_column is not None:
+        for value in sttm_df[logic_column].dropna():
+            logic_words.update(word.lower() for word in _IDENTIFIER.findall(str(value)))
+
+    issues, prompt_lines = [], []
+    for table, columns in referenced.items():
+        known = catalog_columns.get(table)
+        if known is None:
+            issues.append(f"Table {table} (read for {', '.join(sorted(set(columns.values())))}) was not found in {table.project}.")
+            continue
+        by_name = {column.name.lower(): column for column in known}
+        for name, target in columns.items():
+            if name.lower() not in by_name:
+                close = difflib.get_close_matches(name.lower(), list(by_name), n=1)
+                hint = f" Did you mean {by_name[close[0]].name}?" if close else ''
+                issues.append(f"Column {name} (read for {target}) does not exist in {table}.{hint}")
+        relevant = [column for column in known if column.name.lower() in {name.lower() for name in columns} | logic_words]
+        if relevant:
+            prompt_lines.append(f"- {table}: " + ", ".join(f"{column.name} {column.data_type}" for column in relevant))
+
+    prompt = ''
+    if prompt_lines:
+        prompt = ("\n**Source Columns (from the warehouse catalog)**: These are the exact names and types of the source columns "
+                  "this model uses. Do NOT reference any other column of these tables.\n" + "\n".join(prompt_lines))
+    return issues, prompt
+
+
+def source_column_bytes(catalog: SourceCatalog = SOURCE_CATALOG, default_project: Optional[str] = None):
+    """
+    Returns a `column_bytes` callable for `optimize_model_sql`: the bytes per
+    value of a column of a `{{ source(...) }}` table, from its catalog type, or
+    None when the table, the column or the size of its type is unknown. The
+    tables were usually just read by `ground_sttm`, so this hits the cache.
+    """
+    default_project = default_project or os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT") or ''
+
+    def column_bytes(table_sql: str, column_name: str) -> Optional[int]:
+        match = _SOURCE_CALL.search(table_sql)
+        if not match:
+            return None
+        table = TableRef(default_project, match.group('dataset'), match.group('table'))
+        try:
+            columns = catalog.columns([table]).get(table) or []
+        except Exception as err:
+            print(f"Warning: could not read the source catalog for {table}. Error: {err}")
+            return None
+        column = next((column for column in columns if column.name.lower() == column_name.lower()), None)
+        return VALUE_BYTES.get(column.data_type.upper()) if column else None
+
+    return column_bytes
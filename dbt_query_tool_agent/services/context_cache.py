@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from dbt_query_tool_agent.config import (
+    CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_MIN_TOKENS, CONTEXT_CACHE_TTL_SECONDS, ModelRoute, get_model_route,
+)
+from dbt_query_tool_agent.services import model_router
+from dbt_query_tool_agent.services.prompt_builder import PromptBuilder, estimate_tokens, project_sttm
+
+# Entries are recreated this long before they expire, so a call never reads an expired cache.
+EXPIRY_MARGIN_SECONDS = 60
+
+
+class VertexContextCacheBackend:
+    """Stores prefixes as Vertex AI cached contents; models read them by reference."""
+
+    def create(self, route: ModelRoute, parts: List[str], ttl_seconds: float):
+        if model_router.uses_model_factory():
+            # Test models read the parts themselves (see model_router.get_cached_model).
+            return list(parts)
+        from vertexai.caching import CachedContent
+
+        return CachedContent.create(model_name=route.model_name, contents=parts, ttl=timedelta(seconds=ttl_seconds))
+
+    def model(self, cached, task: str, response_schema: Optional[dict] = None):
+        return model_router.get_cached_model(cached, task, response_schema)
+
+
+class _PrefixedModel:
+    def __init__(self, model, prefix: List[str], backend: "InProcessContextCacheBackend"):
+        self._model = model
+        self._prefix = prefix
+        self._backend = backend
+
+    async def generate_content_async(self, contents, **kwargs):
+        self._backend.hits += 1
+        return await self._model.generate_content_async(self._prefix + list(contents), **kwargs)
+
+
+class InProcessContextCacheBackend:
+    """
+    Keeps prefixes in memory and prepends them to every request, for tests and
+    offline use. Models come from `model_router.get_model`, so fakes installed
+    with `set_model_factory` see the full prompt; `created` and `hits` count
+    cache writes and reads.
+    """
+
+    def __init__(self):
+        self.created = 0
+        self.hits = 0
+
+    def create(self, route: ModelRoute, parts: List[str], ttl_seconds: float):
+        self.created += 1
+        return list(parts)
+
+    def model(self, cached, task: str, response_schema: Optional[dict] = None):
+        return _PrefixedModel(model_router.get_model(task, response_schema), cached, self)
+
+
+class ContextCache:
+    """
+    Caches the long prompt prefix shared by several LLM calls (instructions and
+    the STTM of one upload), so it is sent and billed in full only once per
+    `ttl_seconds`. Entries are keyed by model name and prefix content: every
+    tool and repair iteration sending the same prefix to the same model reuses
+    one entry. Prefixes below `min_tokens` (the provider minimum) are sent as-is.
+    """
+
+    def __init__(self, backend, ttl_seconds: float = CONTEXT_CACHE_TTL_SECONDS,
+                 min_tokens: int = CONTEXT_CACHE_MIN_TOKENS, enabled: bool = CONTEXT_CACHE_ENABLED):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.enabled = enabled
+        self._entries: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        # Models the backend failed to cache for; their prompts are sent uncached.
+        self._unsupported_models = set()
+
+    def accepts(self, task: str, prefix: List[Any]) -> bool:
+        """Whether `prefix` would be served from the cache for `task`."""
+        return (
+            self.enabled and bool(prefix) and all(isinstance(part, str) for part in prefix)
+            and get_model_route(task).model_name not in self._unsupported_models
+            and sum(estimate_tokens(part) for part in prefix) >= self.min_tokens
+        )
+
+    async def _entry(self, route: ModelRoute, prefix: List[str]):
+        key = (route.model_name, hashlib.sha256("\x00".join(prefix).encode('utf-8')).hexdigest())
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            created_at, cached = self._entries.get(key, (None, None))
+            if created_at is None or time.monotonic() - created_at > self.ttl_seconds - EXPIRY_MARGIN_SECONDS:
+                cached = await asyncio.to_thread(self.backend.create, route, prefix, self.ttl_seconds)
+                self._entries[key] = (time.monotonic(), cached)
+                print(f"Context cache: stored a ~{sum(map(estimate_tokens, prefix))} token prefix for {route.model_name}.")
+            return cached
+
+    async def bind(self, task: str, parts: List[Any], prefix_length: int,
+                   response_schema: Optional[dict] = None) -> Tuple[Any, List[Any]]:
+        """
+        Returns the model for `task` and the parts to send to it. When the first
+        `prefix_length` parts can be cached, the model reads them from the cache
+        and only the remaining parts are returned; otherwise this is
+        `get_model(task, response_schema)` with all parts.
+        """
+        prefix = list(parts[:prefix_length])
+        if not self.accepts(task, prefix):
+            return model_router.get_model(task, response_schema), parts
+        route = get_model_route(task)
+        try:
+            cached = await self._entry(route, prefix)
+            return self.backend.model(cached, task, response_schema), list(parts[prefix_length:])
+        except Exception as err:
+            print(f"Warning: context caching is not available for {route.model_name}; prompts are sent in full. Error: {err}")
+            self._unsupported_models.add(route.model_name)
+            return model_router.get_model(task, response_schema), parts
+
+    def invalidate(self) -> None:
+        """Forgets every entry (they expire on the provider side) and retries unsupported models."""
+        self._entries.clear()
+        self._unsupported_models.clear()
+
+
+CONTEXT_CACHE = ContextCache(VertexContextCacheBackend())
+
+
+def set_context_cache_backend(backend) -> None:
+    """
+    Replaces the backend of CONTEXT_CACHE, e.g. with InProcessContextCacheBackend()
+    in tests; pass None to restore Vertex AI context caching.
+    """
+    CONTEXT_CACHE.backend = backend or VertexContextCacheBackend()
+    CONTEXT_CACHE.invalidate()
+
+
+def sttm_prefix(instructions: str, sttm_df: pd.DataFrame) -> List[str]:
+    """
+    The prompt prefix shared by the generators reading one STTM: the parsing
+    instructions and the mapping columns of a model (see STTM_PROJECTIONS),
+    shortened to the model SQL budget if needed. Building it in one place keeps
+    it byte-identical across tools, which is what makes it cacheable.
+    """
+    return PromptBuilder('model_sql', instructions).add_sttm(project_sttm(sttm_df, 'model')).parts
@@ -0,0 +1,106 @@
+import os
+import re
+from collections import Counter
+from typing import Dict, Optional
+
+import yaml
+
+from dbt_query_tool_agent.config import (
+    DBT_JOB_RETRIES, DBT_QUERY_PRIORITY, DBT_TIMEOUT_SECONDS, MAX_WAREHOUSE_CONCURRENCY,
+)
+
+# Project folders whose files decide how many nodes can run at once.
+DAG_FOLDERS = ('models', 'tests', 'snapshots')
+_REF = re.compile(r"\bref\(\s*['\"](\w+)['\"]\s*\)")
+_TESTS_KEYS = ('data_tests', 'tests')
+
+
+def read_project_files(project_dir: str) -> Dict[str, str]:
+    """Reads the SQL and YAML files of DAG_FOLDERS of a local dbt project, keyed by relative path."""
+    files = {}
+    for folder in DAG_FOLDERS:
+        for root, _, file_names in os.walk(os.path.join(project_dir, folder)):
+            for file_name in file_names:
+                if file_name.endswith(('.sql', '.yml', '.yaml')):
+                    path = os.path.join(root, file_name)
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        files[os.path.relpath(path, project_dir)] = f.read()
+    return files
+
+
+def _sql_nodes(files: Dict[str, str], folder: str) -> Dict[str, str]:
+    return {
+        os.path.splitext(os.path.basename(path))[0]: text
+        for path, text in files.items()
+        if path.replace(os.sep, '/').startswith(f"{folder}/") and path.endswith('.sql')
+    }
+
+
+def _model_width(files: Dict[str, str]) -> int:
+    """Largest number of models at the same depth of the ref() graph, i.e. runnable together."""
+    refs = {name: set(_REF.findall(text)) for name, text in _sql_nodes(files, 'models').items()}
+    depths: Dict[str, int] = {}
+
+    def depth(name: str, visiting: frozenset = frozenset()) -> int:
+        if name not in depths:
+            parents = [parent for parent in refs.get(name, ()) if parent in refs and parent not in visiting]
+            depths[name] = 1 + max((depth(parent, visiting | {name}) for parent in parents), default=0)
+        return depths[name]
+
+    return max(Counter(depth(name) for name in refs).values(), default=0)
+
+
+def _generic_test_count(files: Dict[str, str]) -> int:
+    count = 0
+    for path, text in files.items():
+        if not path.endswith(('.yml', '.yaml')):
+            continue
+        try:
+            schema = yaml.safe_load(text) or {}
+        except yaml.YAMLError:
+            continue
+        for model in (schema.get('models') or []) if isinstance(schema, dict) else []:
+            for node in [model] + list(model.get('columns') or []):
+                count += sum(len(node.get(key) or []) for key in _TESTS_KEYS)
+    return count
+
+
+def dag_width(files: Dict[str, str], dbt_command: str) -> int:
+    """
+    Estimates how many nodes `dbt_command` can execute in parallel: models per
+    ref() depth for 'run', snapshots for 'snapshot', and singular plus generic
+    tests for 'test' (once the models are built, tests do not depend on each other).
+    """
+    if dbt_command == 'run':
+        return _model_width(files)
+    if dbt_command == 'snapshot':
+        return len(_sql_nodes(files, 'snapshots'))
+    if dbt_command == 'test':
+        return len(_sql_nodes(files, 'tests')) + _generic_test_count(files)
+    return 0
+
+
+def recommend_threads(width: int, budget: Optional[int] = None) -> int:
+    """Threads for a DAG of `width` parallel nodes, within the warehouse concurrency budget."""
+    return max(1, min(width, budget or MAX_WAREHOUSE_CONCURRENCY))
+
+
+def apply_execution_policy(profiles_yml: str, threads: int) -> str:
+    """
+    Sets threads, job retries, priority and timeout on every output of a
+    generated profiles.yml, so they do not depend on what the LLM wrote.
+    Returns the content unchanged if it is not valid YAML.
+    """
+    try:
+        profiles = yaml.safe_load(profiles_yml)
+    except yaml.YAMLError:
+        return profiles_yml
+    if not isinstance(profiles, dict):
+        return profiles_yml
+    for profile in profiles.values():
+        outputs = profile.get('outputs') if isinstance(profile, dict) else None
+        for output in (outputs or {}).values():
+            if isinstance(output, dict):
+                output.update(threads=threads, job_retries=DBT_JOB_RETRIES, priority=DBT_QUERY_PRIORITY,
+                              timeout_seconds=DBT_TIMEOUT_SECONDS)
+    return yaml.safe_dump(profiles, sort_keys=False)
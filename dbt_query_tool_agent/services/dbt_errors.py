@@ -0,0 +1,89 @@
+import re
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+# dbt reports node failures as e.g.
+#   Database Error in test assert_ons_x (tests/assert_ons_x.sql)
+#     Syntax error: Expected ")" but got keyword FROM at [12:20]
+#     compiled code at target/run/...
+DBT_ERROR_HEADER = re.compile(
+    r"(?P<error_type>[A-Z][A-Za-z]*(?: [A-Z][A-Za-z]*)* Error) in (?P<node_type>\w+) (?P<node_name>[\w\.]+) \((?P<path>[^)]+)\)"
+)
+# BigQuery positions look like "at [12:20]".
+BIGQUERY_POSITION = re.compile(r"at \[(?P<line>\d+):(?P<column>\d+)\]")
+
+
+@dataclass
+class DbtError:
+    """A single node failure extracted from dbt output."""
+    error_type: str
+    message: str
+    node_type: Optional[str] = None
+    node_name: Optional[str] = None
+    path: Optional[str] = None
+    line: Optional[int] = None
+    column: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def to_prompt(self) -> str:
+        location = f" at line {self.line}, column {self.column}" if self.line else ""
+        node = f" in {self.node_type} '{self.node_name}' ({self.path})" if self.node_name else ""
+        return f"{self.error_type}{node}{location}:\n{self.message}"
+
+
+def _body_lines(lines: List[str], start: int) -> List[str]:
+    body = []
+    for line in lines[start:]:
+        if not line.strip() or DBT_ERROR_HEADER.search(line):
+            break
+        # The pointer to the compiled file is noise for repairs.
+        if line.strip().startswith('compiled code at'):
+            continue
+        body.append(line.strip())
+    return body
+
+
+def parse_dbt_errors(output: str) -> List[DbtError]:
+    """Extracts every `<Type> Error in <node> (<path>)` block from dbt output."""
+    lines = output.splitlines()
+    errors = []
+    for index, line in enumerate(lines):
+        header = DBT_ERROR_HEADER.search(line)
+        if not header:
+            continue
+        message = "\n".join(_body_lines(lines, index + 1))
+        position = BIGQUERY_POSITION.search(message)
+        errors.append(DbtError(
+            error_type=header.group('error_type'),
+            message=message,
+            node_type=header.group('node_type'),
+            node_name=header.group('node_name'),
+            path=header.group('path'),
+            line=int(position.group('line')) if position else None,
+            column=int(position.group('column')) if position else None,
+        ))
+    return errors
+
+
+def parse_dbt_error(output: str, file_path: Optional[str] = None) -> DbtError:
+    """
+    Returns the structured error for `file_path` (e.g. 'tests/assert_x.sql')
+    from dbt output. Falls back to the first error found, or to the raw text
+    when the output has no recognizable error header.
+    """
+    errors = parse_dbt_errors(output)
+    if file_path:
+        for error in errors:
+            if error.path and (file_path.endswith(error.path) or error.path.endswith(file_path)):
+                return error
+    if errors:
+        return errors[0]
+    position = BIGQUERY_POSITION.search(output)
+    return DbtError(
+        error_type='Error',
+        message=output.strip(),
+        line=int(position.group('line')) if position else None,
+        column=int(position.group('column')) if position else None,
+    )
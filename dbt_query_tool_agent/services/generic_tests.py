@@ -0,0 +1,141 @@
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+import yaml
+
+from dbt_query_tool_agent.services.test_consolidation import classify_test_type, parse_accepted_values, split_columns
+
+# Generic tests are declared under the model's columns in schema.yml and carry
+# the Test ID as their name, so `dbt test` reports them like singular tests.
+SCHEMA_YML_FILE = 'schema.yml'
+# 'data_tests' is the dbt >= 1.8 spelling of the column 'tests' property.
+TESTS_KEY = 'data_tests'
+_LEGACY_TESTS_KEY = 'tests'
+# 'project.dataset.table' or 'dataset.table', optionally backquoted.
+_QUALIFIED_TABLE = re.compile(r"`?(?:[\w\-]+\.)?(?P<dataset>\w+)\.(?P<table>\w+)`?")
+
+
+@dataclass(frozen=True)
+class GenericTest:
+    """One test plan row expressed as a dbt generic test on a model column."""
+    test_id: str
+    column: str
+    test_name: str  # not_null, unique, accepted_values or relationships
+    arguments: Dict = field(default_factory=dict)
+
+    def to_yaml(self) -> Dict:
+        return {self.test_name: {'name': self.test_id, **self.arguments}}
+
+
+def compile_generic_test(row: pd.Series) -> Optional[GenericTest]:
+    """
+    Compiles a single-column null, uniqueness, accepted-values or referential
+    integrity row of the test plan. Returns None for anything else, which is
+    left to singular test generation.
+    """
+    test_id = str(row.get('Test ID', ''))
+    columns = split_columns(row.get('Target Column(s)', ''))
+    if len(columns) != 1 or not re.match(r'^\w+$', test_id):
+        return None
+    column = columns[0]
+    kind = classify_test_type(row.get('Test Type', ''))
+    if kind in ('not_null', 'unique'):
+        return GenericTest(test_id, column, kind)
+    if kind == 'accepted_values':
+        values = parse_accepted_values(row.get('Expected Result', ''), row.get('Derivation Rule/Condition', ''))
+        return GenericTest(test_id, column, 'accepted_values', {'values': values}) if values else None
+    if 'referential' in str(row.get('Test Type', '')).lower():
+        # The parent must be named as a qualified table, e.g. 'JOIN project.dataset.table on key'.
+        parent = _QUALIFIED_TABLE.search(str(row.get('Derivation Rule/Condition', '')))
+        parent_columns = split_columns(row.get('Source Columns', ''))
+        if not parent or len(parent_columns) != 1:
+            return None
+        return GenericTest(test_id, column, 'relationships', {
+            'to': f"source('{parent.group('dataset')}', '{parent.group('table')}')",
+            'field': parent_columns[0],
+        })
+    return None
+
+
+def compile_generic_tests(test_plan_df: pd.DataFrame) -> List[GenericTest]:
+    """Compiles every row of the test plan that has a generic test equivalent."""
+    return [test for test in (compile_generic_test(row) for _, row in test_plan_df.iterrows()) if test]
+
+
+def _test_name(entry) -> Optional[str]:
+    if isinstance(entry, dict) and len(entry) == 1:
+        arguments = next(iter(entry.values()))
+        if isinstance(arguments, dict):
+            return arguments.get('name')
+    return None
+
+
+def merge_generic_tests(schema_yml: str, model_name: str, tests: Iterable[GenericTest], replaced_test_ids: Iterable[str] = ()) -> str:
+    """
+    Adds `tests` to the columns of `model_name` in a schema.yml document.
+
+    Existing tests named after one of `replaced_test_ids` (or one of `tests`) are
+    removed first, so regenerating a test plan neither duplicates tests nor
+    leaves generic tests behind for rows that became singular tests. A column
+    left with only its name by that removal is dropped; every other column is
+    kept as written.
+
+    Raises:
+        yaml.YAMLError: if `schema_yml` is not valid YAML.
+    """
+    tests = list(tests)
+    replaced = set(replaced_test_ids) | {test.test_id for test in tests}
+    tested_columns = {test.column.lower() for test in tests}
+    schema = yaml.safe_load(schema_yml) if schema_yml.strip() else {}
+    schema = schema or {}
+    schema.setdefault('version', 2)
+    models = schema.get('models') or []
+    schema['models'] = models
+
+    for model in models:
+        emptied = []  # Columns this merge removed every test from
+        for column in model.get('columns') or []:
+            removed = False
+            for key in (TESTS_KEY, _LEGACY_TESTS_KEY):
+                if column.get(key):
+                    kept = [entry for entry in column[key] if _test_name(entry) not in replaced]
+                    removed = removed or len(kept) < len(column[key])
+                    column[key] = kept
+                    if not column[key]:
+                        del column[key]
+            # A column getting its tests back below keeps its place.
+            if removed and set(column) == {'name'} and not (
+                model.get('name') == model_name and str(column.get('name', '')).lower() in tested_columns
+            ):
+                emptied.append(column)
+        if emptied:
+            # Columns that were only listed to carry the removed tests go as well.
+            model['columns'] = [column for column in model['columns'] if not any(column is entry for entry in emptied)]
+            if not model['columns']:
+                del model['columns']
+
+    if tests:
+        model = next((entry for entry in models if entry.get('name') == model_name), None)
+        if model is None:
+            model = {'name': model_name}
+            models.append(model)
+        columns = model.get('columns') or []
+        model['columns'] = columns
+        for test in tests:
+            column = next((entry for entry in columns if str(entry.get('name', '')).lower() == test.column.lower()), None)
+            if column is None:
+                column = {'name': test.column}
+                columns.append(column)
+            # Keep whichever spelling the column already uses.
+            key = _LEGACY_TESTS_KEY if _LEGACY_TESTS_KEY in column and TESTS_KEY not in column else TESTS_KEY
+            column[key] = (column.get(key) or []) + [test.to_yaml()]
+    return yaml.safe_dump(schema, sort_keys=False)
+
+
+def split_generic_tests(test_plan_df: pd.DataFrame) -> Tuple[List[GenericTest], pd.DataFrame]:
+    """Returns the generic tests of the test plan and the rows still needing singular tests."""
+    tests = compile_generic_tests(test_plan_df)
+    generic_ids = {test.test_id for test in tests}
+    return tests, test_plan_df[~test_plan_df['Test ID'].astype(str).isin(generic_ids)]
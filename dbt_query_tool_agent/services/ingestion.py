@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+from dbt_query_tool_agent.services.progress import report_progress
+from dbt_query_tool_agent.services.spreadsheet import xlsx_to_csv
+from dbt_query_tool_agent.services.sttm_image import extract_table
+from dbt_query_tool_agent.utils import blob_exists, read_blob_bytes, write_blob
+
+# Tables extracted from images are kept in the project folder as
+# {EXTRACTED_STTM_FOLDER}/{sha256 of the upload}.csv, since extraction needs an LLM call.
+# Images without an extractable table get an empty {sha256}{NO_TABLE_MARKER} instead,
+# so the call is not repeated for them either.
+EXTRACTED_STTM_FOLDER = 'extracted_sttm'
+NO_TABLE_MARKER = '.no_table'
+# Converted uploads kept in memory, most recently used first out of the eviction order.
+# None marks an upload that is sent as it is (no table could be extracted).
+MAX_CACHED_UPLOADS = 32
+
+_CONVERTED: "OrderedDict[Tuple[str, Optional[str]], Optional[bytes]]" = OrderedDict()
+_LOCKS: Dict[Tuple[str, Optional[str]], asyncio.Lock] = {}
+
+
+def upload_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def _remember(key: Tuple[str, Optional[str]], csv_bytes: Optional[bytes]) -> Optional[bytes]:
+    _CONVERTED[key] = csv_bytes
+    while len(_CONVERTED) > MAX_CACHED_UPLOADS:
+        evicted, _ = _CONVERTED.popitem(last=False)
+        _LOCKS.pop(evicted, None)
+    return csv_bytes
+
+
+async def _convert_workbook(bytes_content: bytes, sheet_name: Optional[str]) -> bytes:
+    csv_text, used_sheet, mapping_sheets = await asyncio.to_thread(xlsx_to_csv, bytes_content, sheet_name)
+    if sheet_name is None and len(mapping_sheets) > 1:
+        report_progress(f"The workbook has {len(mapping_sheets)} mapping sheets ({', '.join(mapping_sheets)}); "
+                        f"using '{used_sheet}'. Pass sheet_name to generate from another one.")
+    return csv_text.encode('utf-8')
+
+
+async def _convert_image(bucket, dbt_project_name: str, bytes_content: bytes, digest: str) -> Optional[bytes]:
+    blob = bucket.blob(f"{dbt_project_name}/{EXTRACTED_STTM_FOLDER}/{digest}.csv")
+    marker_blob = bucket.blob(f"{dbt_project_name}/{EXTRACTED_STTM_FOLDER}/{digest}{NO_TABLE_MARKER}")
+    if await blob_exists(blob):
+        return await read_blob_bytes(blob)
+    if await blob_exists(marker_blob):
+        return None
+    try:
+        report_progress("Extracting the mapping table from the uploaded image")
+        csv_text = await extract_table(bytes_content)
+    except Image.UnidentifiedImageError:
+        return None
+    if csv_text is None:
+        marker_blob.metadata = {'author': 'dbt_adk_agent', 'dbt_artifact_type': 'extracted_sttm'}
+        await write_blob(marker_blob, '')
+        return None
+    blob.metadata = {'author': 'dbt_adk_agent', 'dbt_artifact_type': 'extracted_sttm'}
+    await write_blob(blob, csv_text, content_type='text/csv')
+    return csv_text.encode('utf-8')
+
+
+async def ingest_sttm(bucket, dbt_project_name: str, bytes_content: bytes, file_type: str,
+                      sheet_name: Optional[str] = None) -> Tuple[bytes, str]:
+    """
+    Returns the content and file type the tools should read for an upload: CSV
+    for a workbook (one sheet, see spreadsheet.xlsx_to_csv) or an image (its
+    table extracted by the LLM), the upload itself for a CSV. Each upload is
+    converted once per content (and sheet) and kept in memory; image extractions
+    are also kept in `{dbt_project_name}/extracted_sttm/`, so later sessions
+    reuse them. Images whose table cannot be extracted, and files that are not
+    images, are returned unchanged; that outcome is cached the same way, so the
+    extraction is attempted once per image.
+
+    Raises:
+        ValueError: If `sheet_name` is not a sheet of the workbook.
+        ImportError: If openpyxl is not installed and the upload is a workbook.
+    """
+    if file_type == '.csv':
+        return bytes_content, file_type
+    key = (upload_digest(bytes_content), sheet_name if file_type == '.xlsx' else None)
+    async with _LOCKS.setdefault(key, asyncio.Lock()):
+        if key in _CONVERTED:
+            _CONVERTED.move_to_end(key)
+        elif file_type == '.xlsx':
+            _remember(key, await _convert_workbook(bytes_content, sheet_name))
+        else:
+            _remember(key, await _convert_image(bucket, dbt_project_name, bytes_content, key[0]))
+        csv_bytes = _CONVERTED[key]
+        return (bytes_content, file_type) if csv_bytes is None else (csv_bytes, '.csv')
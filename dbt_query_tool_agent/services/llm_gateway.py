@@ -0,0 +1,314 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+# Errors worth retrying: quota spikes (429), transient backend failures (500/503)
+# and server-side deadlines. Anything else (bad request, permission denied, ...)
+# fails fast so the agent's error path sees the real cause.
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    asyncio.TimeoutError,
+)
+
+
+def _env_float(name: str, default: Optional[float]) -> Optional[float]:
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    return float(value)
+
+
+class TokenBucket:
+    """
+    A simple asyncio token bucket. `rate` tokens are added per second up to
+    `capacity`; `acquire()` waits until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while not self.try_acquire():
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class LlmGateway:
+    """
+    Shared entry point for every `generate_content` call made by the tools.
+
+    It applies, in order:
+    1. A token-bucket rate limit (requests per minute across all sessions).
+    2. A semaphore capping the number of in-flight requests.
+    3. A per-call deadline, with jittered exponential backoff on retryable errors.
+    4. Optionally, a hedged duplicate request when the first one is slow.
+
+    `metrics()` exposes queue depth, in-flight count and wait-time statistics.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: float = 60,
+        max_retries: int = 4,
+        base_backoff_seconds: float = 1.0,
+        max_backoff_seconds: float = 30.0,
+        timeout_seconds: Optional[float] = 300,
+        hedge_after_seconds: Optional[float] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.hedge_after_seconds = hedge_after_seconds
+        self._bucket = TokenBucket(rate=requests_per_minute / 60.0, capacity=max(1.0, max_concurrency))
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queue_depth = 0
+        self._in_flight = 0
+        self._wait_times = deque(maxlen=500)
+        self._counters = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'timeouts': 0, 'failures': 0}
+
+    @classmethod
+    def from_env(cls) -> "LlmGateway":
+        """Builds a gateway from `DBT_AGENT_LLM_*` environment variables."""
+        return cls(
+            max_concurrency=int(_env_float("DBT_AGENT_LLM_MAX_CONCURRENCY", 8)),
+            requests_per_minute=_env_float("DBT_AGENT_LLM_REQUESTS_PER_MINUTE", 60),
+            max_retries=int(_env_float("DBT_AGENT_LLM_MAX_RETRIES", 4)),
+            base_backoff_seconds=_env_float("DBT_AGENT_LLM_BACKOFF_SECONDS", 1.0),
+            max_backoff_seconds=_env_float("DBT_AGENT_LLM_MAX_BACKOFF_SECONDS", 30.0),
+            timeout_seconds=_env_float("DBT_AGENT_LLM_TIMEOUT_SECONDS", 300),
+            hedge_after_seconds=_env_float("DBT_AGENT_LLM_HEDGE_AFTER_SECONDS", None),
+        )
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": a uniform delay between 0 and the capped exponential bound.
+        bound = min(self.max_backoff_seconds, self.base_backoff_seconds * (2 ** attempt))
+        return random.uniform(0, bound)
+
+    async def _call_once(self, model, contents, timeout: Optional[float], kwargs: dict):
+        return await asyncio.wait_for(model.generate_content_async(contents, **kwargs), timeout=timeout)
+
+    async def _call_hedged(self, model, contents, timeout: Optional[float], hedge_after: float, kwargs: dict):
+        primary = asyncio.ensure_future(self._call_once(model, contents, timeout, kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        # Only hedge when a concurrency slot is free and the rate limit has a spare
+        # token, so hedging never exceeds the in-flight cap or the quota.
+        if done or self._semaphore.locked() or not self._bucket.try_acquire():
+            return await primary
+
+        # The slot is free, so this does not wait.
+        await self._semaphore.acquire()
+        self._in_flight += 1
+
+        async def call_hedge():
+            try:
+                return await self._call_once(model, contents, timeout, kwargs)
+            finally:
+                self._in_flight -= 1
+                self._semaphore.release()
+
+        self._counters['hedges'] += 1
+        hedge = asyncio.ensure_future(call_hedge())
+        pending = {primary, hedge}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._counters['hedge_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate_content(
+        self,
+        model,
+        contents: Any,
+        timeout: Optional[float] = None,
+        hedge_after: Optional[float] = None,
+        **kwargs,
+    ):
+        """
+        Calls `model.generate_content_async(contents, **kwargs)` under the
+        gateway's rate limit, concurrency cap, deadline and retry policy.
+
+        Args:
+            model: A `GenerativeModel` (or any object exposing `generate_content_async`).
+            contents: The prompt parts to send.
+            timeout (Optional[float]): Per-attempt deadline in seconds. Defaults to the gateway setting.
+            hedge_after (Optional[float]): Send a duplicate request if the first has not
+                answered after this many seconds. Defaults to the gateway setting.
+
+        Returns:
+            The model response from whichever attempt succeeded first.
+        """
+        timeout = timeout if timeout is not None else self.timeout_seconds
+        hedge_after = hedge_after if hedge_after is not None else self.hedge_after_seconds
+        self._counters['calls'] += 1
+
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            self._queue_depth += 1
+            try:
+                await self._bucket.acquire()
+                await self._semaphore.acquire()
+            finally:
+                self._queue_depth -= 1
+            self._wait_times.append(time.monotonic() - queued_at)
+
+            self._in_flight += 1
+            try:
+                if hedge_after:
+                    return await self._call_hedged(model, contents, timeout, hedge_after, kwargs)
+                return await self._call_once(model, contents, timeout, kwargs)
+            except RETRYABLE_EXCEPTIONS as err:
+                if isinstance(err, asyncio.TimeoutError):
+                    self._counters['timeouts'] += 1
+                if attempt >= self.max_retries:
+                    self._counters['failures'] += 1
+                    raise
+                delay = self._backoff(attempt)
+                print(f"LLM call failed with {type(err).__name__}; retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            except Exception:
+                self._counters['failures'] += 1
+                raise
+            finally:
+                self._in_flight -= 1
+                self._semaphore.release()
+
+            # Back off outside the semaphore so waiting retries do not hold a slot.
+            self._counters['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def stream_content(
+        self,
+        model,
+        contents: Any,
+        timeout: Optional[float] = None,
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """
+        Streams the text of `model.generate_content_async(contents, stream=True)`
+        chunk by chunk under the same rate limit and concurrency cap.
+
+        Retries only happen before the first chunk arrives; once text has been
+        yielded a failure is raised to the caller, which may already have acted
+        on the partial output. `timeout` bounds the wait for each chunk.
+        Hedging is not applied to streams.
+        """
+        timeout = timeout if timeout is not None else self.timeout_seconds
+        self._counters['calls'] += 1
+
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            self._queue_depth += 1
+            try:
+                await self._bucket.acquire()
+                await self._semaphore.acquire()
+            finally:
+                self._queue_depth -= 1
+            self._wait_times.append(time.monotonic() - queued_at)
+
+            self._in_flight += 1
+            started = False
+            try:
+                stream = await asyncio.wait_for(model.generate_content_async(contents, stream=True, **kwargs), timeout=timeout)
+                iterator = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+                    except StopAsyncIteration:
+                        return
+                    started = True
+                    # Chunks carrying only safety/usage metadata have no text part.
+                    try:
+                        text = chunk.text
+                    except (ValueError, AttributeError):
+                        continue
+                    if text:
+                        yield text
+            except RETRYABLE_EXCEPTIONS as err:
+                if isinstance(err, asyncio.TimeoutError):
+                    self._counters['timeouts'] += 1
+                if started or attempt >= self.max_retries:
+                    self._counters['failures'] += 1
+                    raise
+                delay = self._backoff(attempt)
+                print(f"LLM stream failed with {type(err).__name__}; retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            except Exception:
+                self._counters['failures'] += 1
+                raise
+            finally:
+                self._in_flight -= 1
+                self._semaphore.release()
+
+            self._counters['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def metrics(self) -> dict:
+        """Returns a snapshot of queue depth, in-flight requests and wait times."""
+        waits = sorted(self._wait_times)
+        return {
+            'queue_depth': self._queue_depth,
+            'in_flight': self._in_flight,
+            'max_concurrency': self.max_concurrency,
+            'wait_seconds_avg': (sum(waits) / len(waits)) if waits else 0.0,
+            'wait_seconds_p95': waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            'wait_seconds_max': waits[-1] if waits else 0.0,
+            **self._counters,
+        }
+
+
+# Process-wide gateway shared by all tools and sessions.
+LLM_GATEWAY = LlmGateway.from_env()
+
+
+async def generate_content(model, contents: Any, **kwargs):
+    """Convenience wrapper around `LLM_GATEWAY.generate_content`."""
+    return await LLM_GATEWAY.generate_content(model, contents, **kwargs)
+
+
+def stream_content(model, contents: Any, **kwargs) -> AsyncIterator[str]:
+    """Convenience wrapper around `LLM_GATEWAY.stream_content`."""
+    return LLM_GATEWAY.stream_content(model, contents, **kwargs)
+
+
+def get_llm_gateway_metrics() -> dict:
+    """Returns the shared gateway's current metrics."""
+    return LLM_GATEWAY.metrics()
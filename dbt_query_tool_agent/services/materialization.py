@@ -0,0 +1,137 @@
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from dbt_query_tool_agent.services.sttm import ColumnMapping, exposed_join_keys, find_key_columns, parse_mappings
+
+MATERIALIZATIONS = ('view', 'table', 'incremental')
+# BigQuery accepts at most four clustering columns.
+MAX_CLUSTER_COLUMNS = 4
+_DATE_TYPE = re.compile(r'^\s*(date|datetime|timestamp)\b', re.IGNORECASE)
+_DATE_NAME = re.compile(r'date|(?:^|_)(?:dt|day|ts|timestamp|time|at)$', re.IGNORECASE)
+# Columns that track when a row last changed make the best incremental filter.
+_CHANGE_NAME = re.compile(r'updat|modif|load|extract|insert|ingest|change', re.IGNORECASE)
+# Matches a config block the LLM wrote despite being told not to.
+_CONFIG_BLOCK = re.compile(r"\{\{\s*config\s*\(.*?\)\s*\}\}\s*", re.DOTALL)
+
+
+@dataclass(frozen=True)
+class MaterializationConfig:
+    """The dbt config of a generated model, derived from its STTM."""
+    materialized: str
+    unique_key: List[str] = field(default_factory=list)
+    partition_by: Optional[Dict[str, str]] = None
+    cluster_by: List[str] = field(default_factory=list)
+    incremental_source_column: str = ''  # Column of the primary source table (T1) filtered on incremental runs
+    incremental_target_column: str = ''  # The model column it is loaded into
+    note: str = ''
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in asdict(self).items() if value}
+
+    def config_block(self) -> str:
+        """Renders the `{{ config(...) }}` block placed at the top of the model."""
+        settings = [f"materialized='{self.materialized}'"]
+        if self.materialized == 'incremental':
+            unique_key = self.unique_key[0] if len(self.unique_key) == 1 else self.unique_key
+            settings += [f"unique_key={unique_key!r}", "incremental_strategy='merge'", "on_schema_change='append_new_columns'"]
+        if self.partition_by:
+            settings.append(f"partition_by={self.partition_by!r}")
+        if self.cluster_by:
+            settings.append(f"cluster_by={self.cluster_by!r}")
+        return "{{ config(\n    " + ",\n    ".join(settings) + "\n) }}\n\n"
+
+    def prompt_instructions(self) -> str:
+        """Tells the model SQL prompt what the config block expects from the query."""
+        instructions = "\n**Materialization**: A `{{ config(...) }}` block is added to the model for you. Do NOT write a config block yourself."
+        if self.materialized == 'incremental':
+            instructions += (
+                "\n**Incremental Filter (MANDATORY)**: The model is incremental. At the end of the `source_data` CTE, after all joins, add exactly:\n"
+                "{% if is_incremental() %}\n"
+                f"where T1.{self.incremental_source_column} >= (select max({self.incremental_target_column}) from {{{{ this }}}})\n"
+                "{% endif %}\n"
+                "If the CTE already has a WHERE clause, use `and` instead of `where`. Do not filter any other table."
+            )
+        return instructions
+
+
+def _date_type(mapping: ColumnMapping) -> Optional[str]:
+    match = _DATE_TYPE.match(mapping.data_type)
+    return match.group(1).lower() if match else None
+
+
+def _incremental_column(mappings: List[ColumnMapping], partition_column: Optional[str]) -> Optional[ColumnMapping]:
+    """
+    Picks a date-like column copied as-is from the primary source table, so the
+    filter can be applied to T1 before any join.
+    """
+    primary_table = mappings[0].source_table.lower()
+    candidates = [
+        mapping for mapping in mappings
+        if mapping.direct and mapping.source and not mapping.join_table
+        and mapping.source_table.lower() == primary_table
+        and (_date_type(mapping) or (not mapping.data_type and _DATE_NAME.search(mapping.target)))
+    ]
+    ranked = (
+        [mapping for mapping in candidates if _CHANGE_NAME.search(mapping.target)]
+        + [mapping for mapping in candidates if mapping.target == partition_column]
+        + candidates
+    )
+    return ranked[0] if ranked else None
+
+
+def derive_materialization(sttm_df: Optional[pd.DataFrame], materialized: str) -> MaterializationConfig:
+    """
+    Derives the config of a 'table' or 'incremental' model from its STTM:
+
+    - `partition_by`: the first target column declared as DATE, DATETIME or
+      TIMESTAMP in a data type column (names alone are not trusted; a string
+      column cannot be partitioned on).
+    - `cluster_by`: the model key and the join keys the model exposes.
+    - For incremental models, `unique_key` (a flagged or key-like column) and a
+      date-like column of the primary source table to filter new rows on.
+      Without both, the model is built as a table instead.
+    """
+    if materialized not in ('table', 'incremental'):
+        return MaterializationConfig(materialized)
+    mappings = parse_mappings(sttm_df) if sttm_df is not None else []
+    if not mappings:
+        note = "No tabular STTM to derive keys from." if materialized == 'incremental' else ''
+        return MaterializationConfig('table', note=note)
+
+    partition_column = next((mapping for mapping in mappings if _date_type(mapping)), None)
+    partition_by = None
+    if partition_column is not None:
+        partition_by = {'field': partition_column.target, 'data_type': _date_type(partition_column)}
+        if partition_by['data_type'] != 'date':
+            partition_by['granularity'] = 'day'
+
+    key_columns, _ = find_key_columns(sttm_df, mappings, allow_guess=False)
+    cluster_by = list(dict.fromkeys(key_columns + [exposed.target for exposed, _ in exposed_join_keys(mappings)]))[:MAX_CLUSTER_COLUMNS]
+
+    if materialized == 'table':
+        return MaterializationConfig('table', partition_by=partition_by, cluster_by=cluster_by)
+
+    incremental_column = _incremental_column(mappings, partition_column.target if partition_column else None)
+    missing = [
+        description for description, value in (("key column", key_columns), ("date column of the primary source table", incremental_column))
+        if not value
+    ]
+    if missing:
+        return MaterializationConfig(
+            'table', partition_by=partition_by, cluster_by=cluster_by,
+            note=f"Built as a table: the STTM has no {' or '.join(missing)} to run incrementally on."
+        )
+    return MaterializationConfig(
+        'incremental', unique_key=key_columns, partition_by=partition_by, cluster_by=cluster_by,
+        incremental_source_column=incremental_column.source, incremental_target_column=incremental_column.target,
+    )
+
+
+def apply_config_block(sql: str, config: MaterializationConfig) -> str:
+    """Replaces any config block in the generated SQL with the derived one."""
+    if config.materialized == 'view':
+        return sql
+    return config.config_block() + _CONFIG_BLOCK.sub('', sql, count=1).lstrip()
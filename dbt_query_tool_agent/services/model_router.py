@@ -0,0 +1,89 @@
+from typing import Any, Callable, List, Optional
+
+from vertexai.generative_models import GenerativeModel, GenerationConfig
+
+from dbt_query_tool_agent.config import ModelRoute, get_model_route
+
+ModelFactory = Callable[[ModelRoute, Optional[dict]], Any]
+
+_model_factory: Optional[ModelFactory] = None
+_thinking_config_supported = True
+
+
+def _generation_config(route: ModelRoute, response_schema: Optional[dict] = None) -> Optional[GenerationConfig]:
+    global _thinking_config_supported
+    config = {}
+    if response_schema is not None:
+        config['response_mime_type'] = 'application/json'
+        config['response_schema'] = response_schema
+    if route.max_output_tokens is not None:
+        config['max_output_tokens'] = route.max_output_tokens
+    if route.temperature is not None:
+        config['temperature'] = route.temperature
+    if route.thinking_budget is not None and _thinking_config_supported:
+        try:
+            return GenerationConfig.from_dict({**config, 'thinking_config': {'thinking_budget': route.thinking_budget}})
+        except Exception as err:
+            # Older SDK releases do not know about thinking_config; fall back to
+            # the remaining settings rather than failing the tool call.
+            print(f"Warning: thinking_budget is not supported by this Vertex AI SDK and will be ignored. Error: {err}")
+            _thinking_config_supported = False
+    return GenerationConfig(**config) if config else None
+
+
+def _default_model_factory(route: ModelRoute, response_schema: Optional[dict] = None) -> GenerativeModel:
+    return GenerativeModel(route.model_name, generation_config=_generation_config(route, response_schema))
+
+
+class _PrefixedModel:
+    """A factory model standing in for a cached-content model: the cached parts are sent ahead of every prompt."""
+
+    def __init__(self, model, prefix: List[Any]):
+        self._model = model
+        self._prefix = prefix
+
+    async def generate_content_async(self, contents, **kwargs):
+        return await self._model.generate_content_async(self._prefix + list(contents), **kwargs)
+
+
+def set_model_factory(factory: Optional[ModelFactory]) -> None:
+    """
+    Replaces how models are built from a `ModelRoute` (and an optional JSON
+    response schema). Tests can pass a factory returning a local fake exposing
+    `generate_content_async`; pass None to restore the Vertex AI factory.
+    While a factory is installed, cached-content models come from it too: no
+    Vertex AI cache is created and the cached parts are prepended to each prompt.
+    """
+    global _model_factory
+    _model_factory = factory
+
+
+def get_model(task: str, response_schema: Optional[dict] = None):
+    """
+    Returns a generative model configured for `task` (see config.MODEL_ROUTES),
+    e.g. get_model('dataset_inference') or get_model('model_sql').
+
+    When `response_schema` is given, the model is asked for JSON output
+    constrained to that schema.
+    """
+    route = get_model_route(task)
+    factory = _model_factory or _default_model_factory
+    return factory(route, response_schema)
+
+
+def uses_model_factory() -> bool:
+    """Whether a factory installed with `set_model_factory` builds the models."""
+    return _model_factory is not None
+
+
+def get_cached_model(cached_content, task: str, response_schema: Optional[dict] = None):
+    """
+    Like `get_model`, for a model whose prompts start with a Vertex AI cached
+    content (see services/context_cache.py). With a model factory installed,
+    `cached_content` is the list of cached parts.
+    """
+    if _model_factory is not None:
+        return _PrefixedModel(get_model(task, response_schema), list(cached_content))
+    return GenerativeModel.from_cached_content(
+        cached_content=cached_content, generation_config=_generation_config(get_model_route(task), response_schema)
+    )
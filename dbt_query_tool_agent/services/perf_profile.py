@@ -0,0 +1,96 @@
+import json
+from datetime import datetime, timezone
+from typing import List, Optional
+
+# Profiles of successful runs are kept in GCS under {project}/perf/, one file
+# per run plus the latest one per command, which the next run compares against.
+PERF_FOLDER = 'perf'
+PROFILE_TOP_N = 10
+# A node counts as regressed when its time or bytes billed grew by this factor.
+REGRESSION_RATIO = 1.2
+# Below these, differences are noise (BigQuery bills at least 10 MB per query).
+_MIN_REGRESSION_SECONDS = 1.0
+_MIN_REGRESSION_BYTES = 10 * 1024 * 1024
+_ADAPTER_FIELDS = ('bytes_processed', 'bytes_billed', 'slot_ms', 'rows_affected')
+
+
+def node_profile(node_result) -> dict:
+    """Timing and warehouse cost of one node, from its run result and adapter response."""
+    adapter_response = getattr(node_result, 'adapter_response', None) or {}
+    node = getattr(node_result, 'node', None)
+    return {
+        'node': getattr(node, 'name', ''),
+        'resource_type': str(getattr(node, 'resource_type', '')),
+        'materialized': getattr(getattr(node, 'config', None), 'materialized', ''),
+        'status': str(getattr(node_result, 'status', '')),
+        'execution_time': round(getattr(node_result, 'execution_time', None) or 0.0, 3),
+        **{name: adapter_response.get(name) for name in _ADAPTER_FIELDS},
+        'job_id': adapter_response.get('job_id'),
+    }
+
+
+def _top(nodes: List[dict], metric: str) -> List[dict]:
+    ranked = sorted((node for node in nodes if node.get(metric)), key=lambda node: node[metric], reverse=True)
+    return [{'node': node['node'], metric: node[metric]} for node in ranked[:PROFILE_TOP_N]]
+
+
+def build_profile(run_results, dbt_command: str) -> dict:
+    """Builds the per-node profile of one dbt invocation, with totals and rankings."""
+    nodes = [node_profile(res) for res in (getattr(run_results, 'results', None) or [])]
+    totals = {'execution_time': round(sum(node['execution_time'] for node in nodes), 3)}
+    for name in _ADAPTER_FIELDS:
+        totals[name] = sum(node[name] or 0 for node in nodes)
+    return {
+        'command': dbt_command,
+        'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'totals': totals,
+        'slowest': _top(nodes, 'execution_time'),
+        'most_expensive': _top(nodes, 'bytes_billed'),
+        'nodes': nodes,
+    }
+
+
+def _grew(before: Optional[float], after: Optional[float], minimum: float) -> bool:
+    return bool(before and after) and after >= before * REGRESSION_RATIO and after - before >= minimum
+
+
+def find_regressions(previous: dict, current: dict) -> List[dict]:
+    """Lists the nodes that got slower or more expensive than in the previous profile."""
+    before_by_node = {node['node']: node for node in previous.get('nodes', [])}
+    regressions = []
+    for node in current.get('nodes', []):
+        before = before_by_node.get(node['node'])
+        if before is None:
+            continue
+        changes = {
+            metric: {'before': before.get(metric), 'after': node.get(metric)}
+            for metric, minimum in (('execution_time', _MIN_REGRESSION_SECONDS), ('bytes_billed', _MIN_REGRESSION_BYTES))
+            if _grew(before.get(metric), node.get(metric), minimum)
+        }
+        if changes:
+            regressions.append({'node': node['node'], **changes})
+    return regressions
+
+
+def save_profile(bucket, project_name: str, profile: dict) -> str:
+    """
+    Writes the profile to {project}/perf/ and compares it with the latest one of
+    the same command, adding `previous_profile` and `regressions` to it.
+    Blocking; returns the blob name of the per-run file.
+    """
+    latest_blob = bucket.blob(f"{project_name}/{PERF_FOLDER}/latest_{profile['command']}.json")
+    if latest_blob.exists():
+        try:
+            previous = json.loads(latest_blob.download_as_bytes())
+            profile['previous_profile'] = previous.get('profile_path', '')
+            profile['regressions'] = find_regressions(previous, profile)
+        except ValueError:
+            print(f"Warning: ignoring unreadable performance profile {latest_blob.name}")
+
+    timestamp = profile['generated_at'].replace(':', '').replace('-', '').replace('+0000', 'Z')
+    blob_name = f"{project_name}/{PERF_FOLDER}/{timestamp}_{profile['command']}.json"
+    profile['profile_path'] = blob_name
+    content = json.dumps(profile, indent=2, default=str)
+    bucket.blob(blob_name).upload_from_string(content, content_type='application/json')
+    latest_blob.upload_from_string(content, content_type='application/json')
+    return blob_name
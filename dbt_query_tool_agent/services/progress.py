@@ -0,0 +1,69 @@
+import asyncio
+import contextvars
+from typing import Any, AsyncIterator, Callable, Optional, Tuple
+
+# The sink for progress messages of the agent turn currently being processed.
+# It is a context variable so that concurrent Gradio sessions each receive only
+# their own tool progress; tools (and worker threads started with
+# asyncio.to_thread, which copy the context) just call report_progress().
+PROGRESS_SINK: contextvars.ContextVar[Optional[Callable[[str], None]]] = contextvars.ContextVar(
+    "dbt_agent_progress_sink", default=None
+)
+
+
+def report_progress(message: str) -> None:
+    """
+    Publishes a short progress message (e.g. "Uploaded tests/assert_x.sql")
+    to the UI of the current session. A no-op when nothing is listening.
+    """
+    sink = PROGRESS_SINK.get()
+    if sink is not None:
+        sink(message)
+    else:
+        print(message)
+
+
+async def iterate_with_progress(events: AsyncIterator[Any]) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Drains `events` (e.g. `runner.run_async(...)`) in a background task with a
+    progress sink installed and yields, in arrival order:
+      - ('event', event) for every item produced by `events`
+      - ('progress', message) for every report_progress() call made meanwhile
+
+    This lets the UI show progress from inside a long-running tool call, which
+    otherwise produces no agent events until the tool returns.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def sink(message: str) -> None:
+        # call_soon_threadsafe makes the sink usable from worker threads too.
+        loop.call_soon_threadsafe(queue.put_nowait, ('progress', message))
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(('event', event))
+        except Exception as err:
+            await queue.put(('error', err))
+        finally:
+            await queue.put(('done', None))
+
+    token = PROGRESS_SINK.set(sink)
+    try:
+        # The task copies the current context, so the sink is visible to tools.
+        pump_task = asyncio.create_task(pump())
+    finally:
+        PROGRESS_SINK.reset(token)
+
+    try:
+        while True:
+            kind, payload = await queue.get()
+            if kind == 'done':
+                break
+            if kind == 'error':
+                raise payload
+            yield kind, payload
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
@@ -0,0 +1,146 @@
+import math
+from typing import Any, List, Optional, Union
+
+import pandas as pd
+
+from dbt_query_tool_agent.config import get_model_route
+from dbt_query_tool_agent.services.progress import report_progress
+from dbt_query_tool_agent.services.sql_transpiler import TRANSFORMATION_LOGIC_COLUMNS, find_logic_column
+from dbt_query_tool_agent.services.sttm import DATA_TYPE_COLUMNS, KEY_FLAG_COLUMNS, find_column
+
+# Rough size of text prompts; close enough for Gemini on CSV-like content.
+CHARS_PER_TOKEN = 4
+# Gemini bills an image per 768x768 tile.
+IMAGE_TILE_PIXELS = 768
+IMAGE_TILE_TOKENS = 258
+# Cells longer than this are cut when a mapping must be shrunk to fit the budget
+# (never in the transformation logic column).
+MAX_CELL_CHARS = 400
+
+# The STTM columns each artifact needs; each entry lists the accepted spellings of one column.
+_TABLE_FIELDS = (('source table',), ('join table',), ('target table', 'target table name'))
+_MAPPING_FIELDS = _TABLE_FIELDS + (
+    ('source column', 'source columns'),
+    ('target column', 'target column(s)'),
+    ('join key',),
+    KEY_FLAG_COLUMNS,
+    DATA_TYPE_COLUMNS,
+    tuple(column.lower() for column in TRANSFORMATION_LOGIC_COLUMNS),
+)
+STTM_PROJECTIONS = {
+    'dataset_inference': _TABLE_FIELDS[:2],
+    'schema_yml': _TABLE_FIELDS,
+    'model': _MAPPING_FIELDS,
+    'test_plan': _MAPPING_FIELDS,
+}
+
+
+def estimate_tokens(part: Any) -> int:
+    """Estimated input tokens of one prompt part (text or PIL image)."""
+    if isinstance(part, str):
+        return math.ceil(len(part) / CHARS_PER_TOKEN)
+    size = getattr(part, 'size', None)
+    if isinstance(size, tuple) and len(size) == 2:
+        width, height = size
+        return math.ceil(width / IMAGE_TILE_PIXELS) * math.ceil(height / IMAGE_TILE_PIXELS) * IMAGE_TILE_TOKENS
+    return 0
+
+
+def project_sttm(sttm_df: pd.DataFrame, artifact: str) -> pd.DataFrame:
+    """
+    Keeps only the STTM columns `artifact` needs (see STTM_PROJECTIONS) and drops
+    rows that become empty or duplicated, e.g. one row per table for schema.yml.
+    A mapping with none of the expected columns is returned unchanged.
+    """
+    columns = [column for column in (find_column(sttm_df, *names) for names in STTM_PROJECTIONS[artifact]) if column is not None]
+    if not columns:
+        return sttm_df
+    return sttm_df[[column for column in sttm_df.columns if column in columns]].dropna(how='all').drop_duplicates()
+
+
+def sttm_part(sttm: Union[pd.DataFrame, str], label: str = "Input CSV Content for Inference") -> str:
+    """Wraps a mapping (a DataFrame or raw CSV text) as a prompt part."""
+    content = sttm.to_csv(index=False) if isinstance(sttm, pd.DataFrame) else sttm
+    return f"\n--- {label} ---\n{content}\n--- End Input CSV Content ---"
+
+
+class PromptBuilder:
+    """
+    Assembles the parts of one LLM call and keeps them within the input token
+    budget of its task (`max_input_tokens` of the model route).
+    """
+
+    def __init__(self, task: str, *parts: Any):
+        self.task = task
+        self.budget = get_model_route(task).max_input_tokens
+        self.parts: List[Any] = list(parts)
+
+    def add(self, *parts: Any) -> "PromptBuilder":
+        self.parts.extend(part for part in parts if part is not None and not (isinstance(part, str) and not part))
+        return self
+
+    @property
+    def tokens(self) -> int:
+        return sum(estimate_tokens(part) for part in self.parts)
+
+    def remaining(self) -> Optional[int]:
+        return None if self.budget is None else self.budget - self.tokens
+
+    def add_sttm(self, sttm_df: pd.DataFrame, label: str = "Input CSV Content for Inference") -> "PromptBuilder":
+        """
+        Adds a mapping that must be sent whole (e.g. for a model). If it does not
+        fit, long cells of the other columns are cut to MAX_CELL_CHARS. The
+        transformation logic is always sent in full: SQL written from a cut
+        derivation would silently compute something else. A mapping still over
+        the budget is sent anyway, and the user is warned.
+        """
+        part = sttm_part(sttm_df, label)
+        remaining = self.remaining()
+        if remaining is not None and estimate_tokens(part) > remaining:
+            logic_column = find_logic_column(sttm_df)
+            compacted = sttm_df.apply(lambda column: column if column.name == logic_column else column.map(
+                lambda value: value[:MAX_CELL_CHARS] + '...' if isinstance(value, str) and len(value) > MAX_CELL_CHARS else value
+            ))
+            part = sttm_part(compacted, label)
+            if estimate_tokens(part) > remaining:
+                report_progress(f"Warning: the mapping (~{estimate_tokens(part)} tokens) does not fit the '{self.task}' prompt "
+                                f"({remaining} tokens left of {self.budget}). It is sent in full; if the output is incomplete, "
+                                "split the mapping into smaller files.")
+            else:
+                print(f"Prompt for '{self.task}': mapping shortened to ~{estimate_tokens(part)} tokens to fit the budget of {self.budget}.")
+        return self.add(part)
+
+    def split_sttm(self, sttm_df: pd.DataFrame) -> List[pd.DataFrame]:
+        """
+        Splits a mapping whose rows can be processed independently (e.g. into test
+        cases) into as few chunks as fit next to the current parts. Every chunk
+        keeps the header; at least one row goes into each chunk.
+        """
+        remaining = self.remaining()
+        if remaining is None or sttm_df.empty or estimate_tokens(sttm_part(sttm_df)) <= remaining:
+            return [sttm_df]
+        header_tokens = estimate_tokens(sttm_part(sttm_df.iloc[0:0]))
+        # Cell lengths plus separators; quoting is not worth serializing every row for.
+        row_chars = sttm_df.fillna('').astype(str).apply(lambda row: sum(map(len, row)) + len(row), axis=1)
+        chunks, start, used = [], 0, header_tokens
+        for index, tokens in enumerate(math.ceil(chars / CHARS_PER_TOKEN) for chars in row_chars):
+            if index > start and used + tokens > remaining:
+                chunks.append(sttm_df.iloc[start:index])
+                start, used = index, header_tokens
+            used += tokens
+        chunks.append(sttm_df.iloc[start:])
+        print(f"Prompt for '{self.task}': mapping of {len(sttm_df)} rows split into {len(chunks)} calls to fit the budget of {self.budget} tokens.")
+        return chunks
+
+    def build(self, *extra_parts: Any) -> List[Any]:
+        """
+        Returns the parts (followed by `extra_parts`, e.g. one chunk of a split
+        mapping), logging their estimated size against the budget.
+        """
+        parts = self.parts + [part for part in extra_parts if part is not None and not (isinstance(part, str) and not part)]
+        tokens = sum(estimate_tokens(part) for part in parts)
+        budget = f" of {self.budget}" if self.budget is not None else ''
+        print(f"Prompt for '{self.task}': {len(parts)} parts, ~{tokens}{budget} input tokens.")
+        if self.budget is not None and tokens > self.budget:
+            print(f"Warning: the prompt for '{self.task}' is over its input token budget.")
+        return parts
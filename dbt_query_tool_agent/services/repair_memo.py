@@ -0,0 +1,324 @@
+import difflib
+import json
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import yaml
+
+from dbt_query_tool_agent.services.dbt_errors import DbtError
+
+# Where learned patches are persisted between sessions.
+REPAIR_MEMO_PATH = os.environ.get(
+    "DBT_AGENT_REPAIR_MEMO_PATH",
+    os.path.join(os.path.expanduser("~"), ".dbt_query_tool_agent", "repair_memo.json")
+)
+# Learned patches larger than this are too specific to be worth replaying.
+MAX_LEARNED_HUNK_LINES = 5
+MAX_PATCHES_PER_SIGNATURE = 5
+
+
+def error_signature(error: DbtError) -> str:
+    """
+    Normalizes a dbt error into a signature that is stable across projects and
+    runs: file paths, quoted identifiers, numbers and positions are replaced with
+    placeholders, so 'Unrecognized name: postcde at [12:8]' and
+    'Unrecognized name: regionn at [3:1]' share one signature.
+    """
+    message = error.message.splitlines()[0] if error.message else ''
+    message = re.sub(r"at \[\d+:\d+\]", "at [<pos>]", message)
+    message = re.sub(r"(['\"`]).*?\1", "<id>", message)
+    message = re.sub(r"[\w\-]+(?:/[\w\-\.]+)+", "<path>", message)
+    message = re.sub(r"(?<=name: )[\w\.]+", "<id>", message)
+    message = re.sub(r"\b\d+\b", "<n>", message)
+    message = re.sub(r"\s+", " ", message).strip().lower()
+    return f"{error.error_type.lower()}|{error.node_type or ''}|{message}"
+
+
+# --- Rule-based fixes ---
+
+@dataclass(frozen=True)
+class RepairRule:
+    """
+    A deterministic fix for a known class of error.
+
+    `error_pattern` is matched against the dbt error message; None means the fix
+    is safe to apply to every generated file of the given kind (see
+    `apply_preventive_fixes`). `fix` returns the patched content, or None when the
+    file does not contain what the rule knows how to fix. `target` maps the
+    failing file to the file that actually needs the patch.
+    """
+    name: str
+    file_suffixes: Tuple[str, ...]
+    error_pattern: Optional[re.Pattern]
+    fix: Callable[[str, Optional[DbtError]], Optional[str]]
+    target: Callable[[str, DbtError], str] = lambda path, error: path
+
+
+def _substitute(pattern: re.Pattern, replacement, content: str) -> Optional[str]:
+    patched, count = pattern.subn(replacement, content)
+    return patched if count else None
+
+
+# An argument without top-level commas or keywords: a column, a literal or a simple call.
+_SQL_OPERAND = r"(?:'[^']*'|[\w\.\"`]+(?:\([^()]*\))?)"
+_SUBSTRING_FROM_FOR = re.compile(
+    rf"SUBSTRING\s*\(\s*({_SQL_OPERAND})\s+FROM\s+({_SQL_OPERAND})(?:\s+FOR\s+({_SQL_OPERAND}))?\s*\)", re.IGNORECASE
+)
+_POSITION_IN = re.compile(rf"POSITION\s*\(\s*({_SQL_OPERAND})\s+IN\s+({_SQL_OPERAND})\s*\)", re.IGNORECASE)
+_CAST_TO = re.compile(r"\bCAST\s*\(\s*([^()]+?|[\w\.]+\([^()]*\))\s+TO\s+(\w+(?:\s*\(\s*\d+(?:\s*,\s*\d+)?\s*\))?)\s*\)", re.IGNORECASE)
+_POSTGRES_CAST = re.compile(r"(?<![:\w])([\w\.]+|'[^']*')::(\w+(?:\s*\(\s*\d+(?:\s*,\s*\d+)?\s*\))?)")
+_MISSING_SOURCE = re.compile(r"depends on a source named '(?P<source>[\w\-]+)\.(?P<table>[\w\-]+)' which was not found")
+
+
+def _fix_job_timeout(content: str, error: Optional[DbtError]) -> Optional[str]:
+    # The LLM sometimes uses 'job_timeout_ms' instead of 'timeout_seconds'.
+    return content.replace('job_timeout_ms', 'timeout_seconds') if 'job_timeout_ms' in content else None
+
+
+def _fix_substring_from_for(content: str, error: Optional[DbtError]) -> Optional[str]:
+    def replace(match):
+        arguments = [argument for argument in match.groups() if argument]
+        return f"SUBSTR({', '.join(arguments)})"
+    return _substitute(_SUBSTRING_FROM_FOR, replace, content)
+
+
+def _fix_position_in(content: str, error: Optional[DbtError]) -> Optional[str]:
+    return _substitute(_POSITION_IN, lambda match: f"STRPOS({match.group(2)}, {match.group(1)})", content)
+
+
+def _fix_cast_to(content: str, error: Optional[DbtError]) -> Optional[str]:
+    return _substitute(_CAST_TO, lambda match: f"CAST({match.group(1)} AS {match.group(2)})", content)
+
+
+def _fix_postgres_cast(content: str, error: Optional[DbtError]) -> Optional[str]:
+    return _substitute(_POSTGRES_CAST, lambda match: f"CAST({match.group(1)} AS {match.group(2)})", content)
+
+
+def _fix_missing_source(content: str, error: Optional[DbtError]) -> Optional[str]:
+    match = _MISSING_SOURCE.search(error.message if error else '')
+    if not match:
+        return None
+    source_name, table_name = match.group('source'), match.group('table')
+    schema = yaml.safe_load(content) or {}
+    schema.setdefault('version', 2)
+    sources = schema.setdefault('sources', []) or []
+    schema['sources'] = sources
+    source = next((entry for entry in sources if entry.get('name') == source_name), None)
+    if source is None:
+        source = {'name': source_name, 'tables': []}
+        sources.append(source)
+    tables = source.setdefault('tables', []) or []
+    source['tables'] = tables
+    if any(table.get('name') == table_name for table in tables):
+        return None
+    tables.append({'name': table_name})
+    return yaml.safe_dump(schema, sort_keys=False)
+
+
+def rewrite_postgres_syntax(sql: str) -> str:
+    """Rewrites the Postgres-only constructs known to the dialect rules into BigQuery SQL."""
+    for fix in (_fix_cast_to, _fix_substring_from_for, _fix_position_in, _fix_postgres_cast):
+        sql = fix(sql, None) or sql
+    return sql
+
+
+def _schema_yml_next_to(path: str, error: DbtError) -> str:
+    return os.path.join(os.path.dirname(path) or 'models', 'schema.yml')
+
+
+REPAIR_RULES: List[RepairRule] = [
+    RepairRule('profiles_job_timeout', ('profiles.yml',), None, _fix_job_timeout),
+    RepairRule('substring_from_for', ('.sql',), re.compile(r"Syntax error", re.IGNORECASE), _fix_substring_from_for),
+    RepairRule('position_in', ('.sql',), re.compile(r"Syntax error", re.IGNORECASE), _fix_position_in),
+    RepairRule('cast_to', ('.sql',), re.compile(r"Syntax error", re.IGNORECASE), _fix_cast_to),
+    RepairRule('postgres_cast', ('.sql',), re.compile(r"Syntax error", re.IGNORECASE), _fix_postgres_cast),
+    RepairRule('missing_source', ('.sql',), _MISSING_SOURCE, _fix_missing_source, target=_schema_yml_next_to),
+]
+
+
+@dataclass
+class MemoFix:
+    """A fix found in the memo: which file to write and its patched content."""
+    source: str  # 'rule:<name>' or 'learned:<signature>'
+    target_path: str
+    patched_content: str
+
+
+# --- Memo store ---
+
+def _replacement_hunks(before: str, after: str) -> List[Tuple[str, str]]:
+    """Line-level (old, new) replacements turning `before` into `after`."""
+    before_lines, after_lines = before.splitlines(), after.splitlines()
+    hunks = []
+    matcher = difflib.SequenceMatcher(a=before_lines, b=after_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        if tag != 'replace' or max(i2 - i1, j2 - j1) > MAX_LEARNED_HUNK_LINES:
+            # Insertions, deletions and large rewrites depend on the whole file.
+            return []
+        old = "\n".join(line.strip() for line in before_lines[i1:i2])
+        new = "\n".join(line.strip() for line in after_lines[j1:j2])
+        hunks.append((old, new))
+    return hunks
+
+
+def repaired_file_key(project_url: str, relative_path: str) -> str:
+    """Identifies a project file across the repair and run tools, e.g. 'gs://b/ons/dbt/models/ons.sql'."""
+    return f"{project_url.rstrip('/')}/{relative_path.lstrip('/')}"
+
+
+class RepairMemo:
+    """
+    Remembers how dbt errors were fixed and replays those fixes.
+
+    Lookups try the built-in REPAIR_RULES first, then patches learned from
+    earlier LLM repairs of an error with the same signature. A patch is only
+    learned once the next dbt run of the patched file succeeds (see `record` and
+    `settle`). Learned patches are kept in a JSON file so they survive restarts;
+    pending ones live in memory.
+    """
+
+    def __init__(self, path: Optional[str] = REPAIR_MEMO_PATH, rules: Optional[List[RepairRule]] = None):
+        self.path = path
+        self.rules = REPAIR_RULES if rules is None else rules
+        self._lock = threading.Lock()
+        self._learned: Dict[str, List[dict]] = self._load()
+        # Patches waiting for a dbt run of their file, by repaired_file_key.
+        self._pending: Dict[str, Tuple[str, List[List[str]]]] = {}
+
+    def _load(self) -> Dict[str, List[dict]]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as err:
+            print(f"Warning: Could not read repair memo at {self.path}. Starting empty. Error: {err}")
+            return {}
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._learned, f, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as err:
+            print(f"Warning: Could not persist repair memo to {self.path}. Error: {err}")
+
+    def apply_preventive_fixes(self, relative_path: str, content: str) -> str:
+        """Applies every rule without an error pattern that targets this kind of file."""
+        for rule in self.rules:
+            if rule.error_pattern is None and relative_path.endswith(rule.file_suffixes):
+                content = rule.fix(content, None) or content
+        return content
+
+    def lookup(self, relative_path: str, content: str, error: DbtError,
+               read_file: Optional[Callable[[str], Optional[str]]] = None) -> Optional[MemoFix]:
+        """
+        Returns a known fix for `error` in the file at `relative_path`, or None
+        when neither a rule nor a learned patch applies.
+
+        `read_file` loads another project file by relative path; it is needed by
+        rules whose fix belongs in a different file (e.g. a missing source,
+        reported on the model but fixed in schema.yml).
+        """
+        # Rules fixing the failing file itself are chained, since one file often
+        # has several instances of the same dialect problem.
+        patched, applied = content, []
+        for rule in self.rules:
+            if not relative_path.endswith(rule.file_suffixes):
+                continue
+            if rule.error_pattern is not None and not rule.error_pattern.search(error.message):
+                continue
+            target_path = rule.target(relative_path, error)
+            if target_path == relative_path:
+                result = rule.fix(patched, error)
+                if result is not None and result != patched:
+                    patched = result
+                    applied.append(rule.name)
+                continue
+            target_content = read_file(target_path) if read_file else None
+            if target_content is None:
+                continue
+            result = rule.fix(target_content, error)
+            if result is not None and result != target_content:
+                return MemoFix(f"rule:{rule.name}", target_path, result)
+        if applied:
+            return MemoFix(f"rule:{'+'.join(applied)}", relative_path, patched)
+
+        signature = error_signature(error)
+        with self._lock:
+            patches = list(self._learned.get(signature, []))
+        for patch in patches:
+            patched = self._apply_hunks(content, patch['hunks'])
+            if patched is not None:
+                return MemoFix(f"learned:{signature}", relative_path, patched)
+        return None
+
+    @staticmethod
+    def _apply_hunks(content: str, hunks: List[List[str]]) -> Optional[str]:
+        lines = content.splitlines()
+        stripped = [line.strip() for line in lines]
+        for old, new in hunks:
+            old_lines = old.split("\n")
+            for start in range(len(stripped) - len(old_lines) + 1):
+                if stripped[start:start + len(old_lines)] == old_lines:
+                    indent = lines[start][:len(lines[start]) - len(lines[start].lstrip())]
+                    new_lines = [indent + line for line in new.split("\n")] if new else []
+                    lines[start:start + len(old_lines)] = new_lines
+                    stripped[start:start + len(old_lines)] = [line.strip() for line in new_lines]
+                    break
+            else:
+                # Every hunk must match, otherwise the patch belongs to a different file.
+                return None
+        return "\n".join(lines)
+
+    def record(self, file_key: str, error: DbtError, before: str, after: str) -> bool:
+        """
+        Keeps the patch that should repair `error` in the file `file_key`
+        (usually produced by the LLM) as pending, until `settle` learns from the
+        next dbt run of that file whether it works. A newer patch of the same
+        file replaces the pending one.
+
+        Returns:
+            bool: True if a replayable patch is pending.
+        """
+        hunks = [list(hunk) for hunk in _replacement_hunks(before, after)]
+        with self._lock:
+            if not hunks:
+                self._pending.pop(file_key, None)
+                return False
+            self._pending[file_key] = (error_signature(error), hunks)
+        return True
+
+    def settle(self, file_key: str, succeeded: bool) -> bool:
+        """
+        Learns the pending patch of `file_key` when the dbt run of the file
+        succeeded, so the next error with the same signature is fixed without
+        the LLM; discards it when the run failed again.
+
+        Returns:
+            bool: True if a patch was learned.
+        """
+        with self._lock:
+            pending = self._pending.pop(file_key, None)
+            if pending is None or not succeeded:
+                return False
+            signature, hunks = pending
+            patches = self._learned.setdefault(signature, [])
+            if any(patch['hunks'] == hunks for patch in patches):
+                return False
+            patches.insert(0, {'hunks': hunks})
+            del patches[MAX_PATCHES_PER_SIGNATURE:]
+            self._save()
+        return True
+
+
+REPAIR_MEMO = RepairMemo()
@@ -0,0 +1,84 @@
+from typing import Dict
+
+import pandas as pd
+
+try:
+    import openpyxl
+except ImportError:  # XLSX output is optional
+    openpyxl = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = None
+
+# Rows converted and written per step, so a large report is never serialized
+# as a whole in memory before the upload starts.
+STREAM_CHUNK_ROWS = 5000
+REPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+}
+
+
+def _chunks(df: pd.DataFrame):
+    for start in range(0, len(df), STREAM_CHUNK_ROWS):
+        yield df.iloc[start:start + STREAM_CHUNK_ROWS]
+
+
+def _stream_csv(file_obj, df: pd.DataFrame) -> None:
+    file_obj.write(df.iloc[0:0].to_csv(index=False).encode('utf-8'))
+    for chunk in _chunks(df):
+        file_obj.write(chunk.to_csv(index=False, header=False).encode('utf-8'))
+
+
+def _stream_parquet(file_obj, df: pd.DataFrame) -> None:
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(file_obj, schema) as writer:
+        for chunk in _chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def _excel_value(value):
+    return None if pd.isna(value) else value
+
+
+def _stream_xlsx(file_obj, sheets: Dict[str, pd.DataFrame]) -> None:
+    # A write-only workbook appends rows without keeping a cell model in memory.
+    workbook = openpyxl.Workbook(write_only=True)
+    for sheet_name, df in sheets.items():
+        worksheet = workbook.create_sheet(title=sheet_name)
+        worksheet.append(list(df.columns))
+        for chunk in _chunks(df):
+            for row in chunk.itertuples(index=False, name=None):
+                worksheet.append([_excel_value(value) for value in row])
+    workbook.save(file_obj)
+
+
+def write_report(blob, sheets: Dict[str, pd.DataFrame], output_format: str) -> None:
+    """
+    Streams a report to a GCS blob in `output_format` ('csv', 'xlsx' or 'parquet').
+    XLSX gets one worksheet per entry of `sheets`; CSV and Parquet hold a single
+    table, so only the first entry is written. Blocking; run it on a worker thread.
+
+    Raises:
+        ValueError: for an unsupported format.
+        ImportError: if the library needed for the format is not installed.
+    """
+    if output_format not in REPORT_FORMATS:
+        raise ValueError(f"Unsupported output format '{output_format}'. Please choose one of: {', '.join(REPORT_FORMATS)}.")
+    # Checked before the upload starts, so no partial object is left behind.
+    if output_format == 'xlsx' and openpyxl is None:
+        raise ImportError("openpyxl is not installed. Cannot generate XLSX. Please use CSV format or install openpyxl.")
+    if output_format == 'parquet' and pa is None:
+        raise ImportError("pyarrow is not installed. Cannot generate Parquet. Please use CSV format or install pyarrow.")
+    blob.content_type = REPORT_FORMATS[output_format][1]
+    # The upload is resumable and sent in chunks while the report is being written.
+    with blob.open('wb') as file_obj:
+        if output_format == 'xlsx':
+            _stream_xlsx(file_obj, sheets)
+        elif output_format == 'parquet':
+            _stream_parquet(file_obj, next(iter(sheets.values())))
+        else:
+            _stream_csv(file_obj, next(iter(sheets.values())))
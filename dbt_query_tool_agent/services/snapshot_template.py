@@ -0,0 +1,115 @@
+import difflib
+import re
+from dataclasses import dataclass
+from string import Template
+from typing import List, Optional
+
+# `$` placeholders leave the Jinja braces of the snapshot untouched.
+SNAPSHOT_TEMPLATE = Template("""{% snapshot $snapshot_name %}
+{{ config(
+    target_database='$target_database',
+    target_schema='$target_schema',
+    unique_key=$unique_key,
+    strategy='$strategy',
+    $strategy_setting
+) }}
+
+select * from {{ ref('$source_model_name') }}
+
+{% endsnapshot %}
+""")
+SNAPSHOT_STRATEGIES = ('check', 'timestamp')
+_IDENTIFIER = re.compile(r'^[A-Za-z_]\w*$')
+_PROJECT_ID = re.compile(r'^[a-z][a-z0-9\-]*[a-z0-9]$')
+
+
+class SnapshotConfigError(ValueError):
+    """Raised when the snapshot parameters cannot produce a valid snapshot."""
+
+
+@dataclass(frozen=True)
+class SnapshotConfig:
+    source_model_name: str
+    unique_key: List[str]
+    strategy: str
+    check_cols: List[str]  # ['all'] for every column
+    updated_at_col: str
+    target_database: str
+    target_schema: str
+
+    @property
+    def snapshot_name(self) -> str:
+        return f"{self.source_model_name}_snapshot"
+
+    def render(self) -> str:
+        if self.strategy == 'check':
+            check_cols = "'all'" if self.check_cols == ['all'] else repr(self.check_cols)
+            strategy_setting = f"check_cols={check_cols}"
+        else:
+            strategy_setting = f"updated_at='{self.updated_at_col}'"
+        return SNAPSHOT_TEMPLATE.substitute(
+            snapshot_name=self.snapshot_name, target_database=self.target_database, target_schema=self.target_schema,
+            unique_key=repr(self.unique_key[0] if len(self.unique_key) == 1 else self.unique_key),
+            strategy=self.strategy, strategy_setting=strategy_setting, source_model_name=self.source_model_name,
+        )
+
+
+def _split(value: Optional[str]) -> List[str]:
+    return [part.strip().strip("'\"` ") for part in re.split(r'[,\s]+', (value or '').strip('[]() ')) if part.strip("'\"` ")]
+
+
+def _check_identifiers(kind: str, names: List[str], model_columns: Optional[List[str]]) -> None:
+    for name in names:
+        if not _IDENTIFIER.match(name):
+            raise SnapshotConfigError(f"Invalid {kind} '{name}': expected a column name.")
+        if model_columns is not None and name.lower() not in {column.lower() for column in model_columns}:
+            close = difflib.get_close_matches(name, model_columns, n=1)
+            hint = f" Did you mean '{close[0]}'?" if close else ''
+            raise SnapshotConfigError(f"The {kind} '{name}' is not a column of the source model.{hint}")
+
+
+def build_snapshot_config(
+    source_model_name: Optional[str],
+    unique_key: Optional[str],
+    strategy: Optional[str],
+    check_cols: Optional[str],
+    updated_at_col: Optional[str],
+    target_database: str,
+    target_schema: str,
+    model_columns: Optional[List[str]] = None,
+) -> SnapshotConfig:
+    """
+    Validates the snapshot parameters collected by the agent. Column names are
+    checked against `model_columns` when the source model's columns are known.
+
+    Raises:
+        SnapshotConfigError: naming the first invalid or missing parameter.
+    """
+    if not source_model_name or not _IDENTIFIER.match(source_model_name):
+        raise SnapshotConfigError("source_model_name is required to create a snapshot and must be a model name.")
+    strategy = (strategy or '').strip().lower()
+    if strategy not in SNAPSHOT_STRATEGIES:
+        raise SnapshotConfigError(f"Unsupported snapshot strategy '{strategy}'. Choose one of: {', '.join(SNAPSHOT_STRATEGIES)}.")
+    unique_keys = _split(unique_key)
+    if not unique_keys:
+        raise SnapshotConfigError("unique_key is required to create a snapshot.")
+    _check_identifiers('unique key', unique_keys, model_columns)
+
+    columns, updated_at = [], ''
+    if strategy == 'check':
+        columns = _split(check_cols)
+        if not columns:
+            raise SnapshotConfigError("check_cols is required for the 'check' strategy ('all' or a list of columns).")
+        if [column.lower() for column in columns] == ['all']:
+            columns = ['all']
+        else:
+            _check_identifiers('check column', columns, model_columns)
+    else:
+        updated_at = (updated_at_col or '').strip().strip("'\"`")
+        if not updated_at:
+            raise SnapshotConfigError("updated_at_col is required for the 'timestamp' strategy.")
+        _check_identifiers('updated_at column', [updated_at], model_columns)
+
+    if not _PROJECT_ID.match(target_database) or not _IDENTIFIER.match(target_schema):
+        raise SnapshotConfigError(f"Invalid snapshot target '{target_database}.{target_schema}'.")
+    return SnapshotConfig(source_model_name, unique_keys, strategy, columns, updated_at, target_database, target_schema)
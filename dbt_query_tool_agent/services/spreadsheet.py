@@ -0,0 +1,99 @@
+import csv
+import datetime
+import io
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+try:
+    import openpyxl
+except ImportError:  # XLSX input is optional
+    openpyxl = None
+
+from dbt_query_tool_agent.services.sql_transpiler import TRANSFORMATION_LOGIC_COLUMNS
+from dbt_query_tool_agent.services.sttm import DATA_TYPE_COLUMNS, KEY_FLAG_COLUMNS
+
+# Header cells that mark a sheet (and the row of the sheet) holding an STTM.
+STTM_HEADERS = frozenset(
+    ('source table', 'source column', 'source columns', 'target table', 'target table name', 'target column',
+     'target column(s)', 'join table', 'join key', 'description')
+    + KEY_FLAG_COLUMNS + DATA_TYPE_COLUMNS + tuple(column.lower() for column in TRANSFORMATION_LOGIC_COLUMNS)
+)
+# A header needs this many STTM columns to count, and is looked for in the first rows only.
+MIN_HEADER_MATCHES = 2
+HEADER_SEARCH_ROWS = 20
+
+
+@dataclass(frozen=True)
+class SheetInfo:
+    name: str
+    header_row: int  # 0-based; 0 when no STTM header was found
+    header_matches: int  # STTM columns in the header row
+
+
+def _text(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        return value.date().isoformat()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).strip()
+
+
+def _load(bytes_content: bytes):
+    if openpyxl is None:
+        raise ImportError("openpyxl is not installed. Cannot read XLSX. Please upload a CSV or install openpyxl.")
+    # Read-only mode streams rows from the archive instead of building a cell model;
+    # data_only reads the cached formula results.
+    return openpyxl.load_workbook(io.BytesIO(bytes_content), read_only=True, data_only=True)
+
+
+def _inspect(worksheet) -> SheetInfo:
+    best_row, best_matches = 0, 0
+    for index, row in enumerate(worksheet.iter_rows(max_row=HEADER_SEARCH_ROWS, values_only=True)):
+        matches = sum(1 for value in row if _text(value).lower() in STTM_HEADERS)
+        if matches > best_matches:
+            best_row, best_matches = index, matches
+    return SheetInfo(worksheet.title, best_row if best_matches >= MIN_HEADER_MATCHES else 0, best_matches)
+
+
+def xlsx_to_csv(bytes_content: bytes, sheet_name: Optional[str] = None) -> Tuple[str, str, List[str]]:
+    """
+    Converts one sheet of a workbook to CSV text, streaming its rows. Without
+    `sheet_name`, the sheet with the most STTM header columns is used (the first
+    sheet if none has any). Title rows above the header, empty rows and columns
+    without a header are dropped. Blocking.
+
+    Returns:
+        The CSV text, the name of the sheet converted, and the names of every
+        sheet holding an STTM (one STTM per sheet).
+
+    Raises:
+        ValueError: If `sheet_name` is not a sheet of the workbook.
+    """
+    workbook = _load(bytes_content)
+    try:
+        sheets = [(worksheet, _inspect(worksheet)) for worksheet in workbook.worksheets]
+        mapping_sheets = [info.name for _, info in sheets if info.header_matches >= MIN_HEADER_MATCHES]
+        if sheet_name is not None:
+            matching = [sheet for sheet in sheets if sheet[1].name == sheet_name]
+            if not matching:
+                raise ValueError(f"Sheet '{sheet_name}' not found. The workbook has: {', '.join(workbook.sheetnames)}.")
+            worksheet, info = matching[0]
+        else:
+            worksheet, info = max(sheets, key=lambda sheet: sheet[1].header_matches)
+
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        columns: List[int] = []
+        for index, row in enumerate(worksheet.iter_rows(min_row=info.header_row + 1, values_only=True)):
+            cells = [_text(value) for value in row]
+            if index == 0:
+                columns = [position for position, cell in enumerate(cells) if cell]
+            if any(cells[position] for position in columns if position < len(cells)):
+                writer.writerow([cells[position] if position < len(cells) else '' for position in columns])
+        return output.getvalue(), info.name, mapping_sheets
+    finally:
+        workbook.close()
@@ -0,0 +1,257 @@
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import SqlglotError
+    from sqlglot.optimizer.pushdown_predicates import pushdown_predicates
+    from sqlglot.optimizer.pushdown_projections import pushdown_projections
+    from sqlglot.optimizer.qualify import qualify
+except ImportError:  # sqlglot is optional; models are then uploaded as generated
+    sqlglot = None
+
+from dbt_query_tool_agent.services.sql_transpiler import TARGET_DIALECT
+
+# Used for the bytes estimate when no size is known for a column (BigQuery
+# bills 8 bytes per INT64/FLOAT64/TIMESTAMP value; strings are usually larger).
+NOMINAL_COLUMN_BYTES = 8
+_LEADING_CONFIG = re.compile(r"^\s*(\{\{\s*config\s*\(.*?\)\s*\}\}\s*)", re.DOTALL)
+_JINJA_EXPRESSION = re.compile(r"\{\{.*?\}\}", re.DOTALL)
+_PLACEHOLDER = "__jinja_{}__"
+
+# (table expression as written, e.g. "{{ source('d', 't') }}", column) -> bytes per value, or None if unknown.
+ColumnBytes = Callable[[str, str], Optional[int]]
+
+
+@dataclass
+class OptimizationReport:
+    """What the optimizer changed in one model, and what it only flagged."""
+    applied: bool = False
+    skipped_reason: str = ''
+    pruned_columns: Dict[str, List[str]] = field(default_factory=dict)  # table -> source columns no longer read
+    removed_joins: List[str] = field(default_factory=list)
+    predicates_pushed_down: bool = False
+    warnings: List[str] = field(default_factory=list)
+    # Bytes no longer read per source row: the size of each pruned column, or
+    # NOMINAL_COLUMN_BYTES when it is unknown. Table sizes are not known here.
+    estimated_bytes_saved_per_row: int = 0
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in asdict(self).items() if value not in ('', [], {}, 0, False) or key == 'applied'}
+
+
+def _mask_jinja(sql: str) -> Tuple[str, Dict[str, str]]:
+    """Replaces `{{ ... }}` expressions with placeholder table names the parser accepts."""
+    masked: Dict[str, str] = {}
+
+    def replace(match: re.Match) -> str:
+        placeholder = _PLACEHOLDER.format(len(masked))
+        masked[placeholder] = match.group(0)
+        return placeholder
+
+    return _JINJA_EXPRESSION.sub(replace, sql), masked
+
+
+def _unmask_jinja(sql: str, masked: Dict[str, str]) -> str:
+    for placeholder, jinja in masked.items():
+        sql = re.sub(rf"`?\b{placeholder}\b`?", lambda _: jinja, sql)
+    return sql
+
+
+def _source_columns(tree) -> Dict[str, Set[str]]:
+    """Maps every physical table (placeholder name) to the columns read from it, in a qualified tree."""
+    columns: Dict[str, Set[str]] = {}
+    for select in tree.find_all(exp.Select):
+        aliases = {table.alias_or_name: table.name for table in select.find_all(exp.Table) if table.find_ancestor(exp.Select) is select}
+        # Without a schema, columns of a single-table SELECT stay unqualified.
+        only_table = next(iter(aliases.values())) if len(aliases) == 1 and not select.args.get('joins') else None
+        for column in select.find_all(exp.Column):
+            if column.find_ancestor(exp.Select) is not select:
+                continue
+            if column.table in aliases:
+                columns.setdefault(aliases[column.table], set()).add(column.name)
+            elif not column.table and only_table:
+                columns.setdefault(only_table, set()).add(column.name)
+    return {table: names for table, names in columns.items() if table.startswith('__jinja_')}
+
+
+def _unalias_jinja_tables(tree, masked: Dict[str, str]) -> None:
+    """
+    Qualification aliases every table with its own name; for a `{{ ... }}`
+    table that would unmask to `{{ ... }} AS {{ ... }}`. The alias is dropped,
+    or renamed after the source/ref name if columns are qualified with it.
+    """
+    taken = {table.alias_or_name.lower() for table in tree.find_all(exp.Table)}
+    for table in list(tree.find_all(exp.Table)):
+        if table.name not in masked or table.alias != table.name:
+            continue
+        select = table.find_ancestor(exp.Select)
+        qualified = [column for column in (select.find_all(exp.Column) if select else []) if column.table == table.name]
+        if not qualified:
+            table.set('alias', None)
+            continue
+        names = re.findall(r"['\"](\w+)['\"]", masked[table.name])
+        base = alias = names[-1] if names else 'source'
+        while alias.lower() in taken:
+            alias = f"{base}_{len(taken)}"
+        taken.add(alias.lower())
+        table.set('alias', exp.TableAlias(this=exp.to_identifier(alias)))
+        for column in qualified:
+            column.set('table', exp.to_identifier(alias))
+
+
+def _ambiguous_selects(tree) -> List:
+    """
+    SELECTs reading several tables that still have unqualified columns after
+    qualification: without a schema there is no telling which table (or join)
+    such a column comes from.
+    """
+    ambiguous = []
+    for select in tree.find_all(exp.Select):
+        if not select.args.get('joins'):
+            continue
+        if any(not column.table for column in select.find_all(exp.Column) if column.find_ancestor(exp.Select) is select):
+            ambiguous.append(select)
+    return ambiguous
+
+
+def _remove_unused_left_joins(tree, skipped: List) -> List[str]:
+    """
+    Drops LEFT JOINs whose table is referenced nowhere but in its own ON clause.
+    This assumes lookup joins (at most one match per row), which is how the
+    model prompt uses them; a join that fans out rows would change the result.
+    SELECTs in `skipped` keep all their joins.
+    """
+    removed = []
+    for select in list(tree.find_all(exp.Select)):
+        if any(select is entry for entry in skipped):
+            continue
+        for join in list(select.args.get('joins') or []):
+            if join.side != 'LEFT' or not isinstance(join.this, exp.Table):
+                continue
+            alias = join.this.alias_or_name
+            used_elsewhere = any(
+                column.table == alias and column.find_ancestor(exp.Join) is not join
+                for column in select.find_all(exp.Column)
+                if column.find_ancestor(exp.Select) is select
+            )
+            if not used_elsewhere:
+                removed.append(alias)
+                join.pop()
+    return removed
+
+
+def _drop_trivial_filters(tree) -> None:
+    """Removes the `WHERE TRUE` left behind when a filter is pushed into a CTE."""
+    for where in list(tree.find_all(exp.Where)):
+        if isinstance(where.this, exp.Boolean) and where.this.this:
+            where.pop()
+
+
+def _spelling(original) -> Dict[str, str]:
+    spelling: Dict[str, str] = {}
+    for identifier in original.find_all(exp.Identifier):
+        spelling.setdefault(identifier.name.lower(), identifier.name)
+    return spelling
+
+
+def _restore_case(tree, spelling: Dict[str, str]) -> None:
+    """Qualification lower-cases identifiers; put back the spelling of the generated SQL."""
+    for identifier in tree.find_all(exp.Identifier):
+        if identifier.name.lower() in spelling:
+            identifier.set('this', spelling[identifier.name.lower()])
+
+
+def _distinct_warnings(tree, key_columns: List[str]) -> List[str]:
+    warnings = []
+    keys = {key.lower() for key in key_columns}
+    for select in tree.find_all(exp.Select):
+        if not select.args.get('distinct'):
+            continue
+        scope = select.find_ancestor(exp.CTE)
+        where = f"CTE '{scope.alias}'" if scope else "the final SELECT"
+        projected_keys = sorted(name for name in (projection.alias_or_name for projection in select.expressions) if name.lower() in keys)
+        if projected_keys:
+            warnings.append(f"SELECT DISTINCT in {where} is avoidable: it projects the model key {', '.join(projected_keys)}, "
+                            "which is tested for uniqueness. Removing it avoids a full shuffle of the result.")
+        else:
+            warnings.append(f"SELECT DISTINCT in {where} forces a full shuffle; remove it unless the source rows really contain duplicates.")
+    return warnings
+
+
+def optimize_model_sql(sql: str, key_columns: Optional[List[str]] = None, column_bytes: Optional[ColumnBytes] = None) -> Tuple[str, OptimizationReport]:
+    """
+    Rewrites a generated dbt model to read less data:
+
+    - prunes CTE columns that nothing downstream selects,
+    - removes LEFT JOINs whose columns are never used,
+    - pushes filters down into the CTEs they apply to,
+    - flags SELECT DISTINCTs that the model key makes avoidable.
+
+    `{{ ... }}` expressions are kept as written. Models with Jinja control blocks
+    (e.g. `{% if is_incremental() %}`) or SQL the parser cannot read are
+    returned unchanged, with the reason in the report. When a SELECT joining
+    several tables has unqualified columns, no column is pruned and that
+    SELECT keeps its joins, since the tables they come from are unknown.
+
+    Returns:
+        The optimized SQL and the report. The saving is estimated per source row,
+        from the sizes `column_bytes` knows and NOMINAL_COLUMN_BYTES for the
+        others; as BigQuery already skips some unread CTE columns itself, it is
+        an upper bound.
+    """
+    report = OptimizationReport()
+    if sqlglot is None:
+        report.skipped_reason = "sqlglot is not installed"
+        return sql, report
+    if '{%' in sql:
+        report.skipped_reason = "Jinja control blocks are not optimized"
+        return sql, report
+
+    config_match = _LEADING_CONFIG.match(sql)
+    config_block = config_match.group(1) if config_match else ''
+    masked_sql, masked = _mask_jinja(sql[len(config_match.group(0)):] if config_match else sql)
+    try:
+        original = sqlglot.parse_one(masked_sql, read=TARGET_DIALECT)
+        tree = qualify(original.copy(), dialect=TARGET_DIALECT, validate_qualify_columns=False,
+                       quote_identifiers=False, identify=False)
+        columns_before = _source_columns(tree)
+
+        ambiguous = _ambiguous_selects(tree)
+        if ambiguous:
+            report.warnings.append(f"{len(ambiguous)} SELECT(s) joining several tables use unqualified columns; "
+                                   "columns were not pruned and their joins were kept. Qualify every column to optimize them.")
+        else:
+            tree = pushdown_projections(tree)
+        report.removed_joins = _remove_unused_left_joins(tree, ambiguous)
+        before_pushdown = tree.sql(dialect=TARGET_DIALECT)
+        tree = pushdown_predicates(tree)
+        _drop_trivial_filters(tree)
+        report.predicates_pushed_down = tree.sql(dialect=TARGET_DIALECT) != before_pushdown
+
+        columns_after = _source_columns(tree)
+        spelling = _spelling(original)
+        _restore_case(tree, spelling)
+        report.warnings += _distinct_warnings(tree, key_columns or [])
+        _unalias_jinja_tables(tree, masked)
+        optimized = tree.sql(dialect=TARGET_DIALECT, pretty=True)
+        sqlglot.parse_one(optimized, read=TARGET_DIALECT)  # The rewrite must still parse
+    except SqlglotError as err:
+        report.skipped_reason = f"Could not analyse the SQL: {str(err).splitlines()[0]}"
+        return sql, report
+
+    for table, names in columns_before.items():
+        pruned = sorted(names - columns_after.get(table, set()))
+        if not pruned:
+            continue
+        table_sql = masked[table]
+        pruned = [spelling.get(name, name) for name in pruned]
+        report.pruned_columns[table_sql] = pruned
+        for name in pruned:
+            known = column_bytes(table_sql, name) if column_bytes else None
+            report.estimated_bytes_saved_per_row += NOMINAL_COLUMN_BYTES if known is None else known
+    report.removed_joins = [spelling.get(alias, alias) for alias in report.removed_joins]
+    report.applied = True
+    return config_block + _unmask_jinja(optimized, masked) + "\n", report
@@ -0,0 +1,165 @@
+import io
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from dbt_query_tool_agent.services.repair_memo import rewrite_postgres_syntax
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ErrorLevel, SqlglotError
+except ImportError:  # sqlglot is optional; the regex dialect rules are used instead
+    sqlglot = None
+
+SOURCE_DIALECT = 'postgres'
+TARGET_DIALECT = 'bigquery'
+# STTM / test plan columns holding SQL expressions, in order of preference.
+TRANSFORMATION_LOGIC_COLUMNS = (
+    'Transformation Logic / Derivation Rule',
+    'Transformation Logic',
+    'Derivation Rule',
+    'Derivation Rule/Condition',
+)
+# Placeholders meaning "no transformation", e.g. 'Direct mapping' or 'N/A'.
+_NO_LOGIC = re.compile(r"^(?:direct(?:ly)?(?:\s+(?:mapping|map|move|copy|pull))?|as[\s\-]is|n/?a|none|-+)$", re.IGNORECASE)
+# Postgres-only constructs that the regex fallback could not rewrite.
+_LEFTOVER_POSTGRES_SYNTAX = re.compile(r"\b(?:SUBSTRING|POSITION|CAST)\s*\([^;]*?\b(?:FROM|IN|TO)\b", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class TranspiledExpression:
+    """The BigQuery form of one transformation-logic cell."""
+    original: str
+    bigquery: str
+    error: Optional[str] = None  # Set when the cell could not be converted reliably
+
+    @property
+    def changed(self) -> bool:
+        return self.bigquery != self.original
+
+
+def is_direct_mapping(value) -> bool:
+    """True when a transformation-logic cell is empty or only says the column is mapped as-is."""
+    return value is None or (isinstance(value, float) and pd.isna(value)) or not str(value).strip() or bool(_NO_LOGIC.match(str(value).strip()))
+
+
+def _sqlglot_transpile(expression: str) -> Tuple[str, Optional[str]]:
+    try:
+        parsed = sqlglot.parse_one(expression, read=SOURCE_DIALECT, error_level=ErrorLevel.RAISE)
+    except SqlglotError as err:
+        return expression, f"Could not parse as SQL: {str(err).splitlines()[0]}"
+    # Prose such as 'Direct mapping' parses as an implicit alias or a raw command.
+    if isinstance(parsed, exp.Command) or (isinstance(parsed, exp.Alias) and not re.search(r"\bAS\b", expression, re.IGNORECASE)):
+        return expression, "Not a SQL expression"
+    try:
+        converted = parsed.sql(dialect=TARGET_DIALECT, unsupported_level=ErrorLevel.RAISE)
+    except SqlglotError as err:
+        return expression, f"Not supported in BigQuery: {str(err).splitlines()[0]}"
+    unknown_functions = sorted({node.name for node in parsed.find_all(exp.Anonymous)})
+    if unknown_functions:
+        return converted, f"Unknown function(s) left unconverted: {', '.join(unknown_functions)}"
+    return converted, None
+
+
+@lru_cache(maxsize=4096)
+def transpile_expression(expression: str) -> TranspiledExpression:
+    """
+    Converts one PostgreSQL-style expression to BigQuery SQL. Results are cached
+    per expression, so repeated cells (and repeated runs over the same STTM) are
+    converted once.
+    """
+    expression = expression.strip()
+    if is_direct_mapping(expression):
+        return TranspiledExpression(expression, expression)
+    # The rules also cover non-standard input such as CAST(x TO type), which no parser accepts.
+    rewritten = rewrite_postgres_syntax(expression)
+    if sqlglot is None:
+        error = "Postgres-specific syntax left unconverted" if _LEFTOVER_POSTGRES_SYNTAX.search(rewritten) else None
+        return TranspiledExpression(expression, rewritten, error)
+    converted, error = _sqlglot_transpile(rewritten)
+    if error and converted == rewritten:
+        # Keep the cell as written when the parser could not make sense of it.
+        converted = expression if rewritten == expression else rewritten
+    return TranspiledExpression(expression, converted, error)
+
+
+def find_logic_column(df: pd.DataFrame) -> Optional[str]:
+    """Returns the name of the transformation-logic column of an STTM or test plan, if any."""
+    normalized = {str(column).strip().lower(): column for column in df.columns}
+    for candidate in TRANSFORMATION_LOGIC_COLUMNS:
+        if candidate.lower() in normalized:
+            return normalized[candidate.lower()]
+    return None
+
+
+def transpile_sttm(df: pd.DataFrame) -> Tuple[pd.DataFrame, List[dict]]:
+    """
+    Runs every transformation-logic cell of `df` through `transpile_expression`.
+
+    Returns:
+        A copy of `df` with the converted expressions, and one issue per cell
+        that could not be converted reliably:
+        {'row': <1-based data row>, 'target_column': ..., 'expression': ..., 'issue': ...}.
+    """
+    logic_column = find_logic_column(df)
+    if logic_column is None:
+        return df, []
+    target_column = next((column for column in df.columns if str(column).strip().lower() in ('target column', 'target column(s)')), None)
+
+    converted_df = df.copy()
+    issues: List[dict] = []
+    for index, value in df[logic_column].items():
+        if pd.isna(value) or not str(value).strip():
+            continue
+        result = transpile_expression(str(value))
+        converted_df.at[index, logic_column] = result.bigquery
+        if result.error:
+            issues.append({
+                'row': df.index.get_loc(index) + 1,
+                'target_column': str(df.at[index, target_column]) if target_column else '',
+                'expression': result.original,
+                'issue': result.error,
+            })
+    return converted_df, issues
+
+
+def format_transpilation_issues(issues: List[dict]) -> str:
+    """Renders transpilation issues as a prompt section listing the cells that still need conversion."""
+    lines = [
+        f"- Row {issue['row']} ({issue['target_column'] or 'unknown target'}): `{issue['expression']}` -- {issue['issue']}"
+        for issue in issues
+    ]
+    return "\n--- Unconverted Transformation Logic ---\n" + "\n".join(lines) + "\n--- End Unconverted Transformation Logic ---"
+
+
+def read_sttm_table(bytes_content: bytes, file_type: str) -> Optional[pd.DataFrame]:
+    """
+    Reads a CSV or XLSX STTM with every cell as a string. Returns None for a CSV
+    that pandas cannot parse, so callers can fall back to sending the raw text.
+    """
+    try:
+        if file_type == '.xlsx':
+            return pd.read_excel(io.BytesIO(bytes_content), dtype=str)
+        return pd.read_csv(io.BytesIO(bytes_content), dtype=str)
+    except ValueError as err:
+        if file_type == '.xlsx':
+            raise
+        print(f"Warning: Could not parse the STTM as a table. Error: {err}")
+        return None
+
+
+def transpile_sttm_file(bytes_content: bytes, file_type: str) -> Tuple[str, List[dict]]:
+    """
+    Reads a CSV or XLSX STTM, transpiles its transformation logic and returns it
+    as CSV text with the transpilation issues. A CSV that pandas cannot parse is
+    returned unchanged, so the LLM still gets to read it.
+    """
+    df = read_sttm_table(bytes_content, file_type)
+    if df is None:
+        return bytes_content.decode('utf-8'), []
+    converted_df, issues = transpile_sttm(df)
+    return converted_df.to_csv(index=False), issues
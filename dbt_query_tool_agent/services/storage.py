@@ -0,0 +1,301 @@
+import io
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+from dbt_query_tool_agent.config import LOCAL_STORAGE_ROOT, STORAGE_COPY_CONCURRENCY
+
+# Storage backends by URL scheme. Buckets of every backend expose the subset of
+# the google.cloud.storage Bucket/Blob API the tools use (blob, list_blobs,
+# exists, reload, download_*, upload_from_string, open, delete, metadata).
+STORAGE_SCHEMES = ('gs', 'file', 'mem')
+INVALID_URL_MESSAGE = "Invalid storage URL. Must start with 'gs://', 'file://' or 'mem://'."
+
+
+@dataclass(frozen=True)
+class BlobStat:
+    name: str
+    size: int
+    generation: int  # Changes on every write of the object
+    etag: str
+    updated: float  # Seconds since the epoch
+
+
+class _UploadOnClose(io.BytesIO):
+    """A write buffer that stores its content in a blob when closed."""
+
+    def __init__(self, blob):
+        super().__init__()
+        self._blob = blob
+
+    def close(self) -> None:
+        if not self.closed:
+            self._blob.upload_from_string(self.getvalue(), content_type=self._blob.content_type)
+        super().close()
+
+
+class _Blob:
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata: Optional[Dict[str, str]] = None
+        self.content_type: Optional[str] = None
+        self.size: Optional[int] = None
+        self.generation: Optional[int] = None
+        self.etag: Optional[str] = None
+        self.updated: Optional[float] = None
+
+    def download_as_text(self, encoding: str = 'utf-8') -> str:
+        return self.download_as_bytes().decode(encoding)
+
+    def download_to_filename(self, filename: str) -> None:
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+    def open(self, mode: str = 'r', encoding: str = 'utf-8'):
+        if 'w' in mode:
+            buffer = _UploadOnClose(self)
+            return buffer if 'b' in mode else io.TextIOWrapper(buffer, encoding=encoding)
+        content = self.download_as_bytes()
+        return io.BytesIO(content) if 'b' in mode else io.StringIO(content.decode(encoding))
+
+
+class LocalBlob(_Blob):
+    """A file under the directory of a LocalBucket. Custom metadata is not persisted."""
+
+    @property
+    def path(self) -> str:
+        return self.bucket.local_path(self.name)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def reload(self) -> None:
+        stat = os.stat(self.path)
+        self.size, self.generation, self.updated = stat.st_size, stat.st_mtime_ns, stat.st_mtime
+        self.etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+    def download_as_bytes(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def download_to_filename(self, filename: str) -> None:
+        shutil.copyfile(self.path, filename)
+
+    def upload_from_string(self, content, content_type: Optional[str] = None) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Written next to the target and renamed, so readers never see a partial file.
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.upload-')
+        with os.fdopen(file_descriptor, 'wb') as f:
+            f.write(content.encode('utf-8') if isinstance(content, str) else content)
+        os.replace(temp_path, self.path)
+        self.content_type = content_type or self.content_type
+
+    def open(self, mode: str = 'r', encoding: str = 'utf-8'):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        return open(self.path, mode, encoding=None if 'b' in mode else encoding)
+
+    def delete(self) -> None:
+        os.remove(self.path)
+
+
+class LocalBucket:
+    """A directory used as a bucket; object names are paths relative to it."""
+    scheme = 'file'
+
+    def __init__(self, name: str, directory: Optional[str] = None):
+        self.name = name
+        self.directory = os.path.abspath(directory or os.path.join(LOCAL_STORAGE_ROOT, name))
+
+    def local_path(self, name: str = '') -> str:
+        path = os.path.normpath(os.path.join(self.directory, *name.split('/')))
+        if path != self.directory and not path.startswith(self.directory + os.sep):
+            raise ValueError(f"'{name}' is outside the storage directory {self.directory}.")
+        return path
+
+    def blob(self, name: str) -> LocalBlob:
+        return LocalBlob(self, name)
+
+    def list_blobs(self, prefix: str = '') -> Iterator[LocalBlob]:
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in sorted(file_names):
+                name = os.path.relpath(os.path.join(root, file_name), self.directory).replace(os.sep, '/')
+                if name.startswith(prefix) and not file_name.startswith('.upload-'):
+                    blob = self.blob(name)
+                    blob.reload()
+                    yield blob
+
+
+@dataclass
+class _MemoryObject:
+    content: bytes
+    content_type: Optional[str]
+    metadata: Optional[Dict[str, str]]
+    generation: int
+    updated: float
+
+
+_MEMORY_BUCKETS: Dict[str, Dict[str, _MemoryObject]] = {}
+_MEMORY_LOCK = threading.Lock()
+_GENERATIONS = itertools.count(1)
+
+
+class MemoryBlob(_Blob):
+    def _object(self) -> Optional[_MemoryObject]:
+        with _MEMORY_LOCK:
+            return self.bucket.objects.get(self.name)
+
+    def exists(self) -> bool:
+        return self._object() is not None
+
+    def reload(self) -> None:
+        stored = self._object()
+        if stored is None:
+            raise FileNotFoundError(f"mem://{self.bucket.name}/{self.name}")
+        self.size, self.generation, self.updated = len(stored.content), stored.generation, stored.updated
+        self.etag = f"{stored.generation:x}"
+        self.content_type, self.metadata = stored.content_type, dict(stored.metadata) if stored.metadata else None
+
+    def download_as_bytes(self) -> bytes:
+        stored = self._object()
+        if stored is None:
+            raise FileNotFoundError(f"mem://{self.bucket.name}/{self.name}")
+        return stored.content
+
+    def upload_from_string(self, content, content_type: Optional[str] = None) -> None:
+        content = content.encode('utf-8') if isinstance(content, str) else bytes(content)
+        with _MEMORY_LOCK:
+            self.bucket.objects[self.name] = _MemoryObject(
+                content, content_type or self.content_type, dict(self.metadata) if self.metadata else None,
+                next(_GENERATIONS), time.time(),
+            )
+
+    def delete(self) -> None:
+        with _MEMORY_LOCK:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise FileNotFoundError(f"mem://{self.bucket.name}/{self.name}")
+
+
+class MemoryBucket:
+    """A bucket held in process memory, shared by every MemoryBucket of the same name (tests, offline runs)."""
+    scheme = 'mem'
+
+    def __init__(self, name: str):
+        self.name = name
+        with _MEMORY_LOCK:
+            self.objects = _MEMORY_BUCKETS.setdefault(name, {})
+
+    def blob(self, name: str) -> MemoryBlob:
+        return MemoryBlob(self, name)
+
+    def list_blobs(self, prefix: str = '') -> Iterator[MemoryBlob]:
+        with _MEMORY_LOCK:
+            names = sorted(name for name in self.objects if name.startswith(prefix))
+        for name in names:
+            blob = self.blob(name)
+            try:
+                blob.reload()
+            except FileNotFoundError:  # Deleted while listing
+                continue
+            yield blob
+
+
+_gcs_client = None
+_gcs_client_lock = threading.Lock()
+
+
+def _gcs_bucket(name: str):
+    # Created on first use, so file:// and mem:// work without Google credentials.
+    global _gcs_client
+    with _gcs_client_lock:
+        if _gcs_client is None:
+            from google.cloud import storage
+            _gcs_client = storage.Client()
+    return _gcs_client.bucket(name)
+
+
+def is_storage_url(url: str) -> bool:
+    parsed_url = urlparse(url or '')
+    return parsed_url.scheme in STORAGE_SCHEMES and bool(parsed_url.netloc)
+
+
+def bucket_for_url(url: str):
+    """
+    Returns the bucket of a 'gs://', 'file://' or 'mem://' URL.
+
+    Raises:
+        ValueError: For any other URL.
+    """
+    parsed_url = urlparse(url)
+    if not is_storage_url(url):
+        raise ValueError(INVALID_URL_MESSAGE)
+    if parsed_url.scheme == 'file':
+        return LocalBucket(parsed_url.netloc)
+    if parsed_url.scheme == 'mem':
+        return MemoryBucket(parsed_url.netloc)
+    return _gcs_bucket(parsed_url.netloc)
+
+
+def split_storage_url(url: str) -> Tuple[object, str]:
+    """The bucket of `url` and the object name (or prefix) within it."""
+    return bucket_for_url(url), urlparse(url).path.lstrip('/')
+
+
+def storage_url(bucket, name: str) -> str:
+    """The URL of object `name` of `bucket`, in the scheme of its backend."""
+    return f"{getattr(bucket, 'scheme', 'gs')}://{bucket.name}/{name}"
+
+
+def stat_blob(blob) -> Optional[BlobStat]:
+    """Size, generation and etag of an object, or None if it does not exist. Blocking."""
+    if not blob.exists():
+        return None
+    blob.reload()
+    updated = blob.updated.timestamp() if hasattr(blob.updated, 'timestamp') else blob.updated
+    return BlobStat(blob.name, blob.size, blob.generation, blob.etag, updated)
+
+
+def local_directory(bucket, prefix: str) -> Optional[str]:
+    """The directory holding the objects under `prefix` when the bucket is local, else None."""
+    return bucket.local_path(prefix.rstrip('/')) if isinstance(bucket, LocalBucket) else None
+
+
+def copy_prefix(source_bucket, source_prefix: str, target_bucket, target_prefix: str = '') -> int:
+    """
+    Copies every object under `source_prefix` to `target_prefix` of
+    `target_bucket` (any two backends), keeping the relative paths, with
+    STORAGE_COPY_CONCURRENCY transfers at a time. Blocking.
+
+    Returns:
+        The number of objects copied.
+    """
+    # A folder prefix, so 'ons/dbt' does not also match 'ons/dbt_backup/...'.
+    source_prefix = source_prefix.rstrip('/') + '/' if source_prefix else ''
+    blobs = [blob for blob in source_bucket.list_blobs(prefix=source_prefix) if not blob.name.endswith('/')]
+
+    def copy(blob) -> None:
+        relative_path = blob.name[len(source_prefix):]
+        target_blob = target_bucket.blob(f"{target_prefix.rstrip('/')}/{relative_path}" if target_prefix else relative_path)
+        if isinstance(target_bucket, LocalBucket):
+            os.makedirs(os.path.dirname(target_blob.path), exist_ok=True)
+            blob.download_to_filename(target_blob.path)
+        else:
+            target_blob.metadata = blob.metadata
+            target_blob.upload_from_string(blob.download_as_bytes(), content_type=blob.content_type)
+
+    with ThreadPoolExecutor(max_workers=STORAGE_COPY_CONCURRENCY) as executor:
+        list(executor.map(copy, blobs))
+    return len(blobs)
+
+
+def download_prefix(bucket, prefix: str, directory: str) -> int:
+    """Copies every object under `prefix` into a local directory. Blocking."""
+    return copy_prefix(bucket, prefix, LocalBucket('', directory))
@@ -0,0 +1,202 @@
+import json
+from typing import Iterable, List, Literal, Tuple, Type, TypeVar
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator
+
+ItemT = TypeVar("ItemT", bound=BaseModel)
+
+
+def _strip_code_fences(value: str) -> str:
+    return value.replace('```sql', '').replace('```', '').strip()
+
+
+class TestScript(BaseModel):
+    """One generated dbt singular test."""
+    file_name: str = Field(pattern=r'^[\w\.]+\.sql$')
+    sql: str = Field(min_length=1)
+
+    @field_validator('sql')
+    @classmethod
+    def _clean_sql(cls, value: str) -> str:
+        value = _strip_code_fences(value)
+        if not value:
+            raise ValueError("sql is empty")
+        return value
+
+    @property
+    def test_id(self) -> str:
+        return self.file_name[:-len('.sql')]
+
+
+class TestCase(BaseModel):
+    """One row of the test plan sheet."""
+    # 'model_component_tested' would otherwise clash with pydantic's model_ namespace.
+    model_config = ConfigDict(protected_namespaces=())
+
+    test_id: str = Field(pattern=r'^[\w]+$')
+    test_scenario: str
+    model_component_tested: str
+    test_type: str = Field(min_length=1)
+    source_columns: str = ""
+    target_columns: str = Field(min_length=1)
+    expected_result: str = ""
+    derivation_rule: str = ""
+    test_data_considerations: str = ""
+    priority: Literal['High', 'Medium', 'Low'] = 'Medium'
+
+
+_IDENTIFIER = r'^[A-Za-z_]\w*$'
+
+
+class DerivationCheck(BaseModel):
+    """One transformation-logic test folded into a consolidated query."""
+    test_id: str = Field(pattern=r'^[\w]+$')
+    target_column: str = Field(pattern=_IDENTIFIER)
+    expected_expression: str = Field(min_length=1)
+
+    @field_validator('expected_expression')
+    @classmethod
+    def _clean_expression(cls, value: str) -> str:
+        value = _strip_code_fences(value).rstrip(';').strip()
+        if not value:
+            raise ValueError("expected_expression is empty")
+        return value
+
+
+class ConsolidatedDerivationChecks(BaseModel):
+    """The shared source query and join keys for all derivation checks on one model."""
+    source_sql: str = Field(min_length=1)
+    model_key: str = Field(pattern=_IDENTIFIER)
+    source_key: str = Field(pattern=_IDENTIFIER)
+    checks: List[DerivationCheck]
+
+    @field_validator('source_sql')
+    @classmethod
+    def _clean_source_sql(cls, value: str) -> str:
+        value = _strip_code_fences(value).rstrip(';').strip()
+        if not value:
+            raise ValueError("source_sql is empty")
+        return value
+
+
+# Test plan CSV headers, in order, and the TestCase field each one maps to.
+TEST_PLAN_COLUMNS = [
+    ('Test ID', 'test_id'),
+    ('Test Scenario', 'test_scenario'),
+    ('Model/Component Tested', 'model_component_tested'),
+    ('Test Type', 'test_type'),
+    ('Source Columns', 'source_columns'),
+    ('Target Column(s)', 'target_columns'),
+    ('Expected Result', 'expected_result'),
+    ('Derivation Rule/Condition', 'derivation_rule'),
+    ('Test Data Considerations', 'test_data_considerations'),
+    ('Priority', 'priority'),
+]
+
+
+def _array_schema(properties: dict, required: List[str]) -> dict:
+    return {
+        "type": "array",
+        "items": {"type": "object", "properties": properties, "required": required},
+    }
+
+
+# Response schemas passed to Gemini (OpenAPI subset understood by Vertex AI).
+TEST_SCRIPTS_RESPONSE_SCHEMA = _array_schema(
+    {"file_name": {"type": "string"}, "sql": {"type": "string"}},
+    ["file_name", "sql"],
+)
+TEST_CASES_RESPONSE_SCHEMA = _array_schema(
+    {
+        field: ({"type": "string", "enum": ["High", "Medium", "Low"]} if field == 'priority' else {"type": "string"})
+        for _, field in TEST_PLAN_COLUMNS
+    },
+    [field for _, field in TEST_PLAN_COLUMNS],
+)
+
+CONSOLIDATED_DERIVATION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "source_sql": {"type": "string"},
+        "model_key": {"type": "string"},
+        "source_key": {"type": "string"},
+        "checks": _array_schema(
+            {"test_id": {"type": "string"}, "target_column": {"type": "string"}, "expected_expression": {"type": "string"}},
+            ["test_id", "target_column", "expected_expression"],
+        ),
+    },
+    "required": ["source_sql", "model_key", "source_key", "checks"],
+}
+
+
+class JsonArrayStreamParser:
+    """
+    Incrementally extracts the top-level objects of a streamed JSON array.
+
+    Each object is returned as soon as its closing brace arrives, so callers can
+    act on it before the rest of the array has been generated. The same parser
+    salvages the complete objects of a truncated response.
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._current: List[str] = []
+
+    def feed(self, text: str) -> List[str]:
+        """Adds streamed text and returns the raw JSON of any completed objects."""
+        completed: List[str] = []
+        for char in text:
+            if self._depth >= 2 or (self._depth == 1 and char == '{'):
+                self._current.append(char)
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '[{':
+                self._depth += 1
+            elif char in ']}':
+                self._depth -= 1
+                if self._depth == 1 and char == '}':
+                    completed.append("".join(self._current))
+                    self._current = []
+        return completed
+
+
+def split_json_array(text: str) -> List[str]:
+    """Returns the raw JSON of every complete top-level object in `text`."""
+    return JsonArrayStreamParser().feed(text)
+
+
+def decode_items(raw_items: Iterable[str], item_type: Type[ItemT]) -> Tuple[List[ItemT], List[Tuple[str, str]]]:
+    """
+    Validates raw JSON objects against `item_type`.
+
+    Returns:
+        A tuple of (valid items, [(raw_json, error_message), ...] for invalid ones).
+    """
+    valid: List[ItemT] = []
+    invalid: List[Tuple[str, str]] = []
+    for raw in raw_items:
+        try:
+            valid.append(item_type.model_validate_json(raw))
+        except ValidationError as err:
+            message = "; ".join(f"{'.'.join(str(loc) for loc in error['loc']) or 'item'}: {error['msg']}" for error in err.errors())
+            invalid.append((raw, message))
+    return valid, invalid
+
+
+def partial_fields(raw: str) -> dict:
+    """Best-effort read of an invalid item's fields, used to target retries."""
+    try:
+        value = json.loads(raw)
+    except json.JSONDecodeError:
+        return {}
+    return value if isinstance(value, dict) else {}
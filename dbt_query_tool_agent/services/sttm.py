@@ -0,0 +1,128 @@
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import pandas as pd
+
+from dbt_query_tool_agent.services.sql_transpiler import find_logic_column, is_direct_mapping
+
+# Optional STTM columns flagging the key of the target model.
+KEY_FLAG_COLUMNS = ('primary key', 'primary key?', 'is primary key', 'pk', 'key', 'key column', 'unique key')
+# Optional STTM columns holding the target data type.
+DATA_TYPE_COLUMNS = ('target data type', 'target datatype', 'data type', 'datatype', 'target type')
+_TRUTHY = {'y', 'yes', 'true', '1', 'x', 'pk', 'primary key', 'key'}
+# Target column names that identify a row on their own, used when no key is flagged.
+_KEY_NAME = re.compile(r'(?:^|_)(?:id|key|pk)$', re.IGNORECASE)
+_COLUMN_REFERENCE = re.compile(r'([A-Za-z_]\w*)\s*$')
+
+
+@dataclass(frozen=True)
+class ColumnMapping:
+    """One target column of the STTM and where it comes from."""
+    target: str
+    source_table: str = ''
+    source: str = ''
+    join_table: str = ''
+    join_key: str = ''
+    key_flag: str = ''
+    data_type: str = ''
+    direct: bool = True  # No derivation rule: the source column is copied as-is
+
+
+def find_column(df: pd.DataFrame, *names: str) -> Optional[str]:
+    """Returns the first column of `df` matching one of `names` (case-insensitive)."""
+    normalized = {str(column).strip().lower(): column for column in df.columns}
+    return next((normalized[name] for name in names if name in normalized), None)
+
+
+def _cell(row: pd.Series, column: Optional[str]) -> str:
+    if column is None or pd.isna(row.get(column)):
+        return ''
+    return str(row[column]).strip()
+
+
+def bare_column(reference: str) -> str:
+    """'T1.ru11ind' -> 'ru11ind'."""
+    match = _COLUMN_REFERENCE.search(reference.split('.')[-1])
+    return match.group(1) if match else ''
+
+
+def split_join_key(join_key: str) -> Tuple[str, str]:
+    """
+    Splits a 'Join Key' cell into (model side column, joined table column), e.g.
+    'T1.ru11ind = T2.ru11ind' or just 'ru11ind'.
+    """
+    if '=' in join_key:
+        left, right = join_key.split('=', 1)
+        return bare_column(left), bare_column(right)
+    column = bare_column(join_key)
+    return column, column
+
+
+def parse_mappings(sttm_df: pd.DataFrame) -> List[ColumnMapping]:
+    """Returns one mapping per distinct target column, in STTM order."""
+    target_column = find_column(sttm_df, 'target column', 'target column(s)')
+    if target_column is None:
+        return []
+    columns = {
+        'source_table': find_column(sttm_df, 'source table'),
+        'source': find_column(sttm_df, 'source column', 'source columns'),
+        'join_table': find_column(sttm_df, 'join table'),
+        'join_key': find_column(sttm_df, 'join key'),
+        'key_flag': find_column(sttm_df, *KEY_FLAG_COLUMNS),
+        'data_type': find_column(sttm_df, *DATA_TYPE_COLUMNS),
+    }
+    logic_column = find_logic_column(sttm_df)
+
+    mappings, seen_targets = [], set()
+    for _, row in sttm_df.iterrows():
+        target = bare_column(_cell(row, target_column))
+        if not target or target.lower() in seen_targets:
+            continue
+        seen_targets.add(target.lower())
+        fields = {name: _cell(row, column) for name, column in columns.items()}
+        fields['source'] = bare_column(fields['source'])
+        mappings.append(ColumnMapping(
+            target=target,
+            direct=is_direct_mapping(_cell(row, logic_column)) if logic_column else True,
+            **fields,
+        ))
+    return mappings
+
+
+def find_key_columns(sttm_df: pd.DataFrame, mappings: List[ColumnMapping], allow_guess: bool = True) -> Tuple[List[str], str]:
+    """
+    Returns the target key column(s) and how they were found: a key flag column
+    of the STTM, a key-like column name, or else (if `allow_guess`) the first
+    direct mapping.
+    """
+    flag_column = find_column(sttm_df, *KEY_FLAG_COLUMNS)
+    if flag_column is not None:
+        flagged = [mapping.target for mapping in mappings if mapping.key_flag.lower() in _TRUTHY]
+        if flagged:
+            return flagged, f"Flagged as key in the '{flag_column}' column of the STTM"
+    named = [mapping.target for mapping in mappings if _KEY_NAME.search(mapping.target)]
+    if named:
+        return named[:1], "Key inferred from the column name"
+    direct = [mapping.target for mapping in mappings if mapping.direct]
+    if direct and allow_guess:
+        return direct[:1], "Key inferred from the first direct mapping of the STTM; adjust if the model has a different grain"
+    return [], ''
+
+
+def exposed_join_keys(mappings: List[ColumnMapping]) -> List[Tuple[ColumnMapping, ColumnMapping]]:
+    """
+    Returns (exposing mapping, joining mapping) pairs for every join whose model
+    side key is also a directly mapped target column, once per (column, join table).
+    """
+    by_source = {mapping.source.lower(): mapping for mapping in mappings if mapping.source and mapping.direct}
+    pairs, seen = [], set()
+    for mapping in mappings:
+        if not mapping.join_table or not mapping.join_key:
+            continue
+        exposed = by_source.get(split_join_key(mapping.join_key)[0].lower())
+        if not exposed or (exposed.target.lower(), mapping.join_table.lower()) in seen:
+            continue
+        seen.add((exposed.target.lower(), mapping.join_table.lower()))
+        pairs.append((exposed, mapping))
+    return pairs
@@ -0,0 +1,74 @@
+import asyncio
+import io
+from typing import List, Optional
+
+from PIL import Image, ImageChops
+
+from dbt_query_tool_agent.config import STTM_IMAGE_MAX_WIDTH, STTM_IMAGE_TILE_HEIGHT
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.prompt_builder import PromptBuilder
+from dbt_query_tool_agent.services.sql_transpiler import read_sttm_table
+
+# Tiles overlap by this much, so a row cut by one tile edge is whole in the next tile.
+TILE_OVERLAP_PIXELS = 96
+# Pixels closer than this to the corner colour count as margin when cropping.
+MARGIN_TOLERANCE = 24
+MARGIN_PADDING_PIXELS = 8
+EXTRACTION_PROMPT = """
+    **Instructions for Extracting a Table from an Image:**
+    1. The image contains a source-to-target mapping (or another table). Transcribe it as CSV.
+    2. The first CSV line is the header row of the table, exactly as written. Then one line per table row, top to bottom.
+    3. Copy every cell verbatim: table and column names, data types and transformation logic keep their exact spelling, case and punctuation. Do NOT correct, complete or reformat anything.
+    4. Leave a cell empty when it is empty in the image. Quote cells that contain commas, quotes or line breaks.
+    5. Output ONLY the CSV, with no explanation and no markdown code fences.
+"""
+
+def normalize_image(image: Image.Image) -> List[Image.Image]:
+    """
+    Prepares an STTM image for extraction: grayscale, cropped to its content,
+    scaled down to STTM_IMAGE_MAX_WIDTH and, when taller than
+    STTM_IMAGE_TILE_HEIGHT, cut into overlapping tiles from top to bottom.
+    """
+    image = image.convert('L')
+    background = Image.new('L', image.size, image.getpixel((0, 0)))
+    box = ImageChops.difference(image, background).point(lambda value: 255 if value > MARGIN_TOLERANCE else 0).getbbox()
+    if box:
+        left, top, right, bottom = box
+        image = image.crop((
+            max(0, left - MARGIN_PADDING_PIXELS), max(0, top - MARGIN_PADDING_PIXELS),
+            min(image.width, right + MARGIN_PADDING_PIXELS), min(image.height, bottom + MARGIN_PADDING_PIXELS),
+        ))
+    if image.width > STTM_IMAGE_MAX_WIDTH:
+        height = max(1, round(image.height * STTM_IMAGE_MAX_WIDTH / image.width))
+        image = image.resize((STTM_IMAGE_MAX_WIDTH, height), Image.LANCZOS)
+
+    tiles, top = [], 0
+    while True:
+        bottom = min(image.height, top + STTM_IMAGE_TILE_HEIGHT)
+        tiles.append(image.crop((0, top, image.width, bottom)))
+        if bottom == image.height:
+            return tiles
+        top = bottom - TILE_OVERLAP_PIXELS
+
+
+async def extract_table(image_bytes: bytes) -> Optional[str]:
+    """
+    Transcribes the table of an image into CSV text with one multimodal call.
+    Returns None when the output does not parse as a table.
+
+    Raises:
+        PIL.UnidentifiedImageError: If `image_bytes` is not an image.
+    """
+    tiles = await asyncio.to_thread(lambda: normalize_image(Image.open(io.BytesIO(image_bytes))))
+    prompt = PromptBuilder('sttm_extraction', EXTRACTION_PROMPT)
+    if len(tiles) > 1:
+        prompt.add(f"\nThe image is split into {len(tiles)} tiles, top to bottom, that overlap slightly. "
+                   "Output the header once and every row once, even if it appears in two tiles.")
+    response = await llm_gateway.generate_content(get_model('sttm_extraction'), prompt.build(*tiles))
+    csv_text = response.text.strip().removeprefix('```csv').removeprefix('```').removesuffix('```').strip()
+    table = await asyncio.to_thread(read_sttm_table, csv_text.encode('utf-8'), '.csv')
+    if table is None or table.empty or len(table.columns) < 2:
+        print("Warning: the table extracted from the STTM image is not valid CSV; the image is sent instead.")
+        return None
+    return csv_text + "\n"
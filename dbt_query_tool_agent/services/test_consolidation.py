@@ -0,0 +1,171 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from dbt_query_tool_agent.services.structured_output import ConsolidatedDerivationChecks
+
+# Consolidated checks are dbt analyses rather than singular tests: `dbt show`
+# returns their rows, so every Test ID gets its own result from a single scan.
+CONSOLIDATED_FOLDER = 'analyses'
+CONSOLIDATED_PREFIX = 'consolidated_'
+# Matches the per-Test-ID rows of a rendered query, so results can be expected
+# even when the query itself fails.
+CONSOLIDATED_TEST_ID = re.compile(r"struct\('(?P<test_id>[\w]+)' as test_id")
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_]\w*$')
+
+
+@dataclass(frozen=True)
+class CompiledCheck:
+    """One test plan row expressed as an aggregate that counts its failing rows."""
+    test_id: str
+    failing_rows_sql: str
+
+
+def classify_test_type(test_type: str) -> Optional[str]:
+    """Maps a test plan 'Test Type' to 'not_null', 'unique', 'accepted_values' or 'derivation'."""
+    test_type = (test_type or '').lower()
+    if 'null' in test_type:
+        return 'not_null'
+    if 'unique' in test_type:
+        return 'unique'
+    if 'accepted' in test_type:
+        return 'accepted_values'
+    # A direct mapping is a derivation whose expected value is the source column.
+    if 'transformation' in test_type or 'derivation' in test_type or 'direct mapping' in test_type:
+        return 'derivation'
+    return None
+
+
+def split_columns(text: str) -> List[str]:
+    """Splits a 'Target Column(s)' cell into column names; returns [] if any part is not a plain identifier."""
+    columns = [part.strip().strip('`').split('.')[-1] for part in re.split(r",|;|\band\b", text or '') if part.strip()]
+    return columns if columns and all(_IDENTIFIER.match(column) for column in columns) else []
+
+
+def parse_accepted_values(*texts: str) -> List[str]:
+    """Returns the quoted values of the first text that lists any (e.g. "'U' for Urban, 'R' for Rural")."""
+    for text in texts:
+        values = re.findall(r"'((?:[^']|'')*)'", text or '')
+        if values:
+            return list(dict.fromkeys(values))
+    return []
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def compile_mechanical_check(row: pd.Series) -> Optional[CompiledCheck]:
+    """
+    Compiles a null, uniqueness or accepted-values row into an aggregate over the
+    model. Returns None for rows that cannot be compiled without interpretation
+    (other test types, multi-column uniqueness, no parseable value list).
+    """
+    kind = classify_test_type(row.get('Test Type', ''))
+    columns = split_columns(row.get('Target Column(s)', ''))
+    test_id = str(row.get('Test ID', ''))
+    if not columns or not re.match(r'^\w+$', test_id):
+        return None
+    if kind == 'not_null':
+        condition = " or ".join(f"`{column}` is null" for column in columns)
+        return CompiledCheck(test_id, f"countif({condition})")
+    if kind == 'unique' and len(columns) == 1:
+        # Rows beyond the first for every duplicated non-null value.
+        return CompiledCheck(test_id, f"count(`{columns[0]}`) - count(distinct `{columns[0]}`)")
+    if kind == 'accepted_values' and len(columns) == 1:
+        values = parse_accepted_values(row.get('Expected Result', ''), row.get('Derivation Rule/Condition', ''))
+        if values:
+            value_list = ", ".join(_quote(value) for value in values)
+            return CompiledCheck(test_id, f"countif(`{columns[0]}` is not null and cast(`{columns[0]}` as string) not in ({value_list}))")
+    return None
+
+
+def render_check_query(description: str, ctes: List[Tuple[str, str]], from_clause: str, checks: List[CompiledCheck]) -> str:
+    """
+    Renders checks as one query: every aggregate is computed in a single pass
+    over `from_clause`, then unpivoted to one (test_id, failing_rows) row per check.
+    """
+    cte_sql = [f"{name} as (\n    {body.strip()}\n)" for name, body in ctes]
+    aggregates = ",\n        ".join(f"{check.failing_rows_sql} as check_{index}" for index, check in enumerate(checks))
+    cte_sql.append(f"check_counts as (\n    select\n        {aggregates}\n    from {from_clause}\n)")
+    rows = ",\n    ".join(f"struct('{check.test_id}' as test_id, check_{index} as failing_rows)" for index, check in enumerate(checks))
+    return (
+        f"-- {description}\n"
+        "-- Every check is evaluated in a single scan; one row per Test ID with its failing row count.\n"
+        f"with {', '.join(cte_sql)}\n"
+        "select test_id, failing_rows\n"
+        "from check_counts,\n"
+        f"unnest([\n    {rows}\n])\n"
+    )
+
+
+def compile_mechanical_checks(model_name: str, test_plan_df: pd.DataFrame) -> Tuple[Optional[str], List[str]]:
+    """
+    Folds every compilable null, uniqueness and accepted-values row of the test
+    plan into one query over `model_name`.
+
+    Returns:
+        The query (None when no row could be folded) and the folded Test IDs.
+    """
+    checks = [check for check in (compile_mechanical_check(row) for _, row in test_plan_df.iterrows()) if check]
+    if not checks:
+        return None, []
+    query = render_check_query(
+        f"Consolidated null, uniqueness and accepted-values checks for '{model_name}'.",
+        [], f"{{{{ ref('{model_name}') }}}}", checks
+    )
+    return query, [check.test_id for check in checks]
+
+
+def compile_derivation_checks(model_name: str, spec: ConsolidatedDerivationChecks, test_ids: List[str]) -> Tuple[Optional[str], List[str]]:
+    """
+    Folds the transformation-logic checks of `spec` (limited to `test_ids`) into
+    one query that joins the model to its sources once.
+
+    Returns:
+        The query (None when no check remains) and the folded Test IDs.
+    """
+    wanted = set(test_ids)
+    checks, seen = [], set()
+    for check in spec.checks:
+        if check.test_id in wanted and check.test_id not in seen:
+            seen.add(check.test_id)
+            # `is not distinct from` treats two NULLs as equal.
+            checks.append(CompiledCheck(
+                check.test_id,
+                f"countif((m.`{check.target_column}` is not distinct from ({check.expected_expression})) = false)"
+            ))
+    if not checks:
+        return None, []
+    query = render_check_query(
+        f"Consolidated transformation-logic checks for '{model_name}'.",
+        [('source_data', spec.source_sql), ('model_data', f"select * from {{{{ ref('{model_name}') }}}}")],
+        f"model_data as m\n    join source_data as s on m.`{spec.model_key}` = s.`{spec.source_key}`",
+        checks
+    )
+    return query, [check.test_id for check in checks]
+
+
+def consolidated_test_ids(query: str) -> List[str]:
+    """Returns the Test IDs a rendered consolidated query reports on."""
+    return CONSOLIDATED_TEST_ID.findall(query)
+
+
+def expand_consolidated_results(rows: List[Dict], expected_test_ids: List[str]) -> List[Dict]:
+    """
+    Turns consolidated (test_id, failing_rows) rows into per-Test-ID results in
+    the shape produced for singular tests ({'test_name', 'status', 'message'}).
+    """
+    failing_by_id = {str(row['test_id']): int(row['failing_rows'] or 0) for row in rows}
+    results = []
+    for test_id in expected_test_ids or list(failing_by_id):
+        if test_id not in failing_by_id:
+            results.append({"test_name": test_id, "status": "ERROR", "message": "No result returned by the consolidated check."})
+        elif failing_by_id[test_id]:
+            results.append({"test_name": test_id, "status": "FAIL", "message": f"Got {failing_by_id[test_id]} failing rows (consolidated check)."})
+        else:
+            results.append({"test_name": test_id, "status": "PASS", "message": ""})
+    return results
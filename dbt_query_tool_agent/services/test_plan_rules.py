@@ -0,0 +1,78 @@
+import re
+from typing import List
+
+import pandas as pd
+
+from dbt_query_tool_agent.services.sql_transpiler import find_logic_column, is_direct_mapping
+from dbt_query_tool_agent.services.sttm import exposed_join_keys, find_key_columns, parse_mappings, split_join_key
+from dbt_query_tool_agent.services.structured_output import TestCase
+
+# Test plan rows that follow directly from the STTM are generated here; only the
+# rows with a derivation rule need the LLM.
+DIRECT_MAPPING_TEST_TYPE = 'Direct Mapping'
+
+
+def _slug(text: str) -> str:
+    return re.sub(r'\W+', '_', text).strip('_').lower()
+
+
+def derivation_rows(sttm_df: pd.DataFrame) -> pd.DataFrame:
+    """Returns the STTM rows whose transformation logic is an actual derivation rule."""
+    logic_column = find_logic_column(sttm_df)
+    if logic_column is None:
+        return sttm_df.iloc[0:0]
+    return sttm_df[~sttm_df[logic_column].map(is_direct_mapping)]
+
+
+def build_rule_based_test_cases(sttm_df: pd.DataFrame, model_name: str) -> List[TestCase]:
+    """
+    Builds the test plan rows that follow mechanically from the STTM:
+    'Uniqueness' and 'Null Check' on the model key, 'Referential Integrity' on
+    columns used as join keys and 'Direct Mapping' equality for every column
+    mapped without a derivation rule.
+    """
+    mappings = parse_mappings(sttm_df)
+    if not mappings:
+        return []
+
+    def case(slug: str, **fields) -> TestCase:
+        return TestCase(test_id=f"assert_{_slug(model_name)}_{slug}", model_component_tested=model_name, **fields)
+
+    cases: List[TestCase] = []
+    key_columns, key_reason = find_key_columns(sttm_df, mappings)
+    for key in key_columns:
+        cases.append(case(
+            f"{_slug(key)}_is_unique", test_scenario=f"Verify uniqueness of {key}", test_type='Uniqueness',
+            target_columns=key, expected_result=f"No duplicate {key} values",
+            derivation_rule=f"{key} is the key of {model_name}", test_data_considerations=key_reason, priority='High',
+        ))
+        cases.append(case(
+            f"{_slug(key)}_not_null", test_scenario=f"Verify {key} is not null", test_type='Null Check',
+            target_columns=key, expected_result=f"No null {key} values",
+            derivation_rule=f"{key} is the key of {model_name}", test_data_considerations=key_reason, priority='High',
+        ))
+
+    # A join key exposed by the model must exist in the joined table.
+    for exposed, joining in exposed_join_keys(mappings):
+        joined_side = split_join_key(joining.join_key)[1]
+        cases.append(case(
+            f"{_slug(exposed.target)}_referential_integrity",
+            test_scenario=f"Verify that all {exposed.target} values in the model exist in {joining.join_table}",
+            test_type='Referential Integrity', source_columns=joined_side, target_columns=exposed.target,
+            expected_result=f"Every non-null {exposed.target} has a match in {joining.join_table}.{joined_side}",
+            derivation_rule=f"JOIN {joining.join_table} on {joining.join_key}",
+            test_data_considerations="Unmatched or late-arriving keys in the joined table", priority='Medium',
+        ))
+
+    for mapping in mappings:
+        if not mapping.direct or not mapping.source or mapping.target in key_columns:
+            continue
+        origin = f"{mapping.source_table}.{mapping.source}" if mapping.source_table else mapping.source
+        cases.append(case(
+            f"{_slug(mapping.target)}_direct_mapping",
+            test_scenario=f"Verify {mapping.target} is mapped directly from {origin}",
+            test_type=DIRECT_MAPPING_TEST_TYPE, source_columns=mapping.source, target_columns=mapping.target,
+            expected_result=f"{mapping.target} equals the source value for every row",
+            derivation_rule=mapping.source, test_data_considerations="NULLs in source", priority='Low',
+        ))
+    return cases
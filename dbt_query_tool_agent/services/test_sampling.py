@@ -0,0 +1,49 @@
+import json
+import os
+from typing import List
+
+from dbt_query_tool_agent.config import TEST_SAMPLE_PERCENT, TEST_SAMPLE_ROWS
+
+# The override only exists in the local copy of the project used for a sampled
+# run; it is never uploaded, so full runs and deployments are unaffected.
+SAMPLE_MACRO_FILE = os.path.join('macros', 'dbt_agent_sample_ref.sql')
+
+# Overrides `ref()` for tests and analyses only: models still build from their
+# full inputs, while the checks read a sample of each model.
+SAMPLE_REF_MACRO = """{% macro ref() %}
+  {%- set version = kwargs.get('version') or kwargs.get('v') -%}
+  {%- if varargs | length == 1 -%}
+    {%- set relation = builtins.ref(varargs[0], version=version) -%}
+  {%- else -%}
+    {%- set relation = builtins.ref(varargs[0], varargs[1], version=version) -%}
+  {%- endif -%}
+  {%- if not execute or model.resource_type not in ('test', 'analysis') -%}
+    {{ return(relation) }}
+  {%- endif -%}
+  {%- set existing = adapter.get_relation(relation.database, relation.schema, relation.identifier) -%}
+  {%- if existing is not none and existing.is_table -%}
+    {{ return('(select * from ' ~ relation ~ ' tablesample system (' ~ var('dbt_agent_sample_percent') ~ ' percent))') }}
+  {%- else -%}
+    {{ return('(select * from ' ~ relation ~ ' limit ' ~ var('dbt_agent_sample_rows') ~ ')') }}
+  {%- endif -%}
+{% endmacro %}
+"""
+
+
+def install_sample_macro(project_dir: str) -> List[str]:
+    """
+    Writes the sampling `ref()` override into a local dbt project.
+
+    Returns:
+        The CLI arguments that set the sample size for the invocation.
+    """
+    macro_path = os.path.join(project_dir, SAMPLE_MACRO_FILE)
+    os.makedirs(os.path.dirname(macro_path), exist_ok=True)
+    with open(macro_path, 'w', encoding='utf-8') as f:
+        f.write(SAMPLE_REF_MACRO)
+    sample_vars = {'dbt_agent_sample_percent': TEST_SAMPLE_PERCENT, 'dbt_agent_sample_rows': TEST_SAMPLE_ROWS}
+    return ["--vars", json.dumps(sample_vars)]
+
+
+def describe_sample() -> str:
+    return f"{TEST_SAMPLE_PERCENT:g}% of each table model, at most {TEST_SAMPLE_ROWS} rows of each view"
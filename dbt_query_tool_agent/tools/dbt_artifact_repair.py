@@ -0,0 +1,235 @@
+import asyncio
+import io
+import os
+import re
+from typing import Optional
+from urllib.parse import urlparse
+
+import pandas as pd
+from google.adk.tools import FunctionTool
+
+from dbt_query_tool_agent import prompts
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.dbt_errors import DbtError, parse_dbt_error
+from dbt_query_tool_agent.services.ingestion import ingest_sttm
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.repair_memo import REPAIR_MEMO, repaired_file_key
+from dbt_query_tool_agent.services.storage import INVALID_URL_MESSAGE, bucket_for_url, is_storage_url, storage_url
+from dbt_query_tool_agent.services.test_consolidation import CONSOLIDATED_FOLDER
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, read_blob_bytes, blob_exists, write_blob
+
+# Lines around the reported error position used to find the related STTM rows.
+ERROR_CONTEXT_LINES = 3
+
+
+def _find_column(df: pd.DataFrame, *candidates: str) -> Optional[str]:
+    """Returns the first column of `df` whose name matches a candidate, case-insensitively."""
+    normalized = {str(column).strip().lower(): column for column in df.columns}
+    for candidate in candidates:
+        if candidate.lower() in normalized:
+            return normalized[candidate.lower()]
+    return None
+
+
+def _mentions(text: str, value: str) -> bool:
+    return bool(value) and re.search(rf"\b{re.escape(value)}\b", text, re.IGNORECASE) is not None
+
+
+def _select_test_plan_rows(plan_df: pd.DataFrame, test_id: str, content: str) -> pd.DataFrame:
+    test_id_column = _find_column(plan_df, 'Test ID')
+    if test_id_column:
+        rows = plan_df[plan_df[test_id_column].astype(str) == test_id]
+        if rows.empty:
+            # Consolidated check queries cover every Test ID they mention.
+            rows = plan_df[plan_df[test_id_column].astype(str).apply(lambda value: _mentions(content, value))]
+        if not rows.empty:
+            return rows
+    # Fall back to rows whose target columns appear in the failing test.
+    target_column = _find_column(plan_df, 'Target Column(s)', 'Target Column')
+    if target_column:
+        return plan_df[plan_df[target_column].astype(str).apply(lambda value: _mentions(content, value))]
+    return plan_df.iloc[0:0]
+
+
+def _select_sttm_rows(sttm_df: pd.DataFrame, content: str, error: DbtError) -> pd.DataFrame:
+    target_column = _find_column(sttm_df, 'Target Column')
+    source_column = _find_column(sttm_df, 'Source Column')
+    key_columns = [column for column in (target_column, source_column) if column]
+    if not key_columns:
+        return sttm_df
+
+    # 1. Rows whose columns are named in the error message.
+    def named_in(text: str) -> pd.Series:
+        mask = pd.Series(False, index=sttm_df.index)
+        for column in key_columns:
+            mask |= sttm_df[column].fillna('').astype(str).apply(lambda value: _mentions(text, value))
+        return mask
+
+    rows = sttm_df[named_in(error.message)]
+    if not rows.empty:
+        return rows
+
+    # 2. Rows whose columns appear on the lines around the reported position.
+    if error.line:
+        lines = content.splitlines()
+        window = "\n".join(lines[max(0, error.line - 1 - ERROR_CONTEXT_LINES):error.line + ERROR_CONTEXT_LINES])
+        rows = sttm_df[named_in(window)]
+        if not rows.empty:
+            return rows
+
+    # 3. Nothing more specific is known; send the whole mapping.
+    return sttm_df
+
+
+def _select_schema_rows(sttm_df: pd.DataFrame) -> pd.DataFrame:
+    # schema.yml only needs the table identifiers.
+    table_columns = [column for column in (
+        _find_column(sttm_df, 'Source Table'), _find_column(sttm_df, 'Join Table'), _find_column(sttm_df, 'Target table')
+    ) if column]
+    return sttm_df[table_columns].drop_duplicates() if table_columns else sttm_df
+
+
+async def _read_context_rows(context_gcs_url: str) -> Optional[pd.DataFrame]:
+    parsed_url = urlparse(context_gcs_url)
+    bucket = bucket_for_url(context_gcs_url)
+    blob = bucket.blob(parsed_url.path.lstrip('/'))
+    if not await blob_exists(blob):
+        return None
+    file_type = os.path.splitext(parsed_url.path)[1].lower()
+    content = await read_blob_bytes(blob)
+    # Image mappings are read through the table extracted from them.
+    content, file_type = await ingest_sttm(bucket, infer_dbt_project_name_from_gcs_path(context_gcs_url), content, file_type)
+    if file_type == '.csv':
+        return pd.read_csv(io.BytesIO(content), dtype=str).fillna('')
+    if file_type == '.xlsx':
+        return (await asyncio.to_thread(pd.read_excel, io.BytesIO(content), dtype=str)).fillna('')
+    # No table could be extracted from the image: there are no rows to select from.
+    return None
+
+
+async def repair_dbt_artifact(
+    artifact_gcs_path: str,
+    error_message: str,
+    context_gcs_url: Optional[str] = None
+) -> dict:
+    """
+    Repairs ONE failing dbt file in place instead of regenerating every artifact.
+
+    Known errors are fixed first from the repair memo (built-in rules such as
+    Postgres-only SQL or a source missing from schema.yml, and patches learned
+    from earlier repairs with the same error signature) without calling the LLM.
+    Otherwise the prompt contains only the failing file, the structured dbt error
+    for it, and the STTM or test plan rows linked to that file:
+    - tests/<test_id>.sql: the test plan row with that Test ID.
+    - analyses/consolidated_*.sql: the test plan rows of the Test IDs it checks.
+    - models/<model>.sql: the STTM rows whose columns are named in the error
+      (or appear around the reported line).
+    - models/schema.yml: the distinct table identifiers from the STTM.
+
+    Args:
+        artifact_gcs_path (str): GCS URL of the failing file
+            (e.g. 'gs://bucket/project/dbt/tests/assert_ons_postcode_is_unique.sql').
+        error_message (str): The dbt output for the failure. The block for this
+            file is extracted automatically, so the full stdout may be passed.
+        context_gcs_url (Optional[str]): GCS URL of the test plan (for tests) or
+            the STTM (for models and schema.yml).
+
+    Returns:
+        dict: The GCS path of the patched file, its new content, the parsed
+            `dbt_error` it was repaired for and the `repair_source`
+            ('rule:<name>', 'learned:<signature>' or 'llm').
+    """
+    try:
+        print(f"--- Executing Tool: repair_dbt_artifact for {artifact_gcs_path} ---")
+        if not is_storage_url(artifact_gcs_path):
+            return {"result": "ERROR", "message": INVALID_URL_MESSAGE}
+
+        parsed_url = urlparse(artifact_gcs_path)
+        bucket = bucket_for_url(artifact_gcs_path)
+        blob_name = parsed_url.path.lstrip('/')
+        blob = bucket.blob(blob_name)
+        if not await blob_exists(blob):
+            return {"result": "ERROR", "message": f"File not found at {artifact_gcs_path}"}
+        await asyncio.to_thread(blob.reload)
+        current_content = (await read_blob_bytes(blob)).decode('utf-8')
+
+        # Path relative to the dbt project root, as dbt reports it (e.g. 'tests/x.sql').
+        relative_path = blob_name.split('/dbt/', 1)[-1]
+        file_name = os.path.basename(blob_name)
+        error = parse_dbt_error(error_message, relative_path)
+
+        # --- Known fixes first: rule-based or learned from earlier repairs, no LLM call ---
+        project_prefix = blob_name[:len(blob_name) - len(relative_path)]
+
+        def read_project_file(path: str) -> Optional[str]:
+            other_blob = bucket.blob(f"{project_prefix}{path}")
+            return other_blob.download_as_bytes().decode('utf-8') if other_blob.exists() else None
+
+        memo_fix = await asyncio.to_thread(REPAIR_MEMO.lookup, relative_path, current_content, error, read_project_file)
+        if memo_fix is not None:
+            print(f"Applying known fix '{memo_fix.source}' to {memo_fix.target_path}")
+            target_blob = blob if memo_fix.target_path == relative_path else bucket.blob(f"{project_prefix}{memo_fix.target_path}")
+            if target_blob is not blob:
+                await asyncio.to_thread(target_blob.reload)
+            target_blob.metadata = {**(target_blob.metadata or {}), 'author': 'dbt_adk_agent', 'repaired': 'true'}
+            await write_blob(target_blob, memo_fix.patched_content,
+                             content_type='text/yaml' if memo_fix.target_path.endswith('.yml') else 'text/plain')
+            return {
+                'output_path': storage_url(bucket, target_blob.name),
+                'repaired_content': memo_fix.patched_content,
+                'dbt_error': error.to_dict(),
+                'repair_source': memo_fix.source,
+                'result': 'SUCCESS'
+            }
+
+        context_df = await _read_context_rows(context_gcs_url) if context_gcs_url else None
+        context_rows = None
+        if context_df is not None:
+            if relative_path.startswith(('tests/', f'{CONSOLIDATED_FOLDER}/')):
+                context_rows = _select_test_plan_rows(context_df, os.path.splitext(file_name)[0], current_content)
+            elif file_name == 'schema.yml':
+                context_rows = _select_schema_rows(context_df)
+            elif file_name.endswith('.sql'):
+                context_rows = _select_sttm_rows(context_df, current_content, error)
+
+        llm_prompt_parts = [
+            prompts.DBT_ARTIFACT_REPAIR_PROMPT,
+            f"\n--- File: {relative_path} ---\n{current_content}\n--- End File ---",
+            f"\n--- dbt Error ---\n{error.to_prompt()}\n--- End dbt Error ---",
+        ]
+        if context_rows is not None and not context_rows.empty:
+            llm_prompt_parts.append(f"\n--- Related Rows (CSV) ---\n{context_rows.to_csv(index=False)}\n--- End Related Rows ---")
+
+        response = await llm_gateway.generate_content(get_model('repair'), llm_prompt_parts)
+        repaired_content = response.text.replace('```sql', '').replace('```yaml', '').replace('```jinja', '').replace('```', '').strip()
+        if not repaired_content:
+            return {"result": "ERROR", "message": "The LLM returned an empty file."}
+
+        blob.metadata = {**(blob.metadata or {}), 'author': 'dbt_adk_agent', 'repaired': 'true'}
+        content_type = 'text/yaml' if file_name.endswith('.yml') else 'text/plain'
+        await write_blob(blob, repaired_content, content_type=content_type)
+
+        # Remember the patch; once a dbt run of the file succeeds, the same error
+        # signature is fixed without the LLM next time.
+        file_key = repaired_file_key(storage_url(bucket, project_prefix), relative_path)
+        await asyncio.to_thread(REPAIR_MEMO.record, file_key, error, current_content, repaired_content)
+
+        return {
+            'output_path': artifact_gcs_path,
+            'repaired_content': repaired_content,
+            'dbt_error': error.to_dict(),
+            'context_row_count': 0 if context_rows is None else len(context_rows),
+            'repair_source': 'llm',
+            'result': 'SUCCESS'
+        }
+    except Exception as err:
+        import traceback
+        traceback.print_exc()
+        return {
+            'output_path': '',
+            'repaired_content': '',
+            'result': 'ERROR',
+            'message': str(err)
+        }
+
+repair_dbt_artifact_tool = FunctionTool(repair_dbt_artifact)
@@ -1,19 +1,348 @@
+import asyncio
 import io
 import os
 import re
-from typing import Optional, List
+from typing import Callable, Dict, Optional, List, Tuple
 import pandas as pd
 from PIL import Image
 from urllib.parse import urlparse
-from vertexai.generative_models import GenerativeModel
 from google.adk.tools import FunctionTool
 from dbt_query_tool_agent import prompts
-from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
+from dbt_query_tool_agent.config import ARTIFACT_TYPE_TASKS, SQL_OPTIMIZER_ENABLED, TEST_SCRIPT_BATCH_SIZE, TEST_SCRIPT_BATCH_CONCURRENCY
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.catalog import ground_sttm, parse_table_ref, source_column_bytes
+from dbt_query_tool_agent.services.context_cache import CONTEXT_CACHE, sttm_prefix
+from dbt_query_tool_agent.services.generic_tests import SCHEMA_YML_FILE, merge_generic_tests, split_generic_tests
+from dbt_query_tool_agent.services.ingestion import ingest_sttm
+from dbt_query_tool_agent.services.materialization import MATERIALIZATIONS, apply_config_block, derive_materialization
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.progress import report_progress
+from dbt_query_tool_agent.services.prompt_builder import PromptBuilder
+from dbt_query_tool_agent.services.snapshot_template import SnapshotConfigError, build_snapshot_config
+from dbt_query_tool_agent.services.sql_optimizer import optimize_model_sql
+from dbt_query_tool_agent.services.sql_transpiler import format_transpilation_issues, read_sttm_table, transpile_sttm
+from dbt_query_tool_agent.services.storage import INVALID_URL_MESSAGE, bucket_for_url, is_storage_url, storage_url
+from dbt_query_tool_agent.services.sttm import find_column, find_key_columns, parse_mappings
+from dbt_query_tool_agent.services.structured_output import (
+    CONSOLIDATED_DERIVATION_RESPONSE_SCHEMA, TEST_SCRIPTS_RESPONSE_SCHEMA, ConsolidatedDerivationChecks,
+    JsonArrayStreamParser, TestScript, decode_items, partial_fields, split_json_array,
+)
+from dbt_query_tool_agent.services.test_consolidation import (
+    CONSOLIDATED_FOLDER, CONSOLIDATED_PREFIX, classify_test_type, compile_derivation_checks, compile_mechanical_checks,
+)
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, read_blob_bytes, blob_exists, write_blob, delete_blob
+from pydantic import ValidationError
+import yaml
 
-from google.cloud import storage
 #PARSING_INSTRUCTIONS = prompts.PARSING_INSTRUCTIONS
+# How many times test-script generation is attempted before giving up on the
+# Test IDs that are still missing or malformed.
+TEST_SCRIPT_MAX_ATTEMPTS = 3
 
-def generate_dbt_model_sql(
+
+def _read_test_plan(bytes_content: bytes, file_type: str) -> pd.DataFrame:
+    if file_type == '.xlsx':
+        df = pd.read_excel(io.BytesIO(bytes_content), dtype=str)
+    else:
+        df = pd.read_csv(io.BytesIO(bytes_content), dtype=str)
+    return df.fillna('')
+
+
+async def _request_test_scripts(model, prompt_parts: list, stream: bool, on_raw_item: Callable[[str], None]) -> str:
+    """
+    Sends one test-script request and calls `on_raw_item` with the raw JSON of
+    each array item. When streaming, items are handed over as soon as they are
+    complete rather than after the last token. Returns the full raw text.
+    """
+    prompt_parts = PromptBuilder('test_sql', *prompt_parts).build()
+    if stream:
+        parser = JsonArrayStreamParser()
+        chunks: List[str] = []
+        async for chunk_text in llm_gateway.stream_content(model, prompt_parts):
+            chunks.append(chunk_text)
+            for raw_item in parser.feed(chunk_text):
+                on_raw_item(raw_item)
+        return "".join(chunks).strip()
+    response = await llm_gateway.generate_content(model, prompt_parts)
+    raw_text = response.text.strip()
+    for raw_item in split_json_array(raw_text):
+        on_raw_item(raw_item)
+    return raw_text
+
+
+async def _generate_test_scripts(
+    model,
+    instruction_parts: list,
+    test_plan_df: Optional[pd.DataFrame],
+    on_script: Callable[[TestScript], None],
+    stream: bool,
+) -> Tuple[str, List[str]]:
+    """
+    Generates one test script per test plan row as schema-constrained JSON.
+
+    Every returned item is validated as a TestScript. Rows whose script is
+    missing or malformed are re-requested on their own, up to
+    TEST_SCRIPT_MAX_ATTEMPTS times. `on_script` is called once per accepted
+    script, as soon as it is decoded.
+
+    Returns:
+        The raw model output of every attempt, and the Test IDs that still have
+        no valid script.
+    """
+    accepted: set = set()
+    raw_outputs: List[str] = []
+    expected_ids = test_plan_df['Test ID'].astype(str).tolist() if test_plan_df is not None else []
+    pending_df = test_plan_df
+    retry_notes: List[str] = []
+
+    for attempt in range(TEST_SCRIPT_MAX_ATTEMPTS if test_plan_df is not None else 1):
+        prompt_parts = list(instruction_parts)
+        if pending_df is not None:
+            prompt_parts.append(f"\n--- Input CSV Content for Inference ---\n{pending_df.to_csv(index=False)}\n--- End Input CSV Content ---")
+        if retry_notes:
+            prompt_parts.append(
+                "\n**RETRY**: Generate scripts ONLY for the test cases in the CSV above. "
+                "The previous attempt returned invalid or no output for them:\n" + "\n".join(retry_notes)
+            )
+
+        invalid: List[Tuple[str, str]] = []
+
+        def handle_raw_item(raw_item: str) -> None:
+            valid, errors = decode_items([raw_item], TestScript)
+            invalid.extend(errors)
+            for script in valid:
+                if script.test_id not in accepted:
+                    accepted.add(script.test_id)
+                    on_script(script)
+
+        raw_outputs.append(await _request_test_scripts(model, prompt_parts, stream, handle_raw_item))
+
+        if test_plan_df is None:
+            break
+        missing = [test_id for test_id in expected_ids if test_id not in accepted]
+        if not missing:
+            return "\n".join(raw_outputs), []
+
+        errors_by_id = {}
+        for raw, error in invalid:
+            file_name = str(partial_fields(raw).get('file_name', ''))
+            errors_by_id[os.path.splitext(file_name)[0]] = error or 'invalid item'
+        retry_notes = [f"- {test_id}: {errors_by_id.get(test_id, 'missing from the response')}" for test_id in missing]
+        print(f"Warning: attempt {attempt + 1} produced no valid script for {len(missing)} test case(s); retrying only those.")
+        pending_df = test_plan_df[test_plan_df['Test ID'].astype(str).isin(missing)]
+
+    missing = [test_id for test_id in expected_ids if test_id not in accepted]
+    return "\n".join(raw_outputs), missing
+
+
+async def _generate_sharded_test_scripts(
+    model,
+    instruction_parts: list,
+    test_plan_df: Optional[pd.DataFrame],
+    on_script: Callable[[TestScript], None],
+    stream: bool,
+    batch_size: int,
+) -> Tuple[str, List[str], List[str]]:
+    """
+    Splits the test plan into batches of `batch_size` rows and generates them
+    concurrently, so large plans are neither truncated nor bottlenecked on one
+    response. Scripts are merged by Test ID (first one wins) and checked for
+    completeness against the plan.
+
+    Returns:
+        The raw model output, the Test IDs without a valid script, and the
+        scripts generated for Test IDs that are not in the plan.
+    """
+    if test_plan_df is None:
+        raw_output, missing = await _generate_test_scripts(model, instruction_parts, None, on_script, stream)
+        return raw_output, missing, []
+
+    plan_df = test_plan_df.drop_duplicates(subset='Test ID')
+    if len(plan_df) < len(test_plan_df):
+        print(f"Warning: ignoring {len(test_plan_df) - len(plan_df)} test plan row(s) with a duplicate Test ID.")
+    batch_size = max(1, batch_size)
+    batches = [plan_df.iloc[start:start + batch_size] for start in range(0, len(plan_df), batch_size)]
+    semaphore = asyncio.Semaphore(TEST_SCRIPT_BATCH_CONCURRENCY)
+    merged: set = set()
+
+    def accept_once(script: TestScript) -> None:
+        if script.test_id not in merged:
+            merged.add(script.test_id)
+            on_script(script)
+
+    async def run_batch(index: int, batch_df: pd.DataFrame) -> str:
+        async with semaphore:
+            report_progress(f"Generating test scripts: batch {index + 1} of {len(batches)} ({len(batch_df)} test cases)")
+            raw_output, _ = await _generate_test_scripts(model, instruction_parts, batch_df, accept_once, stream)
+            return raw_output
+
+    # A failing batch only loses its own rows; they are reported as missing below.
+    results = await asyncio.gather(*(run_batch(i, batch) for i, batch in enumerate(batches)), return_exceptions=True)
+    raw_outputs = []
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            print(f"Warning: test script batch {index + 1} failed: {result}")
+        else:
+            raw_outputs.append(result)
+
+    expected_ids = plan_df['Test ID'].astype(str).tolist()
+    missing = [test_id for test_id in expected_ids if test_id not in merged]
+    unexpected = sorted(merged - set(expected_ids))
+    return "\n".join(raw_outputs), missing, unexpected
+
+
+def _consolidated_file_names(model_name: str) -> Tuple[str, str]:
+    return f"{CONSOLIDATED_PREFIX}{model_name}_checks.sql", f"{CONSOLIDATED_PREFIX}{model_name}_derivation_checks.sql"
+
+
+async def _generate_consolidated_checks(model_name: str, test_plan_df: pd.DataFrame) -> Tuple[Dict[str, str], List[str], str]:
+    """
+    Folds the compatible rows of the test plan into single-scan queries over the model.
+
+    Null, uniqueness and accepted-values rows are compiled without the LLM. All
+    transformation-logic rows are sent in ONE request for a shared source query
+    and per-row expected expressions, which are compiled into a second query.
+    Rows that cannot be folded are left for singular test generation.
+
+    Returns:
+        {file name: query} for the analyses folder, the folded Test IDs, and the
+        raw model output (empty when no LLM call was needed).
+    """
+    if 'Test Type' not in test_plan_df.columns:
+        return {}, [], ''
+    mechanical_file, derivation_file = _consolidated_file_names(model_name)
+    queries: Dict[str, str] = {}
+    mechanical_sql, folded_ids = compile_mechanical_checks(model_name, test_plan_df)
+    if mechanical_sql:
+        queries[mechanical_file] = mechanical_sql
+
+    derivation_df = test_plan_df[test_plan_df['Test Type'].apply(classify_test_type) == 'derivation']
+    raw_output = ''
+    if not derivation_df.empty:
+        prompt_parts = [
+            prompts.DBT_CONSOLIDATED_DERIVATION_PROMPT,
+            f"\n**IMPORTANT**: The model being tested is named '{model_name}'.",
+            f"\n--- Input CSV Content for Inference ---\n{derivation_df.to_csv(index=False)}\n--- End Input CSV Content ---",
+        ]
+        model = get_model('test_sql', response_schema=CONSOLIDATED_DERIVATION_RESPONSE_SCHEMA)
+        response = await llm_gateway.generate_content(model, prompt_parts)
+        raw_output = response.text.strip()
+        try:
+            spec = ConsolidatedDerivationChecks.model_validate_json(raw_output)
+        except ValidationError as err:
+            print(f"Warning: the consolidated derivation checks were malformed; generating them as singular tests instead. Error: {err}")
+            spec = None
+        if spec is not None:
+            derivation_sql, derivation_ids = compile_derivation_checks(model_name, spec, derivation_df['Test ID'].astype(str).tolist())
+            if derivation_sql:
+                queries[derivation_file] = derivation_sql
+                folded_ids.extend(derivation_ids)
+    return queries, folded_ids, raw_output
+
+
+async def _sync_generic_tests(bucket, dbt_project_name: str, model_name: str, test_plan_df: pd.DataFrame, enabled: bool) -> Tuple[List[str], Optional[str]]:
+    """
+    Declares the null, uniqueness, accepted-values and referential integrity rows
+    of the test plan as generic tests in models/schema.yml (when `enabled`), and
+    removes generic tests of earlier runs for Test IDs that are now singular.
+
+    Returns:
+        The Test IDs declared in schema.yml and the schema.yml path if it was written.
+    """
+    schema_gcs_path = f"{dbt_project_name}/dbt/models/{SCHEMA_YML_FILE}"
+    schema_blob = bucket.blob(schema_gcs_path)
+    schema_yml = (await read_blob_bytes(schema_blob)).decode('utf-8') if await blob_exists(schema_blob) else ''
+    plan_test_ids = test_plan_df['Test ID'].astype(str).tolist()
+    generic_tests = split_generic_tests(test_plan_df)[0] if enabled else []
+    if not generic_tests and not any(test_id in schema_yml for test_id in plan_test_ids):
+        return [], None
+    try:
+        updated_yml = merge_generic_tests(schema_yml, model_name, generic_tests, replaced_test_ids=plan_test_ids)
+    except yaml.YAMLError as err:
+        print(f"Warning: {SCHEMA_YML_FILE} could not be parsed; generating singular tests instead. Error: {err}")
+        return [], None
+    schema_blob.metadata = {
+        'author': 'dbt_adk_agent',
+        'dbt_artifact_type': 'schema_yml'
+    }
+    await write_blob(schema_blob, updated_yml)
+    return [test.test_id for test in generic_tests], schema_gcs_path
+
+
+def _snapshot_target_schema(bucket, dbt_project_name: str, bytes_content: bytes, file_type: str,
+                            sttm_df: Optional[pd.DataFrame]) -> Optional[str]:
+    """
+    The dataset the snapshot is written to, the one profiles.yml was generated
+    with: that of the first qualified source table of the STTM or, for image
+    STTMs, the dataset of profiles.yml itself. Blocking.
+    """
+    if sttm_df is not None:
+        source_table = find_column(sttm_df, 'source table')
+        for value in (sttm_df[source_table].dropna() if source_table is not None else []):
+            table = parse_table_ref(str(value), '')
+            if table is not None:
+                return table.dataset
+    elif file_type == '.csv':
+        match = re.search(r"[\w\-]+\.(\w+)\.\w+", bytes_content.decode('utf-8', errors='replace'))
+        if match:
+            return match.group(1)
+    profiles_blob = bucket.blob(f"{dbt_project_name}/dbt/profiles.yml")
+    if not profiles_blob.exists():
+        return None
+    try:
+        profiles = yaml.safe_load(profiles_blob.download_as_text()) or {}
+        outputs = profiles.get(dbt_project_name, {}).get('outputs', {})
+        return next((output.get('dataset') for output in outputs.values() if output.get('dataset')), None)
+    except (yaml.YAMLError, AttributeError):
+        return None
+
+
+async def _generate_snapshot(bucket, dbt_project_name: str, bytes_content: bytes, file_type: str,
+                             file_name_with_ext: str, source_model_name: Optional[str], unique_key: Optional[str],
+                             strategy: Optional[str], check_cols: Optional[str], updated_at_col: Optional[str]) -> dict:
+    """Renders the snapshot from its template; the key and strategy columns are checked against the model's STTM columns."""
+    project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT")
+    if not project_id:
+        return {"error": "Could not determine project ID from environment."}
+    sttm_df = await asyncio.to_thread(read_sttm_table, bytes_content, file_type) if file_type in ('.csv', '.xlsx') else None
+    # The STTM describes the columns of the project's model; other models are not checked.
+    model_columns = None
+    if sttm_df is not None and (source_model_name or '').lower() == dbt_project_name.lower():
+        model_columns = [mapping.target for mapping in parse_mappings(sttm_df)] or None
+    target_schema = await asyncio.to_thread(_snapshot_target_schema, bucket, dbt_project_name, bytes_content, file_type, sttm_df)
+    try:
+        config = build_snapshot_config(
+            source_model_name, unique_key, strategy, check_cols, updated_at_col,
+            project_id, target_schema or "your_default_dataset", model_columns,
+        )
+    except SnapshotConfigError as err:
+        return {"error": str(err)}
+
+    snapshot_sql = config.render()
+    output_gcs_path = f"{dbt_project_name}/dbt/snapshots/{config.snapshot_name}.sql"
+    output_blob = bucket.blob(output_gcs_path)
+    output_blob.metadata = {
+        'author': 'dbt_adk_agent',
+        'dbt_artifact_type': 'snapshot',
+        'original_source_file': file_name_with_ext
+    }
+    await write_blob(output_blob, snapshot_sql)
+    result = {
+        'output_path': [storage_url(bucket, output_gcs_path)],
+        'output_sql': snapshot_sql,
+        'result': 'SUCCESS'
+    }
+    warnings = []
+    if model_columns is None:
+        warnings.append(f"The snapshot columns were not checked: the columns of '{source_model_name}' are not in the STTM.")
+    if target_schema is None:
+        warnings.append("Could not determine the target dataset; set target_schema in the snapshot before running it.")
+    if warnings:
+        result['message'] = " ".join(warnings)
+    return result
+
+
+async def generate_dbt_model_sql(
     gcs_url: str,
     artifact_type: str = "model", # 'model', 'snapshot', 'macro', 'profiles_yml', 'schema_yml', 'test'
     unique_key: Optional[str] = None, 
@@ -21,15 +350,21 @@ def generate_dbt_model_sql(
     check_cols: Optional[str] = None, 
     updated_at_col: Optional[str] = None, 
     source_model_name: Optional[str] = None,
-    schema_for_model: Optional[str] = None 
+    schema_for_model: Optional[str] = None,
+    stream: bool = True, # For 'test': stream the response and upload each file as soon as it is complete
+    test_batch_size: Optional[int] = None, # For 'test': rows per concurrently generated batch (default DBT_AGENT_TEST_BATCH_SIZE)
+    consolidate: bool = False, # For 'test': fold null/unique/accepted-values/derivation checks into single-scan queries
+    generic_tests: bool = False, # For 'test': declare null/unique/accepted-values/relationships checks as generic tests in schema.yml
+    materialization: Optional[str] = None, # For 'model': 'view' (project default), 'table' or 'incremental'
+    sheet_name: Optional[str] = None # For .xlsx uploads: the sheet holding the STTM or test plan (default: detected)
 ) -> dict:
     try:
-        storage_client = storage.Client()
-        if not gcs_url.startswith('gs://'):
-            return {"error": "Invalid gcs URL"}
+        if not is_storage_url(gcs_url):
+            return {"error": INVALID_URL_MESSAGE}
+        if materialization and materialization not in MATERIALIZATIONS:
+            return {"error": f"Unsupported materialization '{materialization}'. Choose one of: {', '.join(MATERIALIZATIONS)}."}
         
         parsed_url = urlparse(gcs_url)
-        bucket_name = parsed_url.netloc
         blob_name = parsed_url.path.lstrip('/') 
         
         dbt_project_name = infer_dbt_project_name_from_gcs_path(gcs_url)
@@ -40,15 +375,15 @@ def generate_dbt_model_sql(
         base_file_name = dbt_project_name
         file_type = os.path.splitext(file_name_with_ext)[1].lower()
         
-        bucket = storage_client.bucket(bucket_name)
+        bucket = bucket_for_url(gcs_url)
         blob = bucket.blob(blob_name) 
 
-        model = GenerativeModel('gemini-2.5-flash')
-
-        if not blob.exists():
+        if not await blob_exists(blob):
             return {'error': 'Object not available at input path'}
         
-        bytes_content = blob.download_as_bytes()
+        bytes_content = await read_blob_bytes(blob)
+        # An image is read once into CSV; every artifact then takes the text path.
+        bytes_content, file_type = await ingest_sttm(bucket, dbt_project_name, bytes_content, file_type, sheet_name)
         
         # --- Select specific prompt based on artifact_type ---
         # Use GENERAL_FORMATTING_INSTRUCTIONS as a base
@@ -65,44 +400,12 @@ def generate_dbt_model_sql(
             output_extension = ".sql"
             current_output_file_name = base_file_name 
         elif artifact_type == "snapshot":
-            specific_instruction = prompts.DBT_SNAPSHOT_SQL_PROMPT
-            dbt_folder = "dbt/snapshots"
-            output_extension = ".sql"
-
-            if not source_model_name:
-                return {"error": "source_model_name is required to create a snapshot."}
-            
-            current_output_file_name = f"{source_model_name}_snapshot"
-
-            # Infer project and dataset for the target config
-            project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT")
-            if not project_id:
-                return {"error": "Could not determine project ID from environment."}
-
-            # Infer dataset name from STTM content to ensure consistency with profiles.yml
-            sttm_blob = bucket.blob(blob_name)
-            sttm_content_for_inference = sttm_blob.download_as_text() if file_type == '.csv' else ""
-            datasetname = "your_default_dataset" # fallback
-            if sttm_content_for_inference:
-                inference_prompt = f"Read the following file content and extract the BigQuery dataset name from a fully qualified table name like 'project.dataset.table'. Only return the single dataset name and nothing else.\n\n{sttm_content_for_inference}"
-                inference_response = model.generate_content(inference_prompt)
-                datasetname = inference_response.text.strip()
-
-            snapshot_details_prompt = f"""
-            \nGenerate a dbt snapshot with the following configuration:
-            - Snapshot Name: {current_output_file_name}
-            - Source Model to reference: {source_model_name}
-            - Unique Key: '{unique_key}'
-            - Strategy: '{strategy}'
-            - Target Database: '{project_id}'
-            - Target Schema: '{datasetname}'
-            """
-            if strategy == 'check' and check_cols:
-                snapshot_details_prompt += f"\n- Check Columns: {check_cols}"
-            elif strategy == 'timestamp' and updated_at_col:
-                snapshot_details_prompt += f"\n- Updated At Column: '{updated_at_col}'"
-            
-            specific_instruction += snapshot_details_prompt
+            # Every setting of a snapshot is known up front, so it is rendered
+            # from a template instead of being generated.
+            return await _generate_snapshot(
+                bucket, dbt_project_name, bytes_content, file_type, file_name_with_ext,
+                source_model_name, unique_key, strategy, check_cols, updated_at_col,
+            )
         elif artifact_type == "macro":
             specific_instruction = prompts.DBT_MACRO_SQL_PROMPT
             dbt_folder = "dbt/macros"
@@ -127,16 +430,51 @@ def generate_dbt_model_sql(
 
         llm_prompt_parts.append(specific_instruction)
 
-        # Snapshots are generated based on user parameters, not the STTM file content.
-        # For other artifacts, we include the STTM content for the LLM to parse.
-        if artifact_type != "snapshot":
+        # For all artifacts, we include the STTM content for the LLM to parse.
+        # Tabular test plans are sent by _generate_test_scripts, which needs the rows
+        # to retry only the Test IDs whose scripts came back missing or malformed.
+        test_plan_df = None
+        transpilation_issues: List[dict] = []
+        materialization_config = None
+        optimization_report = None
+        catalog_issues: List[str] = []
+        model_key_columns: List[str] = []
+        # Leading parts shared with the other generators of this upload, sent through the context cache.
+        cached_prefix_length = 0
+        if artifact_type == "model":
+            sttm_df = await asyncio.to_thread(read_sttm_table, bytes_content, file_type) if file_type in ('.csv', '.xlsx') else None
+            # Keys, partitioning and the incremental filter column come from the STTM, not the LLM.
+            materialization_config = derive_materialization(sttm_df, materialization or 'view')
+            if materialization_config.materialized != 'view':
+                llm_prompt_parts.append(materialization_config.prompt_instructions())
+            if materialization_config.note:
+                report_progress(materialization_config.note)
+            if sttm_df is not None:
+                model_key_columns, _ = find_key_columns(sttm_df, parse_mappings(sttm_df), allow_guess=False)
+                # Unknown source columns would only surface as a failed dbt run and a repair cycle.
+                catalog_issues, catalog_prompt = await asyncio.to_thread(ground_sttm, sttm_df)
+                if catalog_prompt:
+                    llm_prompt_parts.append(catalog_prompt)
+                for issue in catalog_issues:
+                    report_progress(f"STTM check: {issue}")
+        if artifact_type == "test" and file_type in ('.csv', '.xlsx'):
+            test_plan_df = await asyncio.to_thread(_read_test_plan, bytes_content, file_type)
+        elif artifact_type == "model" and sttm_df is not None:
+            # Convert the transformation logic to BigQuery before the LLM sees it;
+            # cells the transpiler cannot handle are listed for the model to convert.
+            converted_df, transpilation_issues = await asyncio.to_thread(transpile_sttm, sttm_df)
+            # The instructions and mapping come first so they can be served from the
+            # context cache; only the model-specific instructions follow them.
+            prefix = sttm_prefix(prompts.GENERAL_PARSING_INSTRUCTIONS, converted_df)
+            llm_prompt_parts = prefix + llm_prompt_parts[1:]
+            cached_prefix_length = len(prefix)
+            if transpilation_issues:
+                report_progress(f"{len(transpilation_issues)} transformation logic cell(s) could not be converted to BigQuery automatically")
+                llm_prompt_parts.append(format_transpilation_issues(transpilation_issues))
+        else:
             if file_type == '.csv':
                 file_content = bytes_content.decode('utf-8')
                 llm_prompt_parts.append(f"\n--- Input CSV Content for Inference ---\n{file_content}\n--- End Input CSV Content ---")
-            elif file_type == '.xlsx':
-                df = pd.read_excel(io.BytesIO(bytes_content))
-                csv_string = df.to_csv(index=False)
-                llm_prompt_parts.append(f"\n--- Input Excel (converted to CSV) Content for Inference ---\n{csv_string}\n--- End Input Excel Content ---")
             else: # Assume image for other types
                 try:
                     image = Image.open(io.BytesIO(bytes_content))
@@ -144,50 +482,105 @@ def generate_dbt_model_sql(
                 except Image.UnidentifiedImageError:
                     return {"error": f"Unsupported file type: '{file_type}'. Please upload a CSV, XLSX, or a valid image file."}
 
-        response = model.generate_content(llm_prompt_parts)
-
-        raw_generated_content = response.text.strip()
-        
         output_paths: List[str] = []
-        
-        if artifact_type == "test":
-            # Split content by the '---' delimiter for multiple test SQLs
-            test_blocks = raw_generated_content.split('---')
-            
-            for block in test_blocks:
-                block = block.strip()
-                if not block:
-                    continue
-
-                # --- FIX: Use a more robust regex to parse the test block ---
-                # This regex looks for the filename directive and captures the filename and the SQL that follows.
-                match = re.search(r"output_file_name:\s*(?P<filename>[\w\.]+\.sql)\s*(?P<sql>.*)", block, re.DOTALL | re.IGNORECASE)
-
-                if not match:
-                    print(f"Warning: Could not find 'output_file_name:' in test block:\n{block}")
-                    continue
 
-                test_file_name_from_llm = match.group('filename').strip()
-                sql_content = match.group('sql').strip().replace('```sql', '').replace('```', '').strip()
+        if artifact_type == "test":
+            pending_uploads = []
 
-                if not sql_content:
-                    continue
-                
+            async def upload_test_script(script: TestScript) -> None:
                 # Use the filename provided by the LLM
-                current_output_gcs_path = f"{dbt_project_name}/{dbt_folder}/{test_file_name_from_llm}"
+                current_output_gcs_path = f"{dbt_project_name}/{dbt_folder}/{script.file_name}"
                 current_output_blob = bucket.blob(current_output_gcs_path)
                 current_output_blob.metadata = {
                     'author': 'dbt_adk_agent', 
                     'dbt_artifact_type': 'test', 
-                    'test_name': os.path.splitext(test_file_name_from_llm)[0], # Get name without extension
+                    'test_name': script.test_id,
                     'original_source_file': file_name_with_ext
                 }
+                await write_blob(current_output_blob, script.sql)
+                report_progress(f"Uploaded tests/{script.file_name}")
 
-                with current_output_blob.open('w') as file:
-                    file.write(sql_content)
-                
-                output_paths.append(f'gs://{bucket_name}/{current_output_gcs_path}')
+            def accept_script(script: TestScript) -> None:
+                # Start the upload right away so GCS writes overlap with generation.
+                pending_uploads.append(asyncio.create_task(upload_test_script(script)))
+                output_paths.append(storage_url(bucket, f'{dbt_project_name}/{dbt_folder}/{script.file_name}'))
+                report_progress(f"Generated test script {len(output_paths)}: {script.file_name}")
+
+            # --- Generic tests: standard checks become schema.yml entries instead of files ---
+            generic_test_ids: List[str] = []
+            if test_plan_df is not None:
+                generic_test_ids, schema_gcs_path = await _sync_generic_tests(
+                    bucket, dbt_project_name, base_file_name, test_plan_df, generic_tests
+                )
+                if schema_gcs_path:
+                    output_paths.append(storage_url(bucket, schema_gcs_path))
+                    report_progress(f"Updated models/{SCHEMA_YML_FILE} with {len(generic_test_ids)} generic test(s)")
+                if generic_test_ids:
+                    # Singular files left over from an earlier run would check the same rows again.
+                    await asyncio.gather(*(
+                        delete_blob(bucket.blob(f"{dbt_project_name}/{dbt_folder}/{test_id}.sql")) for test_id in generic_test_ids
+                    ))
+                    test_plan_df = test_plan_df[~test_plan_df['Test ID'].astype(str).isin(generic_test_ids)]
+
+            # --- Consolidated mode: compatible checks share one scan per model ---
+            consolidated_ids: List[str] = []
+            consolidated_raw = ''
+            if consolidate and test_plan_df is not None:
+                consolidated_queries, consolidated_ids, consolidated_raw = await _generate_consolidated_checks(base_file_name, test_plan_df)
+                for query_file_name, query in consolidated_queries.items():
+                    query_gcs_path = f"{dbt_project_name}/dbt/{CONSOLIDATED_FOLDER}/{query_file_name}"
+                    query_blob = bucket.blob(query_gcs_path)
+                    query_blob.metadata = {
+                        'author': 'dbt_adk_agent',
+                        'dbt_artifact_type': 'consolidated_test',
+                        'original_source_file': file_name_with_ext
+                    }
+                    await write_blob(query_blob, query)
+                    output_paths.append(storage_url(bucket, query_gcs_path))
+                    report_progress(f"Uploaded {CONSOLIDATED_FOLDER}/{query_file_name}")
+                # Singular files left over from an earlier run would check the same rows again.
+                await asyncio.gather(*(
+                    delete_blob(bucket.blob(f"{dbt_project_name}/{dbt_folder}/{test_id}.sql")) for test_id in consolidated_ids
+                ))
+                test_plan_df = test_plan_df[~test_plan_df['Test ID'].astype(str).isin(consolidated_ids)]
+            else:
+                await asyncio.gather(*(
+                    delete_blob(bucket.blob(f"{dbt_project_name}/dbt/{CONSOLIDATED_FOLDER}/{query_file_name}"))
+                    for query_file_name in _consolidated_file_names(base_file_name)
+                ))
+
+            test_model = get_model('test_sql', response_schema=TEST_SCRIPTS_RESPONSE_SCHEMA)
+            try:
+                raw_generated_content, missing_test_ids, unexpected_test_ids = await _generate_sharded_test_scripts(
+                    test_model, llm_prompt_parts, test_plan_df, accept_script, stream,
+                    test_batch_size or TEST_SCRIPT_BATCH_SIZE
+                )
+            finally:
+                # Wait for the remaining uploads; they run concurrently.
+                await asyncio.gather(*pending_uploads)
+
+            result = {
+                'output_path': output_paths,
+                'output_sql': "\n".join(part for part in (consolidated_raw, raw_generated_content) if part),
+                'result': 'SUCCESS'
+            }
+            if generic_test_ids:
+                result['generic_test_ids'] = generic_test_ids
+            if consolidated_ids:
+                result['consolidated_test_ids'] = consolidated_ids
+            if missing_test_ids:
+                result['missing_test_ids'] = missing_test_ids
+                result['message'] = f"No valid script was generated for {len(missing_test_ids)} test case(s) after retrying."
+            if unexpected_test_ids:
+                result['unexpected_test_ids'] = unexpected_test_ids
+            return result
         else:
+            task = ARTIFACT_TYPE_TASKS.get(artifact_type, 'model_sql')
+            prompt_parts = PromptBuilder(task, *llm_prompt_parts).build()
+            model, prompt_parts = await CONTEXT_CACHE.bind(task, prompt_parts, cached_prefix_length)
+            response = await llm_gateway.generate_content(model, prompt_parts)
+            raw_generated_content = response.text.strip()
+
             # Existing logic for other single artifact types
             # --- FIX: Robustly parse the LLM output to extract only the SQL content ---
             # The LLM sometimes adds explanatory text before the code, often separated by '---'.
@@ -216,6 +609,16 @@ def generate_dbt_model_sql(
             if not generated_content:
                 generated_content = raw_generated_content.replace('```sql', '').replace('```jinja', '').replace('```yaml', '').replace('```', '').strip()
 
+            if artifact_type == "model" and SQL_OPTIMIZER_ENABLED:
+                generated_content, optimization_report = await asyncio.to_thread(
+                    optimize_model_sql, generated_content, model_key_columns, source_column_bytes()
+                )
+                if optimization_report.skipped_reason:
+                    report_progress(f"SQL optimizer skipped: {optimization_report.skipped_reason}")
+
+            if materialization_config is not None:
+                generated_content = apply_config_block(generated_content, materialization_config)
+
             if dbt_folder:
                 output_gcs_path = f"{dbt_project_name}/{dbt_folder}/{current_output_file_name}{output_extension}"
             else: 
@@ -230,16 +633,26 @@ def generate_dbt_model_sql(
             }
             output_blob.metadata = tags
 
-            with output_blob.open('w') as file:
-                file.write(generated_content)
+            await write_blob(output_blob, generated_content)
             
-            output_paths.append(f'gs://{bucket_name}/{output_gcs_path}')
+            output_paths.append(storage_url(bucket, output_gcs_path))
 
-        return {
+        result = {
             'output_path': output_paths, # Always return a list of paths
             'output_sql': raw_generated_content, # Return raw_generated_content for all types for debugging if needed
             'result': 'SUCCESS'
         }
+        if transpilation_issues:
+            result['transpilation_issues'] = transpilation_issues
+        if catalog_issues:
+            result['catalog_issues'] = catalog_issues
+        if optimization_report is not None:
+            result['optimization'] = optimization_report.to_dict()
+        if materialization_config is not None and materialization_config.materialized != 'view':
+            result['materialization'] = materialization_config.to_dict()
+            if materialization_config.materialized == 'incremental' and 'is_incremental()' not in generated_content:
+                result['message'] = "The model is incremental but the generated SQL has no is_incremental() filter; every run will rescan the source."
+        return result
     except Exception as err:
         import traceback
         traceback.print_exc() # Print full stack trace for debugging
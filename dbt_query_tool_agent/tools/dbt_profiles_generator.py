@@ -1,19 +1,42 @@
+import asyncio
 import os
+from typing import Optional
 from urllib.parse import urlparse
 from google.adk.tools import FunctionTool
 from dbt_query_tool_agent import prompts
-from google.cloud import storage
-import pandas as pd
-from vertexai.generative_models import GenerativeModel
+from dbt_query_tool_agent.config import DBT_JOB_RETRIES, DBT_QUERY_PRIORITY, DBT_TIMEOUT_SECONDS, MAX_WAREHOUSE_CONCURRENCY
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.dbt_concurrency import DAG_FOLDERS, apply_execution_policy, dag_width, recommend_threads
+from dbt_query_tool_agent.services.ingestion import ingest_sttm
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.prompt_builder import PromptBuilder, project_sttm
+from dbt_query_tool_agent.services.sql_transpiler import read_sttm_table
+from dbt_query_tool_agent.services.repair_memo import REPAIR_MEMO
+from dbt_query_tool_agent.services.storage import INVALID_URL_MESSAGE, bucket_for_url, is_storage_url, storage_url
 import io
-from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, read_blob_bytes, blob_exists, write_blob
 from PIL import Image
 
-STORAGE_CLIENT = storage.Client()
-MODEL = 'gemini-2.5-flash'
 
-def generate_dbt_profiles_yml(
-    gcs_sttm_url: str
+def _estimate_threads(bucket, dbt_project_name: str) -> int:
+    """
+    Threads for the project as it is in storage now. A new project has no models
+    yet, so it gets the whole concurrency budget; dbt never uses more threads
+    than it has nodes ready to run.
+    """
+    prefix = f"{dbt_project_name}/dbt/"
+    files = {
+        blob.name[len(prefix):]: blob.download_as_bytes().decode('utf-8', errors='replace')
+        for folder in DAG_FOLDERS
+        for blob in bucket.list_blobs(prefix=f"{prefix}{folder}/")
+        if blob.name.endswith(('.sql', '.yml', '.yaml'))
+    }
+    width = max(dag_width(files, 'run'), dag_width(files, 'test'))
+    return recommend_threads(width) if width else MAX_WAREHOUSE_CONCURRENCY
+
+async def generate_dbt_profiles_yml(
+    gcs_sttm_url: str,
+    sheet_name: Optional[str] = None # For .xlsx mappings: the sheet holding the STTM (default: detected)
 ) -> dict:
     """
     Generates a dbt profiles.yml file by inferring details and saves it to GCS.
@@ -23,6 +46,9 @@ def generate_dbt_profiles_yml(
     2.  It infers the dbt project name from the GCS URL of the STTM file.
     3.  It inspects the STTM file content (CSV or image) to infer the BigQuery
         dataset name from table identifiers (e.g., 'project.dataset.table').
+    4.  It derives the dbt threads from the width of the project DAG, capped by
+        the warehouse concurrency budget, and applies the configured job
+        retry, priority and timeout policy.
 
     Args:
         gcs_sttm_url (str): The GCS URL of the source-to-target mapping (STTM)
@@ -35,8 +61,8 @@ def generate_dbt_profiles_yml(
         
     try:
         print(f"--- Executing Tool: generate_dbt_profiles_yml for GCS URL: {gcs_sttm_url} ---")
-        if not gcs_sttm_url.startswith('gs://'):
-            return {"error": "Invalid GCS URL. Must start with 'gs://'."}
+        if not is_storage_url(gcs_sttm_url):
+            return {"error": INVALID_URL_MESSAGE}
         
         # 1. Get Project ID from environment
         project_id = os.environ.get("GOOGLE_CLOUD_PROJECT") or os.environ.get("GCP_PROJECT")
@@ -44,41 +70,42 @@ def generate_dbt_profiles_yml(
             return {"error": "ERROR: GOOGLE_CLOUD_PROJECT or GCP_PROJECT environment variable not set."}
 
         parsed_url = urlparse(gcs_sttm_url)
-        bucket_name = parsed_url.netloc
         sttm_blob_name = parsed_url.path.lstrip('/')
         file_type = os.path.splitext(sttm_blob_name)[1].lower()
 
         # 2. Infer dataset name from STTM content by calling the LLM
-        sttm_blob = STORAGE_CLIENT.bucket(bucket_name).blob(sttm_blob_name)
-        if not sttm_blob.exists():
+        bucket = bucket_for_url(gcs_sttm_url)
+        sttm_blob = bucket.blob(sttm_blob_name)
+        if not await blob_exists(sttm_blob):
             return {"error": f"The specified STTM file does not exist at {gcs_sttm_url}"}
 
-        model_for_inference = GenerativeModel(MODEL)
-        inference_prompt_parts = [
+        model_for_inference = get_model('dataset_inference')
+        inference_prompt = PromptBuilder(
+            'dataset_inference',
             "Read the following file content and extract the BigQuery dataset name from a fully qualified table name like 'project.dataset.table'. Only return the single dataset name and nothing else."
-        ]
-        if file_type == '.csv':
-            inference_prompt_parts.append(sttm_blob.download_as_text())
-        elif file_type == '.xlsx':
-            df = pd.read_excel(io.BytesIO(sttm_blob.download_as_bytes()))
-            inference_prompt_parts.append(df.to_csv(index=False))
+        )
+        sttm_bytes = await read_blob_bytes(sttm_blob)
+        # An image is read once into CSV; every artifact then takes the text path.
+        sttm_bytes, file_type = await ingest_sttm(
+            bucket, infer_dbt_project_name_from_gcs_path(gcs_sttm_url), sttm_bytes, file_type, sheet_name
+        )
+        if file_type in ('.csv', '.xlsx'):
+            sttm_df = await asyncio.to_thread(read_sttm_table, sttm_bytes, file_type)
+            # The table identifiers are all the inference needs.
+            inference_prompt.add(sttm_bytes.decode('utf-8') if sttm_df is None else project_sttm(sttm_df, 'dataset_inference').to_csv(index=False))
         else: # Assume image for other types
             try:
-                image_bytes = sttm_blob.download_as_bytes()
-                inference_prompt_parts.append(Image.open(io.BytesIO(image_bytes)))
+                inference_prompt.add(Image.open(io.BytesIO(sttm_bytes)))
             except Image.UnidentifiedImageError:
                 return {"error": f"Unsupported file type: '{file_type}'. Please upload a CSV, XLSX, or a valid image file."}
 
-        inference_response = model_for_inference.generate_content(inference_prompt_parts)
+        inference_response = await llm_gateway.generate_content(model_for_inference, inference_prompt.build())
         dataset_name = inference_response.text.strip()
 
         # 3. Infer dbt project name from GCS path
         dbt_project_name = infer_dbt_project_name_from_gcs_path(gcs_sttm_url)
 
-        bucket = STORAGE_CLIENT.bucket(bucket_name)
-        
-        threads=1
-        timeout_seconds=300
+        threads = await asyncio.to_thread(_estimate_threads, bucket, dbt_project_name)
 
         # Craft the prompt for the LLM to generate profiles.yml
         llm_prompt_parts = [
@@ -90,21 +117,25 @@ def generate_dbt_profiles_yml(
             - BigQuery Project ID: {project_id}
             - BigQuery Dataset Name: {dataset_name}
             - Threads: {threads}
-            - Timeout Seconds: {timeout_seconds}
+            - Timeout Seconds: {DBT_TIMEOUT_SECONDS}
+            - Job Retries: {DBT_JOB_RETRIES}
+            - Priority: {DBT_QUERY_PRIORITY}
             
             Ensure the output is in YAML format within a markdown code block.
             """
         ]
 
-        response = model_for_inference.generate_content(llm_prompt_parts)
+        response = await llm_gateway.generate_content(get_model('yaml'), PromptBuilder('yaml', *llm_prompt_parts).build())
 
         # Extract the generated YAML content
         output_yml = response.text.replace('```yaml', '').replace('```', '').strip()
 
         # --- FIX: Programmatically correct common LLM errors ---
-        # The LLM sometimes incorrectly uses 'job_timeout_ms' instead of 'timeout_seconds'.
-        # This replacement ensures the generated profile is always valid for dbt-bigquery.
-        output_yml = output_yml.replace('job_timeout_ms', 'timeout_seconds')
+        # Known-bad output (e.g. 'job_timeout_ms' instead of 'timeout_seconds') is
+        # fixed by the repair memo's preventive rules.
+        output_yml = REPAIR_MEMO.apply_preventive_fixes('profiles.yml', output_yml)
+        # The execution settings are not left to the LLM.
+        output_yml = apply_execution_policy(output_yml, threads)
 
         # Construct the full output GCS path for profiles.yml (at the root of the dbt project)
         output_gcs_path = f"{dbt_project_name}/dbt/profiles.yml"
@@ -116,12 +147,12 @@ def generate_dbt_profiles_yml(
         }
         output_blob.metadata = tags
 
-        with output_blob.open('w') as file:
-            file.write(output_yml)
+        await write_blob(output_blob, output_yml)
 
         return {
-            'output_path': f'gs://{bucket_name}/{output_gcs_path}',
+            'output_path': storage_url(bucket, output_gcs_path),
             'output_yml_content': output_yml,
+            'threads': threads,
             'result': 'SUCCESS'
         }
     except Exception as err:
@@ -1,21 +1,18 @@
+import asyncio
 import os
 import vertexai
 from urllib.parse import urlparse
 from vertexai.generative_models import GenerativeModel, GenerationConfig
 from google.adk.tools import FunctionTool
-from google.cloud import storage
-STORAGE_CLIENT = storage.Client()
+from dbt_query_tool_agent.services.storage import download_prefix, is_storage_url, split_storage_url
 MODEL = 'gemini-2.5-flash'
 
-def deploy_dbt_project(gcs_bucket_path: str) -> dict:
+def _deploy_dbt_project(gcs_bucket_path: str) -> dict:
     try:
-        if not gcs_bucket_path.startswith('gs://'):
-            return "Invalid gcs URL"
+        if not is_storage_url(gcs_bucket_path):
+            return "Invalid storage URL"
         
-        bucket_name, project_name = gcs_bucket_path[5:].split('/', 1)
-
-        bucket = STORAGE_CLIENT.bucket(bucket_name)
-        blobs = bucket.list_blobs(prefix=project_name)
+        bucket, project_name = split_storage_url(gcs_bucket_path)
 
         # COMPUTING THE TARGET FOLDER
         target_folder = f'dbt_projects/{project_name}'
@@ -23,17 +20,8 @@ def deploy_dbt_project(gcs_bucket_path: str) -> dict:
         # CREATING TARGET DIRECTORY IF NOT EXIST
         os.makedirs(target_folder, exist_ok=True)
 
-        for blob in blobs:
-            relative_path = os.path.relpath(blob.name, project_name)
-            local_file_path = os.path.join(target_folder, relative_path)
-            local_file_dir = os.path.dirname(local_file_path)
-
-            # CREATE SUB-DIRECTORY IF NOT EXIST
-            os.makedirs(local_file_dir, exist_ok=True)
-
-            # DOWNLOAD THE FILE TO THE PATH
-            if not blob.name.endswith('/'):
-                blob.download_to_filename(local_file_path)
+        # DOWNLOAD EVERY FILE OF THE PROJECT, SEVERAL AT A TIME
+        download_prefix(bucket, project_name, target_folder)
         return {
                 'deployment_status': 'success',
                 'deployed_path': f'./dbt_projects/{project_name}'
@@ -43,4 +31,9 @@ def deploy_dbt_project(gcs_bucket_path: str) -> dict:
             'deployment_status': f'error - {str(err)}',
             'deployed_path': None
         }
+
+async def deploy_dbt_project(gcs_bucket_path: str) -> dict:
+    # The download loop is plain blocking GCS I/O, so run it on a worker thread.
+    return await asyncio.to_thread(_deploy_dbt_project, gcs_bucket_path)
+
 deploy_dbt_project_tool = FunctionTool(deploy_dbt_project)
\ No newline at end of file
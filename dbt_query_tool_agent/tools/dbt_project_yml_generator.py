@@ -1,35 +1,30 @@
 import os
 from typing import Optional
-from vertexai.generative_models import GenerativeModel
-from urllib.parse import urlparse
 from google.adk.tools import FunctionTool
 from dbt_query_tool_agent import prompts
-from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.storage import INVALID_URL_MESSAGE, bucket_for_url, is_storage_url, storage_url
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, write_blob
 
-from google.cloud import storage
-STORAGE_CLIENT = storage.Client()
-MODEL = 'gemini-2.5-flash'
-
-def generate_dbt_project_yml(
-    gcs_url: str, # GCS URL for the project root, e.g., gs://my-bucket/my-project/
+async def generate_dbt_project_yml(
+    gcs_url: str, # Storage URL for the project root, e.g., gs://my-bucket/my-project/ (or file://, mem://)
 ) -> dict:
     """
     Generates a dbt_project.yml file and saves it to the root of the dbt project in GCS.
     This tool does not require a source-to-target mapping file.
     """
     try:
-        if not gcs_url.startswith('gs://'):
-            return {"error": "Invalid GCS URL. Must start with 'gs://'."}
+        if not is_storage_url(gcs_url):
+            return {"error": INVALID_URL_MESSAGE}
 
-        parsed_url = urlparse(gcs_url)
-        bucket_name = parsed_url.netloc
         dbt_project_name = infer_dbt_project_name_from_gcs_path(gcs_url)
 
         if not dbt_project_name:
             return {"error": "Could not determine dbt_project_name from GCS URL."}
 
-        bucket = STORAGE_CLIENT.bucket(bucket_name)
-        model = GenerativeModel(MODEL)
+        bucket = bucket_for_url(gcs_url)
+        model = get_model('yaml')
 
         # The prompt is self-contained and uses the project name.
         llm_prompt = [
@@ -38,7 +33,7 @@ def generate_dbt_project_yml(
             f"\nGenerate the dbt_project.yml content for a project named: '{dbt_project_name}'"
         ]
 
-        response = model.generate_content(llm_prompt)
+        response = await llm_gateway.generate_content(model, llm_prompt)
 
         # Extract the generated YAML content
         output_yml = response.text.replace('```yaml', '').replace('```', '').strip()
@@ -53,11 +48,10 @@ def generate_dbt_project_yml(
         }
         output_blob.metadata = tags
 
-        with output_blob.open('w') as file:
-            file.write(output_yml)
+        await write_blob(output_blob, output_yml)
 
         return {
-            'output_path': f'gs://{bucket_name}/{output_gcs_path}',
+            'output_path': storage_url(bucket, output_gcs_path),
             'result': 'SUCCESS'
         }
     except Exception as err:
@@ -1,20 +1,25 @@
+import asyncio
 import io
 import os
-import pandas as pd
 from PIL import Image
 from urllib.parse import urlparse
-from vertexai.generative_models import GenerativeModel
 from google.adk.tools import FunctionTool
 from dbt_query_tool_agent import prompts
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.ingestion import ingest_sttm
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.prompt_builder import PromptBuilder, project_sttm, sttm_part
+from dbt_query_tool_agent.services.sql_transpiler import read_sttm_table
+from dbt_query_tool_agent.services.storage import INVALID_URL_MESSAGE, bucket_for_url, is_storage_url, storage_url
 from typing import Optional
-from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, read_blob_bytes, blob_exists, write_blob
 
-from google.cloud import storage
 SCHEMA_YML_PROMPT_INSTRUCTIONS = prompts.DBT_SCHEMA_YML_PROMPT
 
-def generate_dbt_schema_yml(
+async def generate_dbt_schema_yml(
     gcs_url: str, # GCS URL to the source-to-target mapping (CSV or Image)
-    dbt_project_name: Optional[str] = None # Optional: user can provide if not inferrable from GCS URL
+    dbt_project_name: Optional[str] = None, # Optional: user can provide if not inferrable from GCS URL
+    sheet_name: Optional[str] = None # For .xlsx mappings: the sheet holding the STTM (default: detected)
 ) -> dict:
     """
     Generates a dbt schema.yml file from a source-to-target mapping
@@ -22,12 +27,10 @@ def generate_dbt_schema_yml(
     """
     try:
         print(f"--- Executing Tool: generate_dbt_schema_yml for GCS URL: {gcs_url} ---")
-        storage_client = storage.Client()
-        if not gcs_url.startswith('gs://'):
-            return {"error": "Invalid GCS URL. Must start with 'gs://'."}
+        if not is_storage_url(gcs_url):
+            return {"error": INVALID_URL_MESSAGE}
         
         parsed_url = urlparse(gcs_url)
-        bucket_name = parsed_url.netloc
         # This blob_name correctly represents the path without the bucket.
         blob_name = parsed_url.path.lstrip('/') # e.g. 'gradio_uploads/.../file.csv'
 
@@ -39,15 +42,18 @@ def generate_dbt_schema_yml(
         if not final_dbt_project_name:
              return {"error": "Could not determine dbt project name from GCS URL."}
 
-        bucket = storage_client.bucket(bucket_name)
+        bucket = bucket_for_url(gcs_url)
         blob = bucket.blob(blob_name)
 
-        model = GenerativeModel('gemini-2.5-flash')
+        model = get_model('yaml')
 
-        if not blob.exists():
+        if not await blob_exists(blob):
             return {'error': 'Object not available at input path'}
         
-        bytes_content = blob.download_as_bytes()
+        bytes_content = await read_blob_bytes(blob)
+        # An image is read once into CSV; every artifact then takes the text path.
+        file_type = os.path.splitext(blob_name)[1].lower()
+        bytes_content, file_type = await ingest_sttm(bucket, final_dbt_project_name, bytes_content, file_type, sheet_name)
         
         # --- FIX: Prepare the prompt using specific prompts module variables ---
         llm_prompt_parts = [
@@ -57,22 +63,22 @@ def generate_dbt_schema_yml(
         ]
 
         # Add input content (CSV or Image)
-        file_type = os.path.splitext(blob_name)[1].lower()
-        if file_type == '.csv':
-            file_content = bytes_content.decode('utf-8')
-            llm_prompt_parts.append(f"\n--- Input CSV Content for Schema Inference ---\n{file_content}\n--- End Input CSV Content ---")
-        elif file_type == '.xlsx':
-            df = pd.read_excel(io.BytesIO(bytes_content))
-            csv_string = df.to_csv(index=False)
-            llm_prompt_parts.append(f"\n--- Input Excel (converted to CSV) Content for Schema Inference ---\n{csv_string}\n--- End Input Excel Content ---")
+        prompt = PromptBuilder('yaml', *llm_prompt_parts)
+        if file_type in ('.csv', '.xlsx'):
+            sttm_df = await asyncio.to_thread(read_sttm_table, bytes_content, file_type)
+            if sttm_df is None:
+                prompt.add(sttm_part(bytes_content.decode('utf-8'), "Input CSV Content for Schema Inference"))
+            else:
+                # schema.yml only needs the table identifiers, once per table.
+                prompt.add_sttm(project_sttm(sttm_df, 'schema_yml'), "Input CSV Content for Schema Inference")
         else: # Assume image for other types
             try:
                 image = Image.open(io.BytesIO(bytes_content))
-                llm_prompt_parts.append(image)
+                prompt.add(image)
             except Image.UnidentifiedImageError:
                 return {"error": f"Unsupported file type: '{file_type}'. Please upload a CSV, XLSX, or a valid image file."}
 
-        response = model.generate_content(llm_prompt_parts)
+        response = await llm_gateway.generate_content(model, prompt.build())
 
         # --- FIX: Robustly parse the LLM output to extract only the YAML content ---
         raw_text = response.text
@@ -100,11 +106,10 @@ def generate_dbt_schema_yml(
         }
         output_blob.metadata = tags
 
-        with output_blob.open('w') as file:
-            file.write(output_yml)
+        await write_blob(output_blob, output_yml)
 
         return {
-            'output_path': f'gs://{bucket_name}/{output_gcs_path}',
+            'output_path': storage_url(bucket, output_gcs_path),
             'output_yml_content': output_yml,
             'result': 'SUCCESS'
         }
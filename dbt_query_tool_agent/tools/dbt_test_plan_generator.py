@@ -1,31 +1,43 @@
+import asyncio
 import io
 import os
-from typing import Optional, List
+from typing import Dict, Optional, List
 from PIL import Image
 from urllib.parse import urlparse
-from vertexai.generative_models import GenerativeModel
 from google.adk.tools import FunctionTool
 # Assuming prompts.py is accessible in the same module path
 from dbt_query_tool_agent import prompts
-from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
+from dbt_query_tool_agent.services import llm_gateway
+from dbt_query_tool_agent.services.context_cache import CONTEXT_CACHE, sttm_prefix
+from dbt_query_tool_agent.services.ingestion import ingest_sttm
+from dbt_query_tool_agent.services.model_router import get_model
+from dbt_query_tool_agent.services.prompt_builder import PromptBuilder, project_sttm, sttm_part
+from dbt_query_tool_agent.services.sql_transpiler import format_transpilation_issues, read_sttm_table, transpile_sttm
+from dbt_query_tool_agent.services.storage import INVALID_URL_MESSAGE, bucket_for_url, is_storage_url, storage_url
+from dbt_query_tool_agent.services.sttm import find_column
+from dbt_query_tool_agent.services.test_plan_rules import build_rule_based_test_cases, derivation_rows
+from dbt_query_tool_agent.services.structured_output import (
+    TEST_CASES_RESPONSE_SCHEMA, TEST_PLAN_COLUMNS, TestCase, decode_items, split_json_array,
+)
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, read_blob_bytes, blob_exists, write_blob
 import pandas as pd
-from google.cloud import storage
+# How many correction rounds are spent on malformed test cases.
+TEST_PLAN_REPAIR_ATTEMPTS = 2
 
-def generate_dbt_test_case_sheet(
+async def generate_dbt_test_case_sheet(
     gcs_url: str,
-    output_format: str = "csv" # Can be 'csv' or 'xlsx' (requires openpyxl setup)
+    output_format: str = "csv", # Can be 'csv' or 'xlsx' (requires openpyxl setup)
+    sheet_name: Optional[str] = None # For .xlsx mappings: the sheet holding the STTM (default: detected)
 ) -> dict:
     """
     Generates a DBT test case sheet in the specified format (CSV or XLSX)
     from a source-to-target mapping file (image/CSV) located at a GCS URL.
     """
     try:
-        storage_client = storage.Client()
-        if not gcs_url.startswith('gs://'):
-            return {"error": "Invalid GCS URL. Please provide a path starting with gs://"}
+        if not is_storage_url(gcs_url):
+            return {"error": INVALID_URL_MESSAGE}
 
         parsed_url = urlparse(gcs_url)
-        bucket_name = parsed_url.netloc
         blob_name = parsed_url.path.lstrip('/')
 
         dbt_project_name = infer_dbt_project_name_from_gcs_path(gcs_url)
@@ -36,35 +48,129 @@ def generate_dbt_test_case_sheet(
         base_file_name = dbt_project_name
         file_type = os.path.splitext(file_name_with_ext)[1].lower()
 
-        bucket = storage_client.bucket(bucket_name)
+        bucket = bucket_for_url(gcs_url)
         blob = bucket.blob(blob_name)
 
-        model = GenerativeModel('gemini-2.5-flash')
+        model = get_model('test_plan', response_schema=TEST_CASES_RESPONSE_SCHEMA)
 
-        if not blob.exists():
+        if not await blob_exists(blob):
             return {'error': f'Object not available at input path: {gcs_url}'}
 
-        bytes_content = blob.download_as_bytes()
-
-        llm_prompt_parts = [prompts.GENERAL_PARSING_INSTRUCTIONS]
-        llm_prompt_parts.append(prompts.DBT_TEST_CASE_SHEET_PROMPT) # Use the specific prompt
-
-        if file_type == '.csv':
-            file_content = bytes_content.decode('utf-8')
-            llm_prompt_parts.append(f"\n--- Input CSV Content for Inference ---\n{file_content}\n--- End Input CSV Content ---")
-        elif file_type == '.xlsx':
-            df = pd.read_excel(io.BytesIO(bytes_content))
-            csv_string = df.to_csv(index=False)
-            llm_prompt_parts.append(f"\n--- Input Excel (converted to CSV) Content for Inference ---\n{csv_string}\n--- End Input Excel Content ---")
+        bytes_content = await read_blob_bytes(blob)
+        # An image is read once into CSV; every artifact then takes the text path.
+        bytes_content, file_type = await ingest_sttm(bucket, dbt_project_name, bytes_content, file_type, sheet_name)
+
+        prompt = PromptBuilder('test_plan', prompts.GENERAL_PARSING_INSTRUCTIONS, prompts.DBT_TEST_CASE_SHEET_PROMPT)
+
+        transpilation_issues: List[dict] = []
+        rule_based_cases: List[TestCase] = []
+        needs_llm = True
+        # One entry per LLM call: large mappings are split to fit the prompt budget.
+        sttm_chunks: List[str] = ['']
+        # Leading parts shared with the model SQL generator, sent through the context cache.
+        cached_prefix_length = 0
+        if file_type in ('.csv', '.xlsx'):
+            sttm_df = await asyncio.to_thread(read_sttm_table, bytes_content, file_type)
+            if sttm_df is None:
+                sttm_chunks = [sttm_part(bytes_content.decode('utf-8'))]
+            else:
+                # Key, join-key and direct-mapping checks follow from the mapping itself;
+                # only the rows with a derivation rule are left to the LLM.
+                rule_based_cases = build_rule_based_test_cases(sttm_df, base_file_name)
+                converted_df, converted_issues = await asyncio.to_thread(transpile_sttm, sttm_df)
+                prefix = sttm_prefix(prompts.GENERAL_PARSING_INSTRUCTIONS, converted_df)
+                cached_prompt = PromptBuilder('test_plan', *prefix, prompts.DBT_TEST_CASE_SHEET_PROMPT)
+                if CONTEXT_CACHE.accepts('test_plan', prefix) and cached_prompt.remaining() > 0:
+                    # The whole mapping is already cached for the model SQL: reading it from
+                    # the cache and naming the derivation targets is cheaper than resending
+                    # only the derivation rows.
+                    prompt, cached_prefix_length, transpilation_issues = cached_prompt, len(prefix), converted_issues
+                    if rule_based_cases:
+                        derivations = derivation_rows(sttm_df)
+                        needs_llm = not derivations.empty
+                        # Rule-based cases imply a target column (see parse_mappings).
+                        targets = derivations[find_column(sttm_df, 'target column', 'target column(s)')].dropna().astype(str)
+                        prompt.add(prompts.DBT_TEST_CASE_SHEET_TARGET_SCOPE.format(target_columns=", ".join(dict.fromkeys(targets))))
+                        prompt.add(f"\n**IMPORTANT**: The model being tested is named '{base_file_name}'.")
+                    if transpilation_issues:
+                        print(f"Warning: {len(transpilation_issues)} transformation logic cell(s) could not be converted to BigQuery automatically.")
+                        prompt.add(format_transpilation_issues(transpilation_issues))
+                else:
+                    # Derivation rules go into the plan already converted to BigQuery.
+                    transpilation_issues = converted_issues
+                    if rule_based_cases:
+                        derivations = derivation_rows(sttm_df)
+                        # Issue rows are renumbered to the positions of the rows that are kept.
+                        positions = {index: position for position, index in enumerate(derivations.index, start=1)}
+                        transpilation_issues = [
+                            {**issue, 'row': positions[sttm_df.index[issue['row'] - 1]]}
+                            for issue in converted_issues if sttm_df.index[issue['row'] - 1] in positions
+                        ]
+                        converted_df = converted_df.loc[derivations.index]
+                        needs_llm = not derivations.empty
+                        prompt.add(prompts.DBT_TEST_CASE_SHEET_DERIVATION_SCOPE)
+                        prompt.add(f"\n**IMPORTANT**: The model being tested is named '{base_file_name}'.")
+                    sttm_df = converted_df
+                    if transpilation_issues:
+                        print(f"Warning: {len(transpilation_issues)} transformation logic cell(s) could not be converted to BigQuery automatically.")
+                        prompt.add(format_transpilation_issues(transpilation_issues))
+                    sttm_chunks = [sttm_part(chunk) for chunk in prompt.split_sttm(project_sttm(sttm_df, 'test_plan'))]
         else: # Assume image for other types
             try:
                 image = Image.open(io.BytesIO(bytes_content))
-                llm_prompt_parts.append(image)
+                prompt.add(image)
             except Image.UnidentifiedImageError:
                 return {"error": f"Unsupported file type: '{file_type}'. Please upload a CSV, XLSX, or a valid image file."}
 
-        response = model.generate_content(llm_prompt_parts)
-        raw_generated_content = response.text.strip()
+        raw_outputs: List[str] = []
+        if needs_llm:
+            async def request(chunk: str):
+                chunk_model, parts = await CONTEXT_CACHE.bind('test_plan', prompt.build(chunk), cached_prefix_length, TEST_CASES_RESPONSE_SCHEMA)
+                return await llm_gateway.generate_content(chunk_model, parts)
+
+            responses = await asyncio.gather(*(request(chunk) for chunk in sttm_chunks))
+            raw_outputs = [response.text.strip() for response in responses]
+        else:
+            print("All STTM rows are covered by rule-based test cases; skipping the LLM.")
+        raw_generated_content = "\n".join(raw_outputs)
+
+        # --- Decode the schema-constrained JSON into typed test cases ---
+        # Malformed rows are sent back on their own for correction instead of
+        # regenerating the whole sheet.
+        test_cases, invalid_items = [], []
+        for raw_output in raw_outputs:
+            decoded_cases, decoded_invalid = decode_items(split_json_array(raw_output), TestCase)
+            test_cases.extend(decoded_cases)
+            invalid_items.extend(decoded_invalid)
+        for attempt in range(TEST_PLAN_REPAIR_ATTEMPTS):
+            if not invalid_items:
+                break
+            print(f"Warning: {len(invalid_items)} malformed test case(s) in the LLM output; requesting corrections (attempt {attempt + 1}).")
+            repair_prompt = [
+                prompts.DBT_TEST_CASE_SHEET_PROMPT,
+                "\n**CORRECTION REQUEST**: The following test cases failed validation. Return a JSON array containing ONLY the corrected versions of these test cases, keeping their meaning:\n"
+                + "\n".join(f"- {raw}\n  Validation error: {error}" for raw, error in invalid_items)
+            ]
+            repair_response = await llm_gateway.generate_content(model, repair_prompt)
+            repaired_cases, invalid_items = decode_items(split_json_array(repair_response.text.strip()), TestCase)
+            test_cases.extend(repaired_cases)
+        if invalid_items:
+            print(f"Warning: dropping {len(invalid_items)} test case(s) that are still malformed after correction.")
+
+        # Keep the first occurrence of each Test ID, in order; rule-based rows come first.
+        seen_cases: Dict[str, TestCase] = {}
+        for case in rule_based_cases + test_cases:
+            seen_cases.setdefault(case.test_id, case)
+        unique_cases = list(seen_cases.values())
+        dropped_ids = [case.test_id for case in test_cases if seen_cases[case.test_id] is not case]
+        if dropped_ids:
+            print(f"Warning: dropping {len(dropped_ids)} LLM test case(s) with a duplicate Test ID: {', '.join(dropped_ids)}")
+        if not unique_cases:
+            return {'error': 'The LLM did not return any valid test cases.', 'raw_llm_output': raw_generated_content, 'result': 'ERROR'}
+        df = pd.DataFrame(
+            [[getattr(case, field) for _, field in TEST_PLAN_COLUMNS] for case in unique_cases],
+            columns=[header for header, _ in TEST_PLAN_COLUMNS],
+        )
 
         # Define output folder and file name
         dbt_folder = "test_plans"
@@ -73,31 +179,18 @@ def generate_dbt_test_case_sheet(
 
         if output_format == "csv":
             output_extension = ".csv"
-            try:
-                # Attempt to parse as CSV; if it fails, save raw content
-                df = pd.read_csv(io.StringIO(raw_generated_content))
-                final_content = df.to_csv(index=False)
-            except Exception as e:
-                print(f"Warning: LLM did not produce perfect CSV for test case sheet. Saving raw text. Error: {e}")
-                final_content = raw_generated_content # Fallback to raw text if CSV parsing fails
+            final_content = df.to_csv(index=False)
         elif output_format == "xlsx":
             output_extension = ".xlsx"
             # This part requires openpyxl. Without it, this will fail.
             # You'd typically need to ensure 'openpyxl' is installed in the environment.
             try:
-                # Attempt to parse as CSV first, then convert to XLSX
-                df = pd.read_csv(io.StringIO(raw_generated_content))
                 output_buffer = io.BytesIO()
                 with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
                     df.to_excel(writer, index=False, sheet_name='Test Cases')
                 final_content = output_buffer.getvalue() # Get bytes for XLSX
             except ImportError:
                 return {'error': 'openpyxl is not installed. Cannot generate XLSX. Please use CSV format or install openpyxl.', 'result': 'ERROR'}
-            except Exception as e:
-                print(f"Warning: Failed to convert to XLSX. Saving raw text as CSV instead. Error: {e}")
-                # Fallback to CSV if XLSX conversion fails for other reasons
-                output_extension = ".csv"
-                final_content = raw_generated_content.encode('utf-8') # Ensure bytes for GCS write
         else:
             return {'error': 'Unsupported output format. Please choose "csv" or "xlsx".', 'result': 'ERROR'}
 
@@ -112,14 +205,16 @@ def generate_dbt_test_case_sheet(
 
         # Handle writing based on content type (bytes for XLSX, string for CSV)
         if output_format == "xlsx":
-            output_blob.upload_from_string(final_content, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            await write_blob(output_blob, final_content, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         else: # CSV
-            output_blob.upload_from_string(final_content, content_type='text/csv')
+            await write_blob(output_blob, final_content, content_type='text/csv')
 
-        output_paths.append(f'gs://{bucket_name}/{output_gcs_path}')
+        output_paths.append(storage_url(bucket, output_gcs_path))
 
         return {
             'downloadable_gcs_path': output_paths[0] if output_paths else None,
+            'test_case_count': len(unique_cases),
+            'rule_based_test_case_count': len(rule_based_cases),
             'raw_llm_output': raw_generated_content, # Useful for debugging LLM's raw response
             'result': 'SUCCESS'
         }
@@ -1,33 +1,109 @@
+import asyncio
 import io
 import os
 import json
 from typing import List, Dict # Kept for internal type clarity
 from urllib.parse import urlparse
 import pandas as pd
-from google.cloud import storage
 from google.adk.tools import FunctionTool
-from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
+from dbt_query_tool_agent.services.report_writer import REPORT_FORMATS, write_report
+from dbt_query_tool_agent.services.storage import bucket_for_url, storage_url
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path, read_blob_bytes, blob_exists
 
-def generate_dbt_test_report(
+# Test result fields and the report columns they fill.
+RESULT_COLUMNS = {
+    'status': 'Status',
+    'message': 'Failure Reason',
+    'execution_time': 'Execution Time (s)',
+    'bytes_processed': 'Bytes Processed',
+    'executed_in': 'Executed In',
+}
+# How many runs the summary lists per ranking.
+SUMMARY_TOP_N = 10
+
+
+def _read_test_plan(bytes_content: bytes, file_type: str) -> pd.DataFrame:
+    if file_type == '.xlsx':
+        return pd.read_excel(io.BytesIO(bytes_content), dtype=str)
+    return pd.read_csv(io.BytesIO(bytes_content), dtype=str)
+
+
+def _build_report(test_plan_df: pd.DataFrame, test_results_list: List[Dict]) -> pd.DataFrame:
+    """Left-joins the test results onto the test plan by Test ID."""
+    results_df = pd.DataFrame(test_results_list).reindex(columns=['test_name', *RESULT_COLUMNS])
+    results_df = results_df.rename(columns={'test_name': 'Test ID', **RESULT_COLUMNS})
+    results_df['Test ID'] = results_df['Test ID'].astype(str)
+    # A repeated test name keeps its last result.
+    results_df = results_df.drop_duplicates(subset='Test ID', keep='last')
+
+    # Result columns of an earlier report are replaced rather than duplicated.
+    report_df = test_plan_df.drop(columns=[column for column in RESULT_COLUMNS.values() if column in test_plan_df.columns])
+    report_df = report_df.assign(**{'Test ID': report_df['Test ID'].astype(str)})
+    report_df = report_df.merge(results_df, on='Test ID', how='left', validate='many_to_one')
+
+    report_df['Status'] = report_df['Status'].fillna('NOT RUN')
+    report_df['Failure Reason'] = report_df['Failure Reason'].fillna('').where(report_df['Status'] != 'PASS', '')
+    report_df['Execution Time (s)'] = pd.to_numeric(report_df['Execution Time (s)'], errors='coerce')
+    report_df['Bytes Processed'] = pd.to_numeric(report_df['Bytes Processed'], errors='coerce').astype('Int64')
+    # Results without a node name (older runner output) count as their own run.
+    report_df['Executed In'] = report_df['Executed In'].fillna(report_df['Test ID'].where(report_df['Execution Time (s)'].notna()))
+    return report_df
+
+
+def _build_summary(report_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Ranks the executed queries by execution time and by bytes processed. Tests
+    sharing one query (consolidated checks) are listed together, since they
+    share its cost.
+    """
+    runs_df = (
+        report_df.dropna(subset=['Executed In'])
+        .assign(failed=lambda df: df['Status'] != 'PASS')
+        .groupby('Executed In', sort=False)
+        .agg(**{
+            'Test IDs': ('Test ID', ', '.join),
+            'Failed Tests': ('failed', 'sum'),
+            'Execution Time (s)': ('Execution Time (s)', 'max'),
+            'Bytes Processed': ('Bytes Processed', 'max'),
+        })
+        .reset_index()
+    )
+    rankings = [
+        runs_df.dropna(subset=['Execution Time (s)']).nlargest(SUMMARY_TOP_N, 'Execution Time (s)').assign(Ranking='Slowest'),
+        runs_df.dropna(subset=['Bytes Processed']).nlargest(SUMMARY_TOP_N, 'Bytes Processed').assign(Ranking='Most bytes processed'),
+    ]
+    summary_df = pd.concat(rankings, ignore_index=True)
+    summary_df.insert(0, 'Rank', summary_df.groupby('Ranking').cumcount() + 1)
+    summary_df.insert(0, 'Ranking', summary_df.pop('Ranking'))
+    return summary_df
+
+
+async def generate_dbt_test_report(
     test_plan_gcs_path: str,
-    test_results: str
+    test_results: str,
+    output_format: str = "csv" # 'csv', 'xlsx' or 'parquet'
 ) -> dict:
     """
     Generates a test report by merging dbt test results with the original test plan.
 
     Args:
-        test_plan_gcs_path (str): The GCS URL of the test plan CSV file.
+        test_plan_gcs_path (str): The GCS URL of the test plan CSV or XLSX file.
         test_results (str): A JSON string representing a list of dictionaries from the
                             test runner tool. Each dict should have keys: 'test_name',
-                            'status', 'message'.
+                            'status', 'message', and optionally 'execution_time',
+                            'bytes_processed' and 'executed_in'.
+        output_format (str): 'csv', 'xlsx' or 'parquet'. XLSX reports hold the
+                             summary as a second sheet; for CSV and Parquet it is
+                             written to a separate file.
 
     Returns:
         dict: A dictionary containing the GCS path of the generated test report,
               which can be used for downloading.
     """
     try:
-        storage_client = storage.Client()
-        
+        if output_format not in REPORT_FORMATS:
+            return {'result': 'ERROR', 'message': f"Unsupported output format. Please choose one of: {', '.join(REPORT_FORMATS)}."}
+
         # Parse the JSON string into a Python object
         try:
             test_results_list = json.loads(test_results)
@@ -36,46 +112,44 @@ def generate_dbt_test_report(
 
         # Download the original test plan
         parsed_url = urlparse(test_plan_gcs_path)
-        bucket_name = parsed_url.netloc
         blob_name = parsed_url.path.lstrip('/')
         
-        bucket = storage_client.bucket(bucket_name)
+        bucket = bucket_for_url(test_plan_gcs_path)
         blob = bucket.blob(blob_name)
         
-        if not blob.exists():
+        if not await blob_exists(blob):
             return {'error': f'Test plan not found at: {test_plan_gcs_path}'}
             
-        test_plan_df = pd.read_csv(io.BytesIO(blob.download_as_bytes()))
-        
-        # Create a dictionary from the test results for easy lookup
-        results_map = {result['test_name']: result for result in test_results_list}
-        
-        # Add new columns for results
-        test_plan_df['Status'] = 'NOT RUN'
-        test_plan_df['Failure Reason'] = ''
-        
-        # Populate results based on the 'Test ID' matching the test name
-        for index, row in test_plan_df.iterrows():
-            test_id = str(row['Test ID'])
-            if test_id in results_map:
-                result = results_map[test_id]
-                test_plan_df.at[index, 'Status'] = result['status']
-                if result['status'] != 'PASS':
-                    test_plan_df.at[index, 'Failure Reason'] = result.get('message', '')
-
-        # Save the report to a new CSV file in GCS
-        report_content = test_plan_df.to_csv(index=False)
-        
+        file_type = os.path.splitext(blob_name)[1].lower()
+        test_plan_df = await asyncio.to_thread(_read_test_plan, await read_blob_bytes(blob), file_type)
+        report_df = _build_report(test_plan_df, test_results_list)
+        summary_df = _build_summary(report_df)
+
         dbt_project_name = infer_dbt_project_name_from_gcs_path(test_plan_gcs_path)
-        report_gcs_path = f"{dbt_project_name}/test_reports/{dbt_project_name}_test_report.csv"
-        report_blob = bucket.blob(report_gcs_path)
-        
-        report_blob.upload_from_string(report_content, content_type='text/csv')
-        
-        return {
+        output_extension = REPORT_FORMATS[output_format][0]
+        report_gcs_path = f"{dbt_project_name}/test_reports/{dbt_project_name}_test_report{output_extension}"
+        summary_gcs_path = None
+        if output_format == 'xlsx':
+            await asyncio.to_thread(write_report, bucket.blob(report_gcs_path), {'Test Report': report_df, 'Summary': summary_df}, output_format)
+        else:
+            summary_gcs_path = f"{dbt_project_name}/test_reports/{dbt_project_name}_test_report_summary{output_extension}"
+            await asyncio.gather(
+                asyncio.to_thread(write_report, bucket.blob(report_gcs_path), {'Test Report': report_df}, output_format),
+                asyncio.to_thread(write_report, bucket.blob(summary_gcs_path), {'Summary': summary_df}, output_format),
+            )
+
+        # Consolidated checks share one query, so totals count each query once.
+        runs_df = report_df.dropna(subset=['Executed In']).drop_duplicates(subset='Executed In')
+        response = {
             'result': 'SUCCESS',
-            'downloadable_gcs_path': f'gs://{bucket_name}/{report_gcs_path}'
+            'downloadable_gcs_path': storage_url(bucket, report_gcs_path),
+            'total_execution_time': round(float(runs_df['Execution Time (s)'].sum()), 3),
+            'total_bytes_processed': int(runs_df['Bytes Processed'].sum()),
+            'slowest_tests': summary_df[summary_df['Ranking'] == 'Slowest'].head(3)['Test IDs'].tolist(),
         }
+        if summary_gcs_path:
+            response['summary_gcs_path'] = storage_url(bucket, summary_gcs_path)
+        return response
 
     except Exception as e:
         import traceback
@@ -1,120 +1,252 @@
+import asyncio
 import os
 import subprocess
 import re
 from google.adk.tools import FunctionTool
-from google.cloud import storage
-from urllib.parse import urlparse
 import shutil
 import sys
+import threading
 from io import StringIO
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from dbt.cli.main import dbtRunner
+from dbt_query_tool_agent.services.dbt_concurrency import dag_width, read_project_files, recommend_threads
+from dbt_query_tool_agent.services.perf_profile import build_profile, save_profile
+from dbt_query_tool_agent.services.repair_memo import REPAIR_MEMO, repaired_file_key
+from dbt_query_tool_agent.services.storage import (
+    INVALID_URL_MESSAGE, download_prefix, is_storage_url, local_directory, split_storage_url, storage_url,
+)
+from dbt_query_tool_agent.services.test_consolidation import (
+    CONSOLIDATED_FOLDER, CONSOLIDATED_PREFIX, consolidated_test_ids, expand_consolidated_results,
+)
+from dbt_query_tool_agent.services.test_sampling import describe_sample, install_sample_macro
+from dbt_query_tool_agent.utils import infer_dbt_project_name_from_gcs_path
 
-def run_unit_testing_dbt_project(dbt_project_gcs_path: str, dbt_command: str, model_name: Optional[str] = None) -> dict:
+# dbtRunner is not safe to invoke concurrently within one process (it also swaps
+# sys.stdout below), so invocations are serialized while the event loop stays free.
+_DBT_INVOCATION_LOCK = threading.Lock()
+# Consolidated queries return one row per Test ID; `dbt show` previews 5 rows by default.
+CONSOLIDATED_SHOW_LIMIT = 100000
+
+
+def _run_stats(node_result, executed_in: str) -> dict:
+    """Timing and cost of one executed node, as reported in the test results."""
+    adapter_response = getattr(node_result, 'adapter_response', None) or {}
+    return {
+        "execution_time": round(getattr(node_result, 'execution_time', None) or 0.0, 3),
+        "bytes_processed": adapter_response.get('bytes_processed'),
+        "executed_in": executed_in,
+    }
+
+def _invoke_dbt(dbt, cli_args: List[str]):
+    """Runs one dbt invocation with its output captured. Returns (dbtRunnerResult, full log)."""
+    _DBT_INVOCATION_LOCK.acquire()
+    old_stdout = sys.stdout
+    old_stderr = sys.stderr
+    sys.stdout = captured_stdout = StringIO()
+    sys.stderr = captured_stderr = StringIO()
+
+    result = None
+    try:
+        print(f"Executing dbt command programmatically: dbt {' '.join(cli_args)}")
+        result = dbt.invoke(cli_args)
+    finally:
+        stdout_val = captured_stdout.getvalue()
+        stderr_val = captured_stderr.getvalue()
+        sys.stdout = old_stdout
+        sys.stderr = old_stderr
+        _DBT_INVOCATION_LOCK.release()
+        print(f"--- Captured dbt stdout ---\n{stdout_val}\n--- End dbt stdout ---")
+        if stderr_val:
+            print(f"--- Captured dbt stderr ---\n{stderr_val}\n--- End dbt stderr ---")
+
+    full_log = stdout_val
+    if stderr_val:
+        full_log += "\n--- STDERR ---\n" + stderr_val
+    return result, full_log
+
+
+def _file_outcomes(run_results, outcomes: Dict[str, bool]) -> Dict[str, bool]:
+    """
+    Adds to `outcomes` whether every executed node of each project file ran
+    (True) or one of them errored (False). Failing and skipped tests say nothing
+    about the file itself and are left out.
+    """
+    for res in getattr(run_results, 'results', None) or []:
+        file_path = getattr(getattr(res, 'node', None), 'original_file_path', None)
+        status = str(res.status).lower()
+        if not file_path or status not in ('success', 'pass', 'warn', 'error'):
+            continue
+        outcomes[file_path] = outcomes.get(file_path, True) and status != 'error'
+    return outcomes
+
+
+def _settle_repairs(dbt_project_gcs_path: str, outcomes: Dict[str, bool]) -> None:
+    """Learns the pending repair patches of the files that now run and discards those of files that still error."""
+    for file_path, succeeded in outcomes.items():
+        if REPAIR_MEMO.settle(repaired_file_key(dbt_project_gcs_path, file_path), succeeded):
+            print(f"Learned the repair of {file_path}: it ran successfully.")
+
+
+def _run_consolidated_checks(dbt, project_dir: str, model_name: Optional[str] = None, extra_args: Optional[List[str]] = None,
+                             outcomes: Optional[Dict[str, bool]] = None) -> Tuple[List[dict], bool, str]:
+    """
+    Runs the consolidated check queries in `analyses/` (only those of
+    `model_name`, if given) with `dbt show` and expands their rows into
+    per-Test-ID results. Whether each query ran is added to `outcomes`.
+
+    Returns:
+        The test results, whether every query ran, and the dbt log.
+    """
+    analyses_dir = os.path.join(project_dir, CONSOLIDATED_FOLDER)
+    query_files = sorted(
+        file_name for file_name in (os.listdir(analyses_dir) if os.path.isdir(analyses_dir) else [])
+        if file_name.startswith(f"{CONSOLIDATED_PREFIX}{model_name}_" if model_name else CONSOLIDATED_PREFIX)
+        and file_name.endswith('.sql')
+    )
+    test_results, success, logs = [], True, []
+    for file_name in query_files:
+        with open(os.path.join(analyses_dir, file_name), 'r', encoding='utf-8') as f:
+            expected_test_ids = consolidated_test_ids(f.read())
+        node_name = os.path.splitext(file_name)[0]
+        cli_args = ["show", "--select", node_name, "--limit", str(CONSOLIDATED_SHOW_LIMIT),
+                    "--project-dir", project_dir, "--profiles-dir", project_dir] + (extra_args or [])
+        result, full_log = _invoke_dbt(dbt, cli_args)
+        logs.append(full_log)
+        node_result, agate_table = None, None
+        if result is not None and result.success and getattr(result, 'result', None) is not None:
+            node_result = next(iter(result.result.results), None)
+            agate_table = getattr(node_result, 'agate_table', None)
+        if outcomes is not None:
+            outcomes[f"{CONSOLIDATED_FOLDER}/{file_name}"] = agate_table is not None
+        if agate_table is None:
+            success = False
+            error_message = f"Consolidated check {node_name} failed. See output for details."
+            test_results.extend({"test_name": test_id, "status": "ERROR", "message": error_message} for test_id in expected_test_ids)
+            continue
+        rows = [{'test_id': row['test_id'], 'failing_rows': row['failing_rows']} for row in agate_table.rows]
+        # Every Test ID of the query shares its single scan.
+        stats = _run_stats(node_result, node_name)
+        test_results.extend({**check_result, **stats} for check_result in expand_consolidated_results(rows, expected_test_ids))
+    return test_results, success, "\n".join(logs)
+
+
+async def run_unit_testing_dbt_project(dbt_project_gcs_path: str, dbt_command: str, model_name: Optional[str] = None, sample: bool = False,
+                                       threads: Optional[int] = None) -> dict:
     """
     Runs specified dbt commands (e.g., 'run', 'test') for a dbt project
     stored in a Google Cloud Storage (GCS) bucket using dbt's programmatic invocation API.
     Can also run a specific model within the project.
 
     Args:
-        dbt_project_gcs_path (str): The GCS URL to the dbt project folder
+        dbt_project_gcs_path (str): The storage URL of the dbt project folder
                                      (e.g., 'gs://your-bucket/your-dbt-project-name').
+                                     A 'file://' project is run in place, without
+                                     a download.
         dbt_command (str): The dbt command to execute ('run' or 'test').
         model_name (Optional[str]): The name of a specific model to run. If None, all models
                                      or tests within the project (based on dbt_command) are executed.
+        sample (bool): For 'test' only. Runs the tests against a sample of each model
+                       instead of the full data. Meant for the fix-and-retry attempts,
+                       which look for compilation and database errors; the final
+                       results must come from a run without sampling.
+        threads (Optional[int]): Number of dbt threads. By default derived from the
+                       number of models (or tests) that can run in parallel,
+                       capped by the warehouse concurrency budget.
 
     Returns:
         dict: A dictionary indicating the success or failure of the dbt command
-              and any relevant output or error messages.
+              and any relevant output or error messages. A successful 'run' or
+              'snapshot' also returns a `profile` of every node (execution time,
+              bytes processed and billed, slot-ms, rows affected), which is saved
+              to {project}/perf/ and compared with the previous run.
     """
+    # Downloading the project and running dbt are both blocking, so the whole
+    # invocation runs on a worker thread to keep other sessions responsive.
+    return await asyncio.to_thread(_run_unit_testing_dbt_project, dbt_project_gcs_path, dbt_command, model_name, sample, threads)
+
+
+def _save_run_profile(bucket, dbt_project_gcs_path: str, run_results, dbt_command: str) -> dict:
+    """Profiles every node of a successful run and persists the profile; a failed upload only loses the history."""
+    profile = build_profile(run_results, dbt_command)
+    try:
+        profile_path = save_profile(bucket, infer_dbt_project_name_from_gcs_path(dbt_project_gcs_path), profile)
+        profile['profile_gcs_path'] = storage_url(bucket, profile_path)
+    except Exception as err:
+        print(f"Warning: could not save the performance profile: {err}")
+    return profile
+
+
+def _run_unit_testing_dbt_project(dbt_project_gcs_path: str, dbt_command: str, model_name: Optional[str] = None, sample: bool = False,
+                                  threads: Optional[int] = None) -> dict:
     if not dbtRunner:
         return {"result": "ERROR", "message": "dbt-core is not installed, programmatic invocation is not possible."}
 
-    if not dbt_project_gcs_path.startswith('gs://'):
-        return {"result": "ERROR", "message": "Invalid GCS project path. Must start with 'gs://'."}
+    if not is_storage_url(dbt_project_gcs_path):
+        return {"result": "ERROR", "message": INVALID_URL_MESSAGE}
     if dbt_command not in ['run', 'test', 'snapshot', 'ls']:
         return {"result": "ERROR", "message": "Unsupported dbt command. Only 'run', 'test', and 'snapshot' are supported."}
 
-    storage_client = storage.Client()
     if model_name and dbt_command == 'test':
         print(f"Warning: model_name specified for 'test' command. Running 'dbt test --select {model_name}'.")
+    if sample and dbt_command != 'test':
+        # Sampling a run would materialize partial models.
+        print(f"Warning: sample is only supported for 'test'. Running 'dbt {dbt_command}' on the full data.")
+        sample = False
 
     temp_dir = None
     try:
-        parsed_url = urlparse(dbt_project_gcs_path)
-        bucket_name = parsed_url.netloc
-        project_gcs_prefix = parsed_url.path.lstrip('/')
+        bucket, project_gcs_prefix = split_storage_url(dbt_project_gcs_path)
 
-        # Create a temporary directory to download the dbt project
-        # This will be the root of our dbt project.
-        temp_dir = f"/tmp/dbt_project_{os.urandom(4).hex()}"
-        os.makedirs(temp_dir, exist_ok=True)
-        print(f"Created temporary directory: {temp_dir}")
+        # A file:// project is run where it is, with no download at all; sampling
+        # installs a macro into the project, so it always runs on a copy.
+        project_dir = None if sample else local_directory(bucket, project_gcs_prefix)
+        if project_dir is not None:
+            if not os.path.isdir(project_dir):
+                return {"result": "ERROR", "message": f"No dbt project files found at {dbt_project_gcs_path}"}
+            print(f"Running dbt in the local project directory: {project_dir}")
+        else:
+            # Create a temporary directory to download the dbt project
+            # This will be the root of our dbt project.
+            temp_dir = f"/tmp/dbt_project_{os.urandom(4).hex()}"
+            os.makedirs(temp_dir, exist_ok=True)
+            print(f"Created temporary directory: {temp_dir}")
 
-        bucket = storage_client.bucket(bucket_name)
-
-        # List all blobs under the project prefix and download them
-        blobs = bucket.list_blobs(prefix=project_gcs_prefix)
-        downloaded_files_count = 0
-        for blob in blobs:
-            # Construct local file path, preserving directory structure
-            # The key change is here: the project root is 'temp_dir' not 'temp_dir/dbt'
-            relative_path = os.path.relpath(blob.name, project_gcs_prefix)
-            local_file_path = os.path.join(temp_dir, relative_path)
-
-            # Ensure the directory structure exists locally
-            os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-
-            print(f"Downloading {blob.name} to {local_file_path}")
-            blob.download_to_filename(local_file_path)
-            downloaded_files_count += 1
-
-        if downloaded_files_count == 0:
-            return {"result": "ERROR", "message": f"No dbt project files found at {dbt_project_gcs_path}"}
+            # Download every blob under the project prefix, preserving the directory
+            # structure: the project root is 'temp_dir' not 'temp_dir/dbt'
+            downloaded_files_count = download_prefix(bucket, project_gcs_prefix, temp_dir)
+            print(f"Downloaded {downloaded_files_count} files to {temp_dir}")
+            if downloaded_files_count == 0:
+                return {"result": "ERROR", "message": f"No dbt project files found at {dbt_project_gcs_path}"}
+            project_dir = temp_dir
 
         # Verify profiles.yml exists
-        profiles_yml_path = os.path.join(temp_dir, "profiles.yml")
+        profiles_yml_path = os.path.join(project_dir, "profiles.yml")
         if not os.path.exists(profiles_yml_path):
             return {
                 "result": "ERROR",
-                "message": (f"Error: 'profiles.yml' not found in the downloaded dbt project at {temp_dir}. "
-                            "Please ensure your GCS dbt project includes a profiles.yml file at its root.")
+                "message": (f"Error: 'profiles.yml' not found in the dbt project at {project_dir}. "
+                            "Please ensure your dbt project includes a profiles.yml file at its root.")
             }
         print(f"Found profiles.yml at: {profiles_yml_path}")
 
-        old_stdout = sys.stdout
-        old_stderr = sys.stderr
-        sys.stdout = captured_stdout = StringIO()
-        sys.stderr = captured_stderr = StringIO()
-        
-        result = None
-        try:
-            dbt = dbtRunner()
-            cli_args = [dbt_command, "--project-dir", temp_dir, "--profiles-dir", temp_dir]
-            if model_name:
-                cli_args.extend(["--select", model_name])
-
-            print(f"Executing dbt command programmatically: dbt {' '.join(cli_args)}")
-
-            result = dbt.invoke(cli_args)
-        finally:
-            stdout_val = captured_stdout.getvalue()
-            stderr_val = captured_stderr.getvalue()
-            sys.stdout = old_stdout
-            sys.stderr = old_stderr
-            print(f"--- Captured dbt stdout ---\n{stdout_val}\n--- End dbt stdout ---")
-            if stderr_val:
-                print(f"--- Captured dbt stderr ---\n{stderr_val}\n--- End dbt stderr ---")
-
-        full_log = stdout_val
-        if stderr_val:
-            full_log += "\n--- STDERR ---\n" + stderr_val
+        dbt = dbtRunner()
+        sample_args = install_sample_macro(project_dir) if sample else []
+        cli_args = [dbt_command, "--project-dir", project_dir, "--profiles-dir", project_dir] + sample_args
+        if dbt_command != 'ls':
+            # Overrides the threads of profiles.yml, which was written before the models and tests existed.
+            threads = threads if threads else recommend_threads(dag_width(read_project_files(project_dir), dbt_command))
+            cli_args.extend(["--threads", str(threads)])
+        if model_name:
+            cli_args.extend(["--select", model_name])
+        result, full_log = _invoke_dbt(dbt, cli_args)
 
         # Special handling for 'dbt test' to provide structured output
         if dbt_command == 'test':
             test_results_list = []
-            if hasattr(result, 'results') and result.results:
-                for res in result.results:
+            # dbtRunnerResult.result holds the RunExecutionResult with one entry per test.
+            run_results = getattr(result, 'result', None)
+            if run_results is not None and getattr(run_results, 'results', None):
+                for res in run_results.results:
                     # Start with the default message from the result object
                     failure_message = res.message or ""
                     # If the test failed, try to find a more descriptive message in the logs.
@@ -129,7 +261,8 @@ def run_unit_testing_dbt_project(dbt_project_gcs_path: str, dbt_command: str, mo
                     test_results_list.append({
                         "test_name": res.node.name,
                         "status": str(res.status).upper(),
-                        "message": failure_message
+                        "message": failure_message,
+                        **_run_stats(res, res.node.name)
                     })
             
             summary_line = ""
@@ -138,27 +271,50 @@ def run_unit_testing_dbt_project(dbt_project_gcs_path: str, dbt_command: str, mo
                     summary_line = line.strip()
                     break
 
+            # Checks folded into single-scan queries report per Test ID as well.
+            outcomes = _file_outcomes(run_results, {})
+            consolidated_results, consolidated_success, consolidated_log = _run_consolidated_checks(
+                dbt, project_dir, model_name, sample_args, outcomes
+            )
+            _settle_repairs(dbt_project_gcs_path, outcomes)
+            if consolidated_results:
+                test_results_list.extend(consolidated_results)
+                statuses = [res['status'] for res in consolidated_results]
+                summary_line += (f" Consolidated checks: PASS={statuses.count('PASS')} "
+                                 f"FAIL={statuses.count('FAIL')} ERROR={statuses.count('ERROR')}")
+                full_log += "\n" + consolidated_log
+            success = result.success and consolidated_success
+
             response = {
-                "result": "SUCCESS" if result.success else "FAILED",
+                "result": "SUCCESS" if success else "FAILED",
                 "command": ' '.join(cli_args),
-                "message": f"dbt test completed. {summary_line}",
+                "message": f"dbt test completed. {summary_line.strip()}",
                 "test_results": test_results_list
             }
+            if sample:
+                response["sampled"] = True
+                response["message"] = (f"dbt test completed on sampled data ({describe_sample()}). "
+                                       f"{summary_line.strip()} Run again without sampling for the final results.")
 
             # If the test command failed, include the full log for debugging.
-            if not result.success:
+            if not success:
                 response['stdout'] = full_log
 
             return response
 
         # Existing logic for other commands (run, snapshot, ls)
+        if dbt_command in ('run', 'snapshot'):
+            _settle_repairs(dbt_project_gcs_path, _file_outcomes(getattr(result, 'result', None), {}))
         if result.success:
             message = f"DBT command '{dbt_command}' executed successfully."
-            return {
+            response = {
                 "result": "SUCCESS",
                 "command": ' '.join(cli_args),
                 "message": message
             }
+            if dbt_command in ('run', 'snapshot') and getattr(result, 'result', None) is not None:
+                response["profile"] = _save_run_profile(bucket, dbt_project_gcs_path, result.result, dbt_command)
+            return response
 
         if result.exception:
             return {
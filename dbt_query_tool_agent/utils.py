@@ -1,3 +1,4 @@
+import asyncio
 import os
 import getpass
 from urllib.parse import urlparse
@@ -58,4 +59,32 @@ def infer_dbt_project_name_from_gcs_path(gcs_path: str) -> str:
         return os.path.splitext(original_filename)[0]
     else:
         path_parts = blob_name.split('/')
-        return path_parts[0] if path_parts else ""
\ No newline at end of file
+        return path_parts[0] if path_parts else ""
+
+async def read_blob_bytes(blob) -> bytes:
+    """
+    Downloads a GCS blob on a worker thread so the event loop stays free for
+    other sessions while the transfer is in flight.
+    """
+    return await asyncio.to_thread(blob.download_as_bytes)
+
+
+async def blob_exists(blob) -> bool:
+    """Non-blocking variant of `blob.exists()`."""
+    return await asyncio.to_thread(blob.exists)
+
+
+async def write_blob(blob, content, content_type: str = 'text/plain') -> None:
+    """
+    Uploads `content` (str or bytes) to a GCS blob on a worker thread.
+    Any `blob.metadata` set by the caller is sent along with the upload.
+    """
+    await asyncio.to_thread(blob.upload_from_string, content, content_type=content_type)
+
+
+async def delete_blob(blob) -> bool:
+    """Deletes a GCS blob if it exists. Returns True if something was deleted."""
+    if not await blob_exists(blob):
+        return False
+    await asyncio.to_thread(blob.delete)
+    return True